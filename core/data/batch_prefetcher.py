@@ -0,0 +1,215 @@
+import multiprocessing
+import traceback
+from multiprocessing.sharedctypes import RawArray
+from random import Random
+from math import ceil
+
+import numpy as np
+
+
+class BatchPrefetcher:
+    """
+    Generate (X, y) batches in background worker processes while the main process is busy (e.g. with the training
+    of the network).
+
+    The first batch is generated in the main process (it defines the array layout). Each worker has its own random
+    seed (derived from the given seed) and generates every worker_count-th of the following batches. The batches are
+    always returned in the same order, therefore the generated data is reproducible as long as the seed and the worker
+    count do not change.
+
+    The arrays are not pickled: Each worker owns some slots in shared memory and only the slot index is sent through a
+    (bounded) queue. The workers are forked, therefore the batch function may use any object of the parent process.
+    """
+
+    def __init__(self, f_generate_batch, prefetch_count=4, worker_count=2, seed=None, f_reseed=None):
+        """
+        :param f_generate_batch: A function without arguments that returns (X, y). X is a list of np-arrays and y is a
+        dictionary (name => np-array). All batches must have the same array shapes.
+        :param prefetch_count: The amount of batches that may be generated in advance.
+        :param worker_count: The amount of worker processes.
+        :param seed: The base seed; the worker seeds are derived from it.
+        :param f_reseed: A function that is called in each worker with the worker seed before any batch is generated.
+        """
+        self.__f_generate_batch = f_generate_batch
+        self.__prefetch_count = prefetch_count
+        self.__worker_count = worker_count
+        self.__seed = seed
+        self.__f_reseed = f_reseed
+
+        self.__layout = None
+        self.__slots = None
+        self.__free_queues = None
+        self.__ready_queues = None
+        self.__workers = None
+        self.__first_batch = None
+        self.__next_batch = 0
+        self.__checked_out = None
+
+    @property
+    def is_running(self):
+        return self.__workers is not None
+
+    @property
+    def prefetch_count(self):
+        return self.__prefetch_count
+
+    @property
+    def worker_count(self):
+        return self.__worker_count
+
+    @staticmethod
+    def get_worker_seeds(seed, worker_count):
+        rand = Random(seed)
+        return [rand.getrandbits(32) for i in range(worker_count)]
+
+    @staticmethod
+    def _get_layout(X, y):
+        # The layout contains for each array (the X arrays first and then the y arrays sorted by their name) the key,
+        # the shape, the dtype and the offset in the slot
+        layout = []
+        offset = 0
+        for key, arr in [(('X', i), X[i]) for i in range(len(X))] + [(('y', name), y[name]) for name in sorted(y.keys())]:
+            arr = np.asarray(arr)
+            layout.append({
+                'key': key,
+                'shape': arr.shape,
+                'dtype': arr.dtype,
+                'offset': offset
+            })
+
+            # Align each array to 8 bytes
+            offset += int(ceil(arr.nbytes / 8.)) * 8
+        return layout, offset
+
+    def __get_slot_arrays(self, slot):
+        X = []
+        y = {}
+        for entry in self.__layout:
+            arr = np.frombuffer(
+                slot, dtype=entry['dtype'], count=int(np.prod(entry['shape'])), offset=entry['offset']
+            ).reshape(entry['shape'])
+            target, name = entry['key']
+            if target == 'X':
+                X.append(arr)
+            else:
+                y[name] = arr
+        return X, y
+
+    def __write_slot(self, slot, X, y):
+        X_slot, y_slot = self.__get_slot_arrays(slot)
+        if len(X) != len(X_slot) or sorted(y.keys()) != sorted(y_slot.keys()):
+            raise Exception("The generated batch does not match the layout of the first batch")
+        for target, source in list(zip(X_slot, X)) + [(y_slot[name], y[name]) for name in y_slot.keys()]:
+            source = np.asarray(source)
+            if source.shape != target.shape:
+                raise Exception("Invalid batch array shape (expected {}, but got {})".format(target.shape, source.shape))
+            target[...] = source
+
+    def __worker(self, worker_index, seed):
+        free_queue = self.__free_queues[worker_index]
+        ready_queue = self.__ready_queues[worker_index]
+        try:
+            if self.__f_reseed is not None:
+                self.__f_reseed(seed)
+            while True:
+                slot_index = free_queue.get()
+                if slot_index is None:
+                    break
+                X, y = self.__f_generate_batch()
+                self.__write_slot(self.__slots[worker_index][slot_index], X, y)
+                ready_queue.put(slot_index)
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            ready_queue.put(traceback.format_exc())
+
+    def start(self, first_batch=None):
+        """
+        Start the worker processes. The array layout is taken from the first batch. This batch is generated in the
+        main process and it is returned by the first call of next_batch.
+        :param first_batch: Optionally an already generated batch (X, y) that defines the array layout.
+        :return:
+        """
+        if self.is_running:
+            return
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            raise Exception("Prefetching requires the 'fork' start method, which is not available on this platform")
+
+        if first_batch is None:
+            first_batch = self.__f_generate_batch()
+        self.__layout, slot_size = self._get_layout(*first_batch)
+
+        # The main process always holds one slot (the current batch), therefore each worker gets one additional slot
+        slots_per_worker = int(ceil(self.__prefetch_count / self.__worker_count)) + 1
+        self.__slots = [
+            [RawArray('b', max(slot_size, 1)) for s in range(slots_per_worker)] for w in range(self.__worker_count)
+        ]
+        self.__free_queues = [ctx.Queue() for w in range(self.__worker_count)]
+        self.__ready_queues = [ctx.Queue(maxsize=slots_per_worker) for w in range(self.__worker_count)]
+        for w in range(self.__worker_count):
+            for s in range(slots_per_worker):
+                self.__free_queues[w].put(s)
+
+        seeds = self.get_worker_seeds(self.__seed, self.__worker_count)
+        self.__workers = []
+        for w in range(self.__worker_count):
+            worker = ctx.Process(target=self.__worker, args=(w, seeds[w]), daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+        self.__first_batch = first_batch
+        self.__next_batch = 0
+        self.__checked_out = None
+        print("Started {} prefetch workers ({} batches, {} bytes per batch)".format(self.__worker_count, self.__prefetch_count, slot_size))
+
+    def next_batch(self):
+        """
+        Get the next batch. The returned arrays are views on shared memory (except for the first batch, which was
+        generated in the main process): They are only valid until next_batch or stop is called again.
+        :return: X, y
+        """
+        if not self.is_running:
+            raise Exception("The prefetcher is not running")
+        self.__release_checked_out()
+
+        # The batch that was generated in the main process is returned first
+        if self.__first_batch is not None:
+            first_batch = self.__first_batch
+            self.__first_batch = None
+            return first_batch
+
+        worker_index = self.__next_batch % self.__worker_count
+        slot_index = self.__ready_queues[worker_index].get()
+        if isinstance(slot_index, str):
+            self.stop()
+            raise Exception("A prefetch worker failed:\n{}".format(slot_index))
+        self.__next_batch += 1
+        self.__checked_out = (worker_index, slot_index)
+
+        return self.__get_slot_arrays(self.__slots[worker_index][slot_index])
+
+    def __release_checked_out(self):
+        if self.__checked_out is not None:
+            worker_index, slot_index = self.__checked_out
+            self.__free_queues[worker_index].put(slot_index)
+            self.__checked_out = None
+
+    def __del__(self):
+        self.stop()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        for free_queue in self.__free_queues:
+            free_queue.put(None)
+        for worker in self.__workers:
+            worker.join(timeout=5.)
+            if worker.is_alive():
+                worker.terminate()
+        self.__workers = None
+        self.__first_batch = None
+        self.__checked_out = None
+        self.__free_queues = None
+        self.__ready_queues = None
+        self.__slots = None
@@ -0,0 +1,128 @@
+from itertools import chain
+import numbers
+
+import numpy as np
+
+
+class ClusterBatch:
+    """
+    An array based representation of the data that is returned by DataProvider.get_data. Instead of nested lists
+    (collections -> clusters -> elements) it contains:
+    - data: A contiguous (B, N, *data_shape) array with all elements
+    - cluster_indices: A (B, N) integer array with the cluster index of each element
+    - cluster_counts: A (B,) integer array with the cluster count of each collection
+    - additional_obj_info: Like the get_data output (a list with an entry for each collection)
+    - hints: A list with an entry for each collection; each entry is None or a list of element index arrays
+
+    The elements of each collection are stored cluster by cluster (like in the list format), therefore the cluster
+    indices of a collection are always sorted.
+
+    The old list format is available via to_list_data; its elements are views on "data".
+    """
+
+    def __init__(self, data, cluster_indices, cluster_counts, additional_obj_info=None, hints=None):
+        self.data = data
+        self.cluster_indices = cluster_indices
+        self.cluster_counts = cluster_counts
+        self.additional_obj_info = additional_obj_info if additional_obj_info is not None else [None] * len(cluster_counts)
+        self.hints = hints if hints is not None else [None] * len(cluster_counts)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def input_count(self):
+        return self.data.shape[1]
+
+    @property
+    def data_shape(self):
+        return self.data.shape[2:]
+
+    @staticmethod
+    def allocate(cluster_collection_count, input_count, data_shape, dtype=np.float32):
+        return ClusterBatch(
+            np.zeros((cluster_collection_count, input_count) + tuple(data_shape), dtype=dtype),
+            np.zeros((cluster_collection_count, input_count), dtype=np.int32),
+            np.zeros((cluster_collection_count,), dtype=np.int32)
+        )
+
+    def can_hold(self, cluster_collection_count, input_count, data_shape):
+        return self.data.shape == (cluster_collection_count, input_count) + tuple(data_shape)
+
+    @staticmethod
+    def from_list_data(data, data_shape, additional_obj_info=None, hints=None, out=None):
+        """
+        Convert data in the get_data format to a batch.
+        :param data: The clusters of each collection: [[[element, ...], ...], ...]
+        :param data_shape: The shape of an element
+        :param additional_obj_info: The additional object infos (as returned by get_data)
+        :param hints: The hints (as returned by get_data); each hint contains element indices (see resolve_hints).
+        :param out: A batch whose buffers should be reused (if they have the correct size)
+        :return: The batch
+        """
+        cluster_collection_count = len(data)
+        input_count = sum(map(len, data[0])) if cluster_collection_count > 0 else 0
+        if out is None or not out.can_hold(cluster_collection_count, input_count, data_shape):
+            out = ClusterBatch.allocate(cluster_collection_count, input_count, data_shape)
+
+        out.additional_obj_info = list(additional_obj_info) if additional_obj_info is not None else [None] * cluster_collection_count
+        out.hints = []
+        for c in range(cluster_collection_count):
+            clusters = data[c]
+            elements = list(chain.from_iterable(clusters))
+            if len(elements) != input_count:
+                raise Exception("All collections of a batch must have the same element count (expected {}, but got {})".format(input_count, len(elements)))
+
+            i = 0
+            for ci in range(len(clusters)):
+                cluster_size = len(clusters[ci])
+                for element in clusters[ci]:
+                    out.data[c, i] = np.reshape(element, out.data.shape[2:])
+                    i += 1
+                out.cluster_indices[c, (i - cluster_size):i] = ci
+            out.cluster_counts[c] = len(clusters)
+
+            out.hints.append(ClusterBatch.resolve_hints(elements, None if hints is None else hints[c]))
+
+        return out
+
+    @staticmethod
+    def resolve_hints(elements, hints):
+        """
+        Convert the hints of a single cluster collection to element index arrays. The providers emit the hints already
+        as element indices (the index of the element in the flattened cluster list); for compatibility hints may also
+        contain the elements itself (or (element, info) tuples), which are resolved by their identity.
+        :param elements: The flattened cluster list
+        :param hints: None or a list of hints
+        :return: None or a list of int32 index arrays
+        """
+        if hints is None:
+            return None
+        element_indices = None
+        result = []
+        for hint in hints:
+            if all(isinstance(x, numbers.Integral) for x in hint):
+                result.append(np.asarray(hint, dtype=np.int32).reshape((-1,)))
+            else:
+                if element_indices is None:
+                    element_indices = {id(element): i for i, element in enumerate(elements)}
+                result.append(np.asarray([
+                    element_indices[id(x[0] if isinstance(x, tuple) else x)] for x in hint
+                ], dtype=np.int32))
+        return result
+
+    def get_cluster_sizes(self, c):
+        return np.bincount(self.cluster_indices[c], minlength=self.cluster_counts[c])
+
+    def to_list_data(self):
+        """
+        Return the batch in the get_data format. The elements are views on the batch data.
+        :return: [[[element, ...], ...], ...]
+        """
+        result = []
+        for c in range(len(self)):
+            offsets = np.concatenate([[0], np.cumsum(self.get_cluster_sizes(c))])
+            result.append([
+                [self.data[c, i] for i in range(offsets[ci], offsets[ci + 1])] for ci in range(self.cluster_counts[c])
+            ])
+        return result
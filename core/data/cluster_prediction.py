@@ -0,0 +1,233 @@
+import numpy as np
+
+
+class ClusterPrediction:
+    """
+    An array based representation of the output of ClusterNN.predict. Instead of a list of dictionaries (collections ->
+    elements -> cluster counts) it contains:
+    - cluster_count: A (B, K) array with the cluster count distribution of each collection (K is the amount of possible
+      cluster counts)
+    - assignments: A (B, N, sum_k) array with the cluster assignment distributions. The distributions for all cluster
+      counts are stored one after another: The distribution for k clusters starts at offsets[k]
+    - additional_outputs: A dictionary (name => (B, ...) array) with the additional prediction outputs
+
+    The old list format is still available: Indexing (prediction[i]) and iterating creates the dictionary of a
+    collection on demand, to_list creates all of them. Their arrays are views on "assignments".
+    """
+
+    def __init__(self, cluster_counts, cluster_count, assignments, additional_outputs=None):
+        self.cluster_counts = list(cluster_counts)
+        self.cluster_count = cluster_count
+        self.assignments = assignments
+        self.additional_outputs = additional_outputs if additional_outputs is not None else {}
+
+        self.offsets = {}
+        offset = 0
+        for k in self.cluster_counts:
+            self.offsets[k] = offset
+            offset += k
+        if offset != assignments.shape[2]:
+            raise Exception("Invalid assignments shape (expected {} distribution values, but got {})".format(offset, assignments.shape[2]))
+
+    @staticmethod
+    def from_outputs(cluster_counts, assignment_outputs, cluster_count_output, additional_outputs=None):
+        """
+        Create a prediction object from the (split) outputs of the prediction model.
+        :param cluster_counts: The possible cluster counts
+        :param assignment_outputs: A list of (B, 1, k) outputs: For each input the distributions of all cluster counts
+        :param cluster_count_output: The (B, K) cluster count output
+        :param additional_outputs: A dictionary with the additional outputs
+        :return: The prediction object
+        """
+        cluster_counts = list(cluster_counts)
+        input_count = len(assignment_outputs) // len(cluster_counts)
+        batch_size = cluster_count_output.shape[0]
+        assignments = np.empty((batch_size, input_count, sum(cluster_counts)), dtype=cluster_count_output.dtype)
+        offset = 0
+        for j in range(len(cluster_counts)):
+            k = cluster_counts[j]
+            for i in range(input_count):
+                assignments[:, i, offset:(offset + k)] = np.reshape(assignment_outputs[len(cluster_counts) * i + j], (batch_size, k))
+            offset += k
+        return ClusterPrediction(cluster_counts, cluster_count_output, assignments, additional_outputs)
+
+    @staticmethod
+    def from_stacked_outputs(cluster_counts, assignment_outputs, cluster_count_output, additional_outputs=None):
+        """
+        Create a prediction object from the stacked outputs of a prediction model with a packed input.
+        :param cluster_counts: The possible cluster counts
+        :param assignment_outputs: A list with a (B, N, k) output for each cluster count
+        :param cluster_count_output: The (B, K) cluster count output
+        :param additional_outputs: A dictionary with the additional outputs
+        :return: The prediction object
+        """
+        assignments = np.concatenate(assignment_outputs, axis=2).astype(cluster_count_output.dtype, copy=False)
+        return ClusterPrediction(cluster_counts, cluster_count_output, assignments, additional_outputs)
+
+    @staticmethod
+    def from_shared_outputs(cluster_counts, assignment_output, cluster_count_output, additional_outputs=None):
+        """
+        Create a prediction object from the output of a prediction model with a shared assignment head.
+        :param cluster_counts: The possible cluster counts
+        :param assignment_output: The (B, N, K, k_max) output: assignment_output[:, :, j, :k] contains the
+        distributions for the j-th cluster count k
+        :param cluster_count_output: The (B, K) cluster count output
+        :param additional_outputs: A dictionary with the additional outputs
+        :return: The prediction object
+        """
+        cluster_counts = list(cluster_counts)
+        i_cluster_counts = np.concatenate([np.full((k,), j) for j, k in enumerate(cluster_counts)])
+        i_clusters = np.concatenate([np.arange(k) for k in cluster_counts])
+        assignments = assignment_output[:, :, i_cluster_counts, i_clusters].astype(cluster_count_output.dtype, copy=False)
+        return ClusterPrediction(cluster_counts, cluster_count_output, assignments, additional_outputs)
+
+    def __len__(self):
+        return self.assignments.shape[0]
+
+    @property
+    def input_count(self):
+        return self.assignments.shape[1]
+
+    def get_assignments(self, k):
+        """
+        Get the cluster assignment distributions for k clusters.
+        :param k: The cluster count
+        :return: A (B, N, k) view
+        """
+        offset = self.offsets[k]
+        return self.assignments[:, :, offset:(offset + k)]
+
+    def argmax_assignments(self, k):
+        """
+        Get the most probable cluster of each element, assuming there are k clusters.
+        :param k: The cluster count
+        :return: A (B, N) array with cluster indices
+        """
+        return np.argmax(self.get_assignments(k), axis=2)
+
+    def most_probable_k(self):
+        """
+        Get the most probable cluster count of each collection.
+        :return: A (B,) array
+        """
+        return np.argmax(self.cluster_count, axis=1) + self.cluster_counts[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return {
+            'cluster_count': self.cluster_count[i],
+            'elements': [
+                {k: self.assignments[i, n, self.offsets[k]:(self.offsets[k] + k)] for k in self.cluster_counts}
+                for n in range(self.input_count)
+            ],
+            'additional_outputs': {name: output[i] for name, output in self.additional_outputs.items()}
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_list(self):
+        """
+        Create the old list format:
+        [
+           {
+               'cluster_count': [0.2, 0.3, 0.5],
+               'elements': [
+                   {
+                       k_min: [0.3, 0.7],
+                       ...
+                       k_max: [0.3, 0.3, 0.3, 0.1]
+                   },
+                   ...
+               ],
+               'additional_outputs': {...}
+           },
+           ...
+        ]
+        :return: The list
+        """
+        return list(self)
+
+
+class TopClusterPrediction:
+    """
+    The result of a two-phase prediction (see ClusterNN.predict with top_cluster_counts): The cluster assignments are
+    only calculated for the m most probable cluster counts of each collection. It contains:
+    - cluster_count: A (B, K) array with the cluster count distribution of each collection
+    - candidate_cluster_counts: A (B, m) array with the m most probable cluster counts of each collection (the most
+      probable first)
+    - assignments: A (B, m, N, k_max) array: assignments[i, j, :, :k] contains the distributions of the collection i
+      for the cluster count k = candidate_cluster_counts[i, j]; all other values are 0
+    - additional_outputs: A dictionary (name => (B, ...) array) with the additional prediction outputs
+
+    Like ClusterPrediction, indexing creates the dictionary of a collection in the list format of ClusterNN.predict, but
+    the elements only contain the candidate cluster counts.
+    """
+
+    def __init__(self, cluster_counts, cluster_count, candidate_cluster_counts, assignments, additional_outputs=None):
+        self.cluster_counts = list(cluster_counts)
+        self.cluster_count = cluster_count
+        self.candidate_cluster_counts = candidate_cluster_counts
+        self.assignments = assignments
+        self.additional_outputs = additional_outputs if additional_outputs is not None else {}
+
+    def __len__(self):
+        return self.assignments.shape[0]
+
+    @property
+    def input_count(self):
+        return self.assignments.shape[2]
+
+    @property
+    def top_count(self):
+        return self.candidate_cluster_counts.shape[1]
+
+    def get_assignments(self, i, j=0):
+        """
+        Get the cluster assignment distributions of the collection i for its j-th candidate cluster count.
+        :param i: The collection index
+        :param j: The candidate index (0 is the most probable cluster count)
+        :return: A (N, k) view
+        """
+        return self.assignments[i, j, :, :self.candidate_cluster_counts[i, j]]
+
+    def argmax_assignments(self, j=0):
+        """
+        Get the most probable cluster of each element, assuming there are as many clusters as the j-th candidate
+        cluster count of the collection.
+        :param j: The candidate index (0 is the most probable cluster count)
+        :return: A (B, N) array with cluster indices
+        """
+        return np.argmax(self.assignments[:, j], axis=2)
+
+    def most_probable_k(self):
+        """
+        Get the most probable cluster count of each collection.
+        :return: A (B,) array
+        """
+        return self.candidate_cluster_counts[:, 0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return {
+            'cluster_count': self.cluster_count[i],
+            'elements': [
+                {int(k): self.assignments[i, j, n, :k] for j, k in enumerate(self.candidate_cluster_counts[i])}
+                for n in range(self.input_count)
+            ],
+            'additional_outputs': {name: output[i] for name, output in self.additional_outputs.items()}
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_list(self):
+        """
+        Create the list format of ClusterNN.predict (the elements only contain the candidate cluster counts).
+        :return: The list
+        """
+        return list(self)
@@ -12,7 +12,9 @@ import json
 
 from yattag import Doc
 
-from core.helper import try_makedirs, index_of
+from core.helper import try_makedirs
+from core.data.cluster_batch import ClusterBatch
+from core.data.cluster_prediction import ClusterPrediction
 
 class DataProvider:
     def __init__(self, target_min_cluster_count=None, target_max_cluster_count=None, seed=None):
@@ -20,6 +22,15 @@ class DataProvider:
         self.target_min_cluster_count = target_min_cluster_count
         self.target_max_cluster_count = target_max_cluster_count
 
+    def reseed(self, seed):
+        """
+        Reseed the random number generators of this data provider (e.g. for background workers that generate data).
+        Sub-classes with own random number generators should extend this method.
+        :param seed:
+        :return:
+        """
+        self.__rand.seed(seed)
+
     def get_min_cluster_count(self):
         pass
 
@@ -91,6 +102,11 @@ class DataProvider:
         #     ]
         # ]
 
+        # Batches are handled without python lists: X is then a (B, N, *data_shape) array and the shuffle indices a
+        # (B, N) array
+        if isinstance(data, ClusterBatch):
+            return self.__convert_batch_to_prediction_X(data, shuffle=shuffle)
+
         X = []
         res_hints = []
         shuffle_indices = []
@@ -107,22 +123,46 @@ class DataProvider:
             shuffle_indices.append(shuffle_idx)
 
             if hints is not None and hints[i] is not None:
-                curr_hints = list(map(
-                    lambda cluster_hint: list(map(
-                        lambda x: index_of(X, x),
-                        cluster_hint
-                    )),
-                    hints[i]
-                ))
+
+                # The hints contain the original element indices: Map them to the shuffled indices
+                inverse_shuffle_idx = np.argsort(shuffle_idx)
+                curr_hints = [
+                    inverse_shuffle_idx[hint].tolist() for hint in ClusterBatch.resolve_hints(list(chain.from_iterable(cluster_collection)), hints[i])
+                ]
             else:
                 curr_hints = None
             res_hints.append(curr_hints)
 
         return X, res_hints, shuffle_indices
 
+    def __convert_batch_to_prediction_X(self, batch, shuffle=True):
+        shuffle_indices = np.tile(np.arange(batch.input_count), (len(batch), 1))
+        res_hints = []
+        for i in range(len(batch)):
+            if shuffle:
+                self.__rand.shuffle(shuffle_indices[i])
+            if batch.hints[i] is not None:
+
+                # The hints contain the original element indices: Map them to the shuffled indices
+                inverse_shuffle_idx = np.argsort(shuffle_indices[i])
+                curr_hints = [inverse_shuffle_idx[hint].tolist() for hint in batch.hints[i]]
+            else:
+                curr_hints = None
+            res_hints.append(curr_hints)
+        X = batch.data[np.arange(len(batch))[:, np.newaxis], shuffle_indices]
+        return X, res_hints, shuffle_indices
+
     def convert_prediction_to_clusters(self, X, prediction, point_post_processor=None, additional_obj_info=None,
                                        return_reformatted_additional_obj_infos=False):
 
+        # Handle compact predictions: The cluster assignments are calculated at once for all collections
+        if isinstance(prediction, ClusterPrediction):
+            cluster_assignments = {k: prediction.argmax_assignments(k) for k in self.get_target_cluster_counts()}
+            return list(map(lambda i: self.__assignments_to_clusters(X[i], {k: a[i] for k, a in cluster_assignments.items()},
+                                                                     point_post_processor=point_post_processor,
+                                                                     additional_obj_info=additional_obj_info,
+                                                                     return_reformatted_additional_obj_infos=return_reformatted_additional_obj_infos), range(len(prediction))))
+
         # Handle list inputs
         if isinstance(prediction, list):
             return list(map(lambda i: self.convert_prediction_to_clusters(X[i], prediction[i],
@@ -130,11 +170,20 @@ class DataProvider:
                                                                           additional_obj_info=additional_obj_info,
                                                                           return_reformatted_additional_obj_infos=return_reformatted_additional_obj_infos), range(len(prediction))))
 
+        # Get the most probable cluster of each element (for each cluster count)
+        cluster_assignments = {
+            k: np.argmax(np.asarray([element[k] for element in prediction['elements']]), axis=1) for k in self.get_target_cluster_counts()
+        }
+        return self.__assignments_to_clusters(X, cluster_assignments, point_post_processor=point_post_processor,
+                                              additional_obj_info=additional_obj_info,
+                                              return_reformatted_additional_obj_infos=return_reformatted_additional_obj_infos)
+
+    def __assignments_to_clusters(self, X, cluster_assignments, point_post_processor=None, additional_obj_info=None,
+                                  return_reformatted_additional_obj_infos=False):
         cluster_counts = list(self.get_target_cluster_counts())
 
         # TODO: The following code was first created as a loop and modified -> cleanup
         current_inputs = X
-        current_prediction = prediction
         current_cluster_combinations = {}
         reformatted_additional_obj_infos = {}
 
@@ -148,7 +197,7 @@ class DataProvider:
                 if point_post_processor is not None:
                     point = point_post_processor(point)
 
-                cluster_index = np.argmax(current_prediction['elements'][ii][ci])
+                cluster_index = cluster_assignments[ci][ii]
                 current_clusters[cluster_index].append(point)
                 if additional_obj_info is not None:
                     current_reformatted_additional_obj_infos[cluster_index].append(additional_obj_info[ii])
@@ -176,17 +225,7 @@ class DataProvider:
         :return:
         """
 
-        # Define the max cluster count function: If it is already given we are done
-        if cluster_count_f is None:
-            if cluster_count_range is not None:
-                # Use a range of cluster counts
-                cluster_count_f = lambda: self.__rand.randint(*cluster_count_range)
-            elif cluster_count is not None:
-                # Use a fixed max cluster count
-                cluster_count_f = lambda: cluster_count
-            else:
-                # Use a default value for the cluster count (=None)
-                cluster_count_f = lambda: None
+        cluster_count_f = self.__get_cluster_count_f(cluster_count_f, cluster_count, cluster_count_range)
 
         if dummy_data:
 
@@ -230,6 +269,94 @@ class DataProvider:
 
         return train_data, additional_obj_info, hints
 
+    def __get_cluster_count_f(self, cluster_count_f=None, cluster_count=None, cluster_count_range=None):
+
+        # Define the max cluster count function: If it is already given we are done
+        if cluster_count_f is None:
+            if cluster_count_range is not None:
+                # Use a range of cluster counts
+                cluster_count_f = lambda: self.__rand.randint(*cluster_count_range)
+            elif cluster_count is not None:
+                # Use a fixed max cluster count
+                cluster_count_f = lambda: cluster_count
+            else:
+                # Use a default value for the cluster count (=None)
+                cluster_count_f = lambda: None
+        return cluster_count_f
+
+    def get_batch(self, elements_per_cluster_collection, cluster_collection_count,
+                  cluster_count_f=None, cluster_count=None, cluster_count_range=None,
+                  dummy_data=False, data_type='train', batch=None):
+        """
+        Like get_data, but the result is returned as ClusterBatch (one contiguous array for all elements, the cluster
+        indices and the cluster counts). The old list format is available via ClusterBatch.to_list_data.
+
+        No nested lists are built for the batch: The elements of each collection are written directly to the batch
+        buffer (see _get_clusters_into).
+
+        :param batch: A previously returned batch whose buffers should be reused (if the size matches)
+        :return: The batch
+        """
+        cluster_count_f = self.__get_cluster_count_f(cluster_count_f, cluster_count, cluster_count_range)
+        data_shape = self.get_data_shape()
+        if batch is None or not batch.can_hold(cluster_collection_count, elements_per_cluster_collection, data_shape):
+            batch = ClusterBatch.allocate(cluster_collection_count, elements_per_cluster_collection, data_shape)
+
+        batch.additional_obj_info = []
+        batch.hints = []
+        for c in range(cluster_collection_count):
+            if dummy_data:
+
+                # Dummy 0-data: The elements are assigned round-robin to cluster_count_f() clusters (or to the maximum
+                # cluster count if no value is defined), like get_data does it (empty clusters are removed)
+                cluster_count = cluster_count_f()
+                if cluster_count is None:
+                    cluster_count = self.get_max_cluster_count()
+                cluster_count = min(cluster_count, elements_per_cluster_collection)
+                batch.data[c] = 0.
+                cluster_sizes = np.bincount(np.arange(elements_per_cluster_collection) % cluster_count, minlength=cluster_count)
+                additional_obj_info, hints = None, None
+            else:
+                cluster_sizes, additional_obj_info, hints = self._get_clusters_into(
+                    batch.data[c], elements_per_cluster_collection, cluster_count_f(), data_type=data_type
+                )
+
+                if min(cluster_sizes) == 0:
+                    print("Warning: There are empty clusters in the generated data (this may cause some problems).")
+
+            batch.cluster_indices[c] = np.repeat(np.arange(len(cluster_sizes), dtype=np.int32), cluster_sizes)
+            batch.cluster_counts[c] = len(cluster_sizes)
+            batch.additional_obj_info.append(additional_obj_info)
+            batch.hints.append(hints)
+
+        return batch
+
+    def _get_clusters_into(self, out, element_count, cluster_count=None, data_type='train'):
+        """
+        Like _get_clusters, but the elements are written cluster by cluster to a buffer. The default implementation
+        copies each generated cluster with a single (vectorized) assignment; providers may override this method to
+        generate their elements directly in the buffer.
+        :param out: The (element_count, *data_shape) buffer of the cluster collection
+        :param element_count:
+        :param cluster_count:
+        :param data_type:
+        :return: cluster_sizes, additional_obj_info, hints (element index arrays, see ClusterBatch.resolve_hints)
+        """
+        clusters, additional_obj_info, hints = self._get_clusters(element_count, cluster_count, data_type=data_type)
+        cluster_sizes = [len(cluster) for cluster in clusters]
+        if sum(cluster_sizes) != element_count:
+            raise Exception("All collections of a batch must have the same element count (expected {}, but got {})".format(element_count, sum(cluster_sizes)))
+
+        offset = 0
+        for cluster in clusters:
+            if len(cluster) > 0:
+                out[offset:(offset + len(cluster))] = np.reshape(np.stack(cluster), (len(cluster),) + out.shape[1:])
+            offset += len(cluster)
+
+        if hints is not None:
+            hints = ClusterBatch.resolve_hints(list(chain.from_iterable(clusters)), hints)
+        return cluster_sizes, additional_obj_info, hints
+
     def _get_clusters(self, element_count, cluster_count=None, data_type='train'):
         """
         Generate some clusters and return them. Format [[obj1cluster1, obj2cluster1, ...], [obj1cluster2, ...]]
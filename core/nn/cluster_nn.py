@@ -1,27 +1,27 @@
-from itertools import chain, combinations
+from itertools import chain
 from random import Random
 from os import path
 from time import time
-import collections
 
 import numpy as np
 
-from sklearn import metrics
-
 from termcolor import colored
 
 from keras.models import Model
 from keras.layers import Input, Activation, Reshape, TimeDistributed
 
+from core.data.batch_prefetcher import BatchPrefetcher
+from core.data.cluster_batch import ClusterBatch
+from core.data.cluster_prediction import ClusterPrediction, TopClusterPrediction
 from core.nn.base_nn import BaseNN
 from core.nn.history import History
-from core.nn.helper import filter_None, AlignedTextTable, np_show_complete_array, get_caller, concat_layer, slice_layer
+from core.nn.helper import filter_None, AlignedTextTable, np_show_complete_array, get_caller, concat_layer, slice_layer, \
+    get_pair_indices, gradient_checkpointed_blocks, use_checkpointed_gradients
 from core.event import Event
-from core.helper import try_makedirs, index_of
+from core.helper import try_makedirs
 
-from core.nn.external.purity import purity_score
 from core.nn.misc.MR import misclassification_rate_BV01
-from core.nn.misc.BBN import BBN
+from core.nn.misc.contingency_metrics import get_default_contingency_metrics, calculate_metrics
 
 class ClusterNN(BaseNN):
     def __init__(self, data_provider, input_count, embedding_nn=None, seed=None, create_metrics_plot=True,
@@ -30,6 +30,7 @@ class ClusterNN(BaseNN):
         super().__init__(
             name='NN_[CLASS]_I{}'.format(input_count) if include_input_count_in_name else 'NN_[CLASS]'
         )
+        self._seed = seed
         self._rand = Random(seed)
         self._data_provider = data_provider
         self._input_count = input_count
@@ -48,6 +49,16 @@ class ClusterNN(BaseNN):
         self._model_prediction = None
         self._model_training = None
 
+        # The models for the two-phase prediction (see predict): The trunk model calculates the input of the assignment
+        # heads and the cluster count; there is a head model for each cluster count. They are only available if the
+        # network registers its assignment trunk and heads.
+        self._model_prediction_trunk = None
+        self._model_prediction_heads = None
+
+        # Gradient checkpoints of the network (see _build_checkpointed_blocks). If there are any, then the optimizer
+        # uses checkpointed_gradients.
+        self._gradient_checkpoint_chains = []
+
         # TBD: Currently ignored
         self._model_discriminator_real = None
         self._model_discriminator_fake = None
@@ -83,6 +94,13 @@ class ClusterNN(BaseNN):
         # The hints input for the network
         self.__nw_clustering_hint = None
 
+        # Does the network use the hints input? True / False: It is declared by the network; None: It is detected while
+        # the network is built (the network uses hints if it calls _get_clustering_hint). If the hints are not used,
+        # then the hints input is not part of the models and no hints have to be generated.
+        self._uses_clustering_hints = None
+        self.__clustering_hint_requested = False
+        self.__hints_input_active = None
+
         # Use hints for the training? (if hints are available; otherwise this setting has no effect)
         self.__use_hints_for_training = use_hints_for_training
 
@@ -93,6 +111,25 @@ class ClusterNN(BaseNN):
         # Is the network already built?
         self._network_built = False
 
+        # Prefetching of training batches in background processes: None => no prefetching is used
+        self._prefetch_count = None
+        self._prefetch_worker_count = 2
+        self.__batch_prefetcher = None
+        self.__prefetch_config = None
+
+        # Reusable buffers for the generated training and validation batches
+        self.__train_batch = None
+        self.__valid_batch = None
+
+        # Use one packed (B, N, *data_shape) input instead of N separate inputs. This is only done if the network
+        # supports it (see _supports_packed_input).
+        self._packed_input = False
+
+        # Use one shared (B, N, k_max) logit tensor for the cluster assignments of all cluster counts: The network has
+        # then only one (B, N, K, k_max) assignment output (see _supports_shared_assignment_head). This requires a
+        # packed input.
+        self._shared_assignment_head = False
+
     @property
     def is_network_built(self):
         return self._network_built
@@ -161,6 +198,71 @@ class ClusterNN(BaseNN):
     def early_stopping_iterations(self, early_stopping_itrs):
         self._early_stopping_itrs = early_stopping_itrs
 
+    @property
+    def prefetch_count(self):
+        return self._prefetch_count
+
+    @prefetch_count.setter
+    def prefetch_count(self, prefetch_count):
+        self._prefetch_count = prefetch_count
+
+    @property
+    def prefetch_worker_count(self):
+        return self._prefetch_worker_count
+
+    @prefetch_worker_count.setter
+    def prefetch_worker_count(self, prefetch_worker_count):
+        self._prefetch_worker_count = prefetch_worker_count
+
+    @property
+    def uses_clustering_hints(self):
+        return self._uses_clustering_hints
+
+    @uses_clustering_hints.setter
+    def uses_clustering_hints(self, uses_clustering_hints):
+        self._uses_clustering_hints = uses_clustering_hints
+
+    @property
+    def hints_input_active(self):
+        """
+        Is the hints input part of the network input? This is only known after the networks are built; before this
+        the input is assumed to be active if it is not declared as unused.
+        """
+        if self.__hints_input_active is not None:
+            return self.__hints_input_active
+        return self._uses_clustering_hints is not False
+
+    @property
+    def packed_input(self):
+        return self._packed_input
+
+    @packed_input.setter
+    def packed_input(self, packed_input):
+        self._packed_input = packed_input
+
+    @property
+    def packed_input_active(self):
+        """
+        Does the network use one packed input (and stacked outputs) instead of one input for each element?
+        """
+        return self._packed_input and self._supports_packed_input()
+
+    @property
+    def shared_assignment_head(self):
+        return self._shared_assignment_head
+
+    @shared_assignment_head.setter
+    def shared_assignment_head(self, shared_assignment_head):
+        self._shared_assignment_head = shared_assignment_head
+
+    @property
+    def shared_assignment_head_active(self):
+        """
+        Does the network use one shared assignment output for all cluster counts (instead of an output for each cluster
+        count)?
+        """
+        return self._shared_assignment_head and self.packed_input_active and self._supports_shared_assignment_head()
+
     @property
     def use_hints_for_training(self):
         return self.__use_hints_for_training
@@ -185,25 +287,17 @@ class ClusterNN(BaseNN):
     def __register_default_evaluation_metrics(self):
 
         # These metrics are described here: http://scikit-learn.org/stable/modules/clustering.html#clustering-performance-evaluation
-        for name, f_metric in [
-            ('adjusted_rand_score', metrics.adjusted_rand_score),
-            ('adjusted_mutual_info_score', metrics.adjusted_mutual_info_score),
-            ('normalized_mutual_info_score', metrics.normalized_mutual_info_score),
-            ('mutual_info_score', metrics.mutual_info_score),
-            ('homogeneity_score', metrics.homogeneity_score),
-            ('completeness_score', metrics.completeness_score),
-            ('v_measure_score', metrics.v_measure_score),
-            ('fowlkes_mallows_score', metrics.fowlkes_mallows_score),
-            ('purity_score', purity_score),
+        # All of them (and also the purity and the BBN metrics) are calculated from contingency tables: They are
+        # implemented in contingency_metrics, which allows to calculate them for a whole batch at once (the values are
+        # equal to the values of the sklearn functions). The un-normalized and the normalized BBN metric use Q=0. The
+        # misclassification rate uses the optimal cluster assignment.
+        for name, f_metric in get_default_contingency_metrics() + [
 
             # BV01 = Beta Version 01
             # The reason for this version number is that this metric may change
             # in future (currently it is (probably) not optiomal and just an upper bound).
-            ('misclassification_rate_BV01', misclassification_rate_BV01),
-
-            # Register the un-normalized and the normalized BBN metric. For both Q=0 is used.
-            ('bbn_q0', lambda y_true, y_pred: BBN(y_true, y_pred, Q=0, normalize=False)),
-            ('bbn_q0_normalized', lambda y_true, y_pred: BBN(y_true, y_pred, Q=0, normalize=True))
+            # It is still calculated to compare the results with older results.
+            ('misclassification_rate_BV01', misclassification_rate_BV01)
         ]:
             self.register_evaluation_metric(name, f_metric)
 
@@ -247,6 +341,25 @@ class ClusterNN(BaseNN):
     def _uses_embedding_layer(self):
         return self._embedding_nn is not None
 
+    def _supports_packed_input(self):
+        """
+        Can the network be built with a packed input? If the packed input is active, then _build_network gets one
+        (B, N, *data_shape) input tensor instead of a list with N inputs. The network output has then to be stacked as
+        well: network_output contains a (B, N, k) softmax output for each cluster count k (in the same order as the
+        cluster counts) and finally the cluster count output.
+        :return: True or False
+        """
+        return False
+
+    def _supports_shared_assignment_head(self):
+        """
+        Can the network use a shared assignment head (only with a packed input)? If it is active, then network_output
+        contains only one (B, N, K, k_max) output with the masked softmax distributions of all cluster counts (see
+        masked_cluster_softmax) and the cluster count output.
+        :return: True or False
+        """
+        return False
+
     def calculate_embeddings(self, x):
 
         # Handle list inputs
@@ -320,6 +433,23 @@ class ClusterNN(BaseNN):
         embedding_model = self._embedding_nn.model
         return embedding_model(layer)
 
+    def _get_packed_embedding(self, layer):
+        """
+        Get the embeddings for a packed (B, N, *data_shape) input. The embedding network is applied once to the whole
+        set (time-distributed). The wrapper layer has the name of the embedding model, therefore the stored weights are
+        compatible with the unpacked network.
+        :param layer: The packed input
+        :return: A (B, N, *embedding_shape) tensor
+        """
+        if self._embedding_nn is None:
+            return layer
+        embedding_model = self._embedding_nn.model
+        return self._s_layer(
+            embedding_model.name,
+            lambda name: TimeDistributed(embedding_model, name=name),
+            format_name=False
+        )(layer)
+
     def _register_plots(self):
         BaseNN._register_plots(self)
         model_name = self._get_name('cluster_nn')
@@ -416,6 +546,22 @@ class ClusterNN(BaseNN):
     def _build_y_data(self, inputs):
         pass
 
+    def _build_y_data_from_cluster_indices(self, cluster_indices, cluster_counts, X=None):
+        """
+        Build the y data for a batch. The default implementation converts the arrays to the input format of
+        _build_y_data; sub-classes may overwrite this method to avoid this conversion.
+        :param cluster_indices: A (B, N) array with the (already shuffled) cluster index of each element
+        :param cluster_counts: A (B,) array with the cluster count of each collection
+        :param X: The X arrays (a list with an (B, *data_shape) array for each element)
+        :return: The y data
+        """
+        n = cluster_indices.shape[1]
+        inputs = [{
+            'cluster_count': int(cluster_counts[c]),
+            'data': [(None if X is None else X[i][c], cluster_indices[c, i]) for i in range(n)]
+        } for c in range(len(cluster_counts))]
+        return self._build_y_data(inputs)
+
     def __build_X_data(self, inputs, ignore_length=False):
         data_shape = self.data_provider.get_data_shape()
         input_count = self._input_count
@@ -429,17 +575,64 @@ class ClusterNN(BaseNN):
             assert len(current_inputs) == input_count
             for i in range(len(current_inputs)):
                 X[i][c] = self._normalize_array_if_required(current_inputs[i][0])
+        if self.packed_input_active:
+            X = [np.stack(X, axis=1)]
 
         # Append hints
-        X.append(self.__hints_to_np_arr(
-            list(map(lambda inp: inp['hints'], inputs)),
-            len(inputs)
-        ))
+        if self.hints_input_active:
+            X.append(self.__hints_to_np_arr(
+                list(map(lambda inp: inp['hints'], inputs)),
+                len(inputs)
+            ))
 
         return X
 
+    def __build_Xy_data_from_batch(self, batch, hints=None):
+        if batch.input_count != self._input_count:
+            print("Error: Invalid input count (expected {}, but got {})".format(self._input_count, batch.input_count))
+
+        batch_size = len(batch)
+        n = batch.input_count
+        shuffle_indices = np.tile(np.arange(n), (batch_size, 1))
+        cluster_indices = np.empty((batch_size, n), dtype=np.int32)
+        X_hints = []
+        if not self.hints_input_active:
+            hints = None
+        for c in range(batch_size):
+
+            # Create a permutation for the cluster indices
+            cluster_permutation = np.arange(batch.cluster_counts[c], dtype=np.int32)
+            self._rand.shuffle(cluster_permutation)
+
+            # Shuffle all inputs
+            self._rand.shuffle(shuffle_indices[c])
+            cluster_indices[c] = cluster_permutation[batch.cluster_indices[c, shuffle_indices[c]]]
+
+            # The hints contain the original element indices: Map them to the shuffled indices
+            if hints is not None and hints[c] is not None:
+                inverse_shuffle_indices = np.argsort(shuffle_indices[c])
+                X_hints.append([inverse_shuffle_indices[hint] for hint in hints[c]])
+            else:
+                X_hints.append([])
+
+        # Gather all elements at once: (B, N, *data_shape)
+        X_data = batch.data[np.arange(batch_size)[:, np.newaxis], shuffle_indices]
+        if self._normalize_network_input:
+            X_data = self._normalize_elements(X_data)
+        X_elements = [X_data[:, i] for i in range(n)]
+        y = self._build_y_data_from_cluster_indices(cluster_indices, batch.cluster_counts, X_elements)
+        X = [X_data] if self.packed_input_active else X_elements
+
+        if self.hints_input_active:
+            X.append(self.__hints_to_np_arr(X_hints, batch_size))
+        return X, y
+
     def _build_Xy_data(self, data, hints=None, ignore_length=False):
 
+        # Batches can be processed without any python lists
+        if isinstance(data, ClusterBatch):
+            return self.__build_Xy_data_from_batch(data, hints)
+
         # Prepare the data:
         # [
         #     {
@@ -471,17 +664,19 @@ class ClusterNN(BaseNN):
                 print("Error: Invalid input count (expected {}, but got {})".format(self._input_count, len(current_inputs)))
 
             # Shuffle all inputs
-            self._rand.shuffle(current_inputs)
+            shuffle_indices = list(range(len(current_inputs)))
+            self._rand.shuffle(shuffle_indices)
+            current_hints_elements = [x[0] for x in current_inputs]
+            current_inputs = [current_inputs[i] for i in shuffle_indices]
 
-            # Generate the hints (if some hints are given)
+            # Generate the hints (if some hints are given): They contain the original element indices, which have to
+            # be mapped to the shuffled indices
             current_hints = []
-            if hints is not None and hints[c] is not None:
-                current_x_inputs = list(map(lambda x: x[0], current_inputs))
-                for hint in hints[c]:
-                    current_hints.append(list(map(
-                        lambda x: index_of(current_x_inputs, x[0]),
-                        hint
-                    )))
+            if hints is not None and hints[c] is not None and self.hints_input_active:
+                inverse_shuffle_indices = np.argsort(shuffle_indices)
+                current_hints = [
+                    inverse_shuffle_indices[hint] for hint in ClusterBatch.resolve_hints(current_hints_elements, hints[c])
+                ]
 
             # That's it for the current cluster collection:)
             inputs.append({
@@ -499,6 +694,8 @@ class ClusterNN(BaseNN):
             builder = lambda name: self._s_layer(name, builder_core)
         else:
             builder = builder_core
+        if self.packed_input_active:
+            return [Input(shape=(self._input_count,) + self.data_provider.get_data_shape(), name='input_packed')]
         return [
             builder('input_{}'.format(i))
             for i in range(self._input_count)
@@ -522,6 +719,14 @@ class ClusterNN(BaseNN):
         # else:
         #     return clusters
 
+    def _get_batch(self, data_type='train', dummy_data=False, cluster_collection_count=None, batch=None):
+        if cluster_collection_count is None:
+            cluster_collection_count = self._minibatch_size
+        return self._data_provider.get_batch(
+            self._input_count, cluster_collection_count, data_type=data_type, dummy_data=dummy_data,
+            cluster_count_f=self._f_cluster_count, batch=batch
+        )
+
     def _get_cluster_counts(self):
         return list(self._data_provider.get_target_cluster_counts())
 
@@ -530,11 +735,70 @@ class ClusterNN(BaseNN):
         arr = arr / (np.std(arr) + 1e-8)
         return arr
 
+    def _normalize_elements(self, arr):
+        # Like _normalize_array, but for each element of an (B, N, *data_shape) array
+        axis = tuple(range(2, arr.ndim))
+        arr = arr - np.mean(arr, axis=axis, keepdims=True)
+        arr = arr / (np.std(arr, axis=axis, keepdims=True) + 1e-8)
+        return arr
+
     def _normalize_array_if_required(self, arr):
         if self._normalize_network_input:
             arr = self._normalize_array(arr)
         return arr
 
+    def _reseed(self, seed):
+        """
+        Reseed the random number generators that are used to generate data (the one of the network and the ones of the
+        data provider). This is done in each prefetch worker. The global random number generators are not changed.
+        :param seed:
+        :return:
+        """
+        self._rand.seed(seed)
+        self._data_provider.reseed(seed)
+
+    def __generate_train_batch(self, dummy_data=False):
+        self.__train_batch = self._get_batch('train', dummy_data=dummy_data, batch=self.__train_batch)
+        return self._build_Xy_data(self.__train_batch, self.__train_batch.hints if self.__use_hints_for_training else None)
+
+    def __get_prefetch_config(self):
+        # The settings that define the generated training batches: If one of them changes, the prefetcher is restarted
+        return (
+            self._prefetch_count, self._prefetch_worker_count, self._minibatch_size, self._f_cluster_count,
+            self.__use_hints_for_training, self._normalize_network_input, self.packed_input_active
+        )
+
+    def __start_prefetching(self):
+        if self.__batch_prefetcher is not None:
+            if self.__prefetch_config == self.__get_prefetch_config():
+                return
+            self.stop_prefetching()
+        if self._prefetch_count is None:
+            return
+
+        # Each start gets a new seed from the network random number generator: The data is reproducible (if the network
+        # has a seed), but a restarted prefetcher does not replay the batches of the previous one
+        seed = self._rand.getrandbits(32)
+        self.__prefetch_config = self.__get_prefetch_config()
+        self.__batch_prefetcher = BatchPrefetcher(
+            self.__generate_train_batch, prefetch_count=self._prefetch_count, worker_count=self._prefetch_worker_count,
+            seed=seed, f_reseed=self._reseed
+        )
+
+        # The first batch defines the layout of the shared memory; it is returned by the first next_batch call
+        self.__batch_prefetcher.start(first_batch=self.__generate_train_batch())
+
+    def stop_prefetching(self):
+        """
+        Stop the prefetch workers (if they are running). The prefetcher is kept alive across train calls, therefore
+        consecutive train calls continue the same batch sequence; it is also stopped if the network is deleted.
+        :return:
+        """
+        if self.__batch_prefetcher is None:
+            return
+        self.__batch_prefetcher.stop()
+        self.__batch_prefetcher = None
+
     def _do_validation(self):
         return (self.__get_last_epoch() + 1) % self._validate_every_nth_epoch == 0
 
@@ -544,17 +808,19 @@ class ClusterNN(BaseNN):
 
         self.event_training_iteration_before.fire(nth=self.__get_last_epoch())
         do_validation = self._do_validation()
-        cluster_counts = self._get_cluster_counts()  #list(self._data_provider.get_cluster_counts())
 
         # Generate training data
         t_start_data_gen_time = time()
-        train_data, _, train_hints = self._get_data('train', dummy_data=dummy_train)
-        X_train, y_train = self._build_Xy_data(train_data, train_hints if self.__use_hints_for_training else None)
+        if self.__batch_prefetcher is not None and not dummy_train:
+            X_train, y_train = self.__batch_prefetcher.next_batch()
+        else:
+            X_train, y_train = self.__generate_train_batch(dummy_data=dummy_train)
 
         # If required: Generate validation data
         if do_validation:
-            valid_data, _, valid_hints = self._get_data('valid', dummy_data=dummy_train, cluster_collection_count=self._validation_data_count)
-            validation_data = self._build_Xy_data(valid_data, valid_hints)
+            self.__valid_batch = self._get_batch('valid', dummy_data=dummy_train, cluster_collection_count=self._validation_data_count, batch=self.__valid_batch)
+            valid_data = self.__valid_batch
+            validation_data = self._build_Xy_data(valid_data, valid_data.hints)
         else:
             valid_data = None
             validation_data = None
@@ -605,10 +871,11 @@ class ClusterNN(BaseNN):
         if do_validation:
             valid_metrics, valid_prediction = self.evaluate_metrics(valid_data, return_prediction=True)
             current_metrics = {metric: [] for metric in valid_metrics[0].keys()}
+            most_probable_cluster_counts = valid_prediction.most_probable_k()
             for c_i in range(len(valid_data)):
 
                 # Get the most probable cluster count
-                most_probable_cluster_count = np.argmax(valid_prediction[c_i]['cluster_count']) + cluster_counts[0]
+                most_probable_cluster_count = most_probable_cluster_counts[c_i]
 
                 # Add all metrics to current_metrics
                 for metric in valid_metrics[c_i].keys():
@@ -717,22 +984,29 @@ class ClusterNN(BaseNN):
     def train(self, iterations=1):
         early_stopped = False
         iterations_done = 0
-        for i in range(iterations):
-
-            # Is early stopping enabled?
-            if self._early_stopping_itrs is not None:
-                history = self._get_history(self._model_training)
-                best_valid_loss_itr = history.get_min_index('val_loss')
-                latest_itr = self.__get_last_epoch()
-                if not (latest_itr is None or best_valid_loss_itr is None):
-                    if latest_itr - best_valid_loss_itr >= self._early_stopping_itrs:
-                        print("Early stopping (after {} iterations without any improvement on the validation data)".format(self._early_stopping_itrs))
-                        early_stopped = True
-                        break
-
-            # Do a training iteration
-            self.__train_iteration()
-            iterations_done += 1
+
+        # If enabled: Generate the training batches in the background (the prefetcher keeps running after this call)
+        self.__start_prefetching()
+        try:
+            for i in range(iterations):
+
+                # Is early stopping enabled?
+                if self._early_stopping_itrs is not None:
+                    history = self._get_history(self._model_training)
+                    best_valid_loss_itr = history.get_min_index('val_loss')
+                    latest_itr = self.__get_last_epoch()
+                    if not (latest_itr is None or best_valid_loss_itr is None):
+                        if latest_itr - best_valid_loss_itr >= self._early_stopping_itrs:
+                            print("Early stopping (after {} iterations without any improvement on the validation data)".format(self._early_stopping_itrs))
+                            early_stopped = True
+                            break
+
+                # Do a training iteration
+                self.__train_iteration()
+                iterations_done += 1
+        except BaseException:
+            self.stop_prefetching()
+            raise
 
         # If required: Fire the early stopped event
         if early_stopped:
@@ -741,6 +1015,10 @@ class ClusterNN(BaseNN):
         return early_stopped
 
     def data_to_cluster_indices(self, data, shuffle_indices=None):
+        if isinstance(data, ClusterBatch):
+            if shuffle_indices is None:
+                return np.copy(data.cluster_indices)
+            return data.cluster_indices[np.arange(len(data))[:, np.newaxis], np.asarray(shuffle_indices)]
         if len(data[0]) > 0 and isinstance(data[0][0], list):
             return list(map(
                 lambda i: self.data_to_cluster_indices(data[i], None if shuffle_indices is None else shuffle_indices[i]),
@@ -764,7 +1042,7 @@ class ClusterNN(BaseNN):
         # TBD: Convert data and call "evaluate_metrics_from_prediction(self, X, cluster_indices, prediction):"
 
         data_X, data_hints, data_idx,  = self._data_provider.convert_data_to_prediction_X(data, shuffle=shuffle_data)
-        prediction = self.predict(data_X, data_hints)
+        prediction = self.predict(data_X, data_hints, compact_result=True)
 
         cluster_indices = self.data_to_cluster_indices(data, data_idx)
         metrics = self.evaluate_metrics_from_prediction(prediction, cluster_indices)
@@ -795,6 +1073,19 @@ class ClusterNN(BaseNN):
         # [[0, 1, 0, ... 2], [1, 2, 0, ...]...]
         # = For the nth element the cluster index
 
+        # Handle compact predictions: The cluster assignments are calculated at once for all collections
+        if isinstance(prediction, ClusterPrediction):
+            cluster_counts = self._get_cluster_counts()
+            cluster_indices = np.asarray(cluster_indices)
+            k_metrics = {
+                k: calculate_metrics(self._evaluation_metrics, cluster_indices, prediction.argmax_assignments(k)) for k in cluster_counts
+            }
+            return [{
+                metric: {
+                    k: k_metrics[k][metric][i] for k in cluster_counts
+                } for metric in self._evaluation_metrics.keys()
+            } for i in range(len(prediction))]
+
         # Handle list inputs
         if isinstance(prediction, list):
             return list(map(
@@ -826,24 +1117,16 @@ class ClusterNN(BaseNN):
             ))
 
             # Calculate all metrics
-            for metric, f_metric in self._evaluation_metrics.items():
-                metrics[metric][cluster_count] = f_metric(cluster_indices, p_cluster_indices)
+            cluster_count_metrics = calculate_metrics(self._evaluation_metrics, np.asarray([cluster_indices]), np.asarray([p_cluster_indices]))
+            for metric in self._evaluation_metrics.keys():
+                metrics[metric][cluster_count] = cluster_count_metrics[metric][0]
 
         return metrics
 
     def __hints_to_np_arr(self, hints, count=1):
-        if hints is None:
-            hints = [None] * count
-        else:
-            count = len(hints)
-        X_hints = [self.__preprocess_hints(c_hints) for c_hints in hints]
-        X_hints = np.asarray(X_hints)
-        return X_hints
-
-    def __preprocess_hints(self, hints):
         """
-        This function preprocesses the hints. It creates an upper similarity matrix out of the hints.
-        The diagonal is not included (it obviously would be everywhere 1).
+        This function preprocesses the hints. It creates an upper similarity matrix out of the hints of each cluster
+        collection. The diagonal is not included (it obviously would be everywhere 1).
 
         The matrix is flattened to an array (assuming there are 4 inputs):
         [
@@ -856,40 +1139,37 @@ class ClusterNN(BaseNN):
         ]
 
         If both elements are in the same cluster, the value is 1, otherwise it is 0.
-        :param batch_size:
-        :param hints:
-        :return:
+        :param hints: A list with the hints for each cluster collection (or None). The hints of a cluster collection
+        are None or a list of element index lists / arrays.
+        :param count: The cluster collection count (only used if hints is None)
+        :return: A (count, n(n-1)/2) array
         """
         n = self.input_count
-        result = np.zeros((n * (n - 1) // 2,), dtype=np.float32)
-        if hints is None:
-            return result
+        if hints is not None:
+            count = len(hints)
+
+        # Each element gets the (1-based) index of its hint; 0 means there is no hint for the element
+        hint_groups = np.zeros((count, n), dtype=np.int32)
+        if hints is not None:
+            for c in range(count):
+                if hints[c] is None or len(hints[c]) == 0:
+                    continue
+                c_hints = [np.asarray(hint, dtype=np.int32).ravel() for hint in hints[c]]
 
-        # Check if some elements occur more than once in the hints
-        dbl_elements = [item for item, count in collections.Counter(list(chain(*hints))).items() if count > 1]
-        if len(dbl_elements) > 0:
-            raise Exception("Some elements are more than once in the hints: {}; Hints: {}".format(dbl_elements, hints))
-
-        # Add all hints (it could be done more efficient by just setting the right index, but it would be more complicated to develop (and to read (and speed doesnt matter here at all)))
-        processes_hints = {source_i:set() for source_i in range(self.input_count)}
-        def add_hint(x, y):
-            min_i = min(x, y)
-            max_i = max(x, y)
-            processes_hints[min_i].add(max_i)
-        for hint in hints:
-            for x, y in combinations(hint, r=2):
-                add_hint(x, y)
-        i = 0
-        for source_i in range(self.input_count):
-            curr_processed_hints = processes_hints[source_i]
-            for target_i in range(source_i + 1, self.input_count):
-                if target_i in curr_processed_hints:
-                    result[i] = 1.
-                i += 1
-        return result
-
-
-    def predict(self, X, hints=None, debug_mode=None, debug_outputs=None):
+                # Check if some elements occur more than once in the hints
+                dbl_elements = np.nonzero(np.bincount(np.concatenate(c_hints), minlength=n) > 1)[0]
+                if len(dbl_elements) > 0:
+                    raise Exception("Some elements are more than once in the hints: {}; Hints: {}".format(dbl_elements.tolist(), hints[c]))
+
+                for i in range(len(c_hints)):
+                    hint_groups[c, c_hints[i]] = i + 1
+
+        # Two elements are in the same cluster if they have the same hint
+        i_source, i_target = get_pair_indices(n, include_self_comparison=False)
+        source_groups = hint_groups[:, i_source]
+        return ((source_groups == hint_groups[:, i_target]) & (source_groups > 0)).astype(np.float32)
+
+    def predict(self, X, hints=None, debug_mode=None, debug_outputs=None, compact_result=False, top_cluster_counts=None):
         # Cases:
         # X is a list of lists or np-arrays -> multiple runs
         # X is a list of np-arrays -> single run
@@ -913,26 +1193,23 @@ class ClusterNN(BaseNN):
         # hint is that 0 and 2 are also in the same cluster. If an element index does not show up in this list, this means
         # it is absolutely nothing known about the position of the input. The network may use these hints, but they also
         # could be ignored (this highly depends on how the network is implemented)
+        #
+        # If compact_result is True, then a ClusterPrediction object is returned instead of the list of dictionaries.
+        # It contains the same values, but as a few arrays (it still supports the indexing of the list format).
+        #
+        # If top_cluster_counts is an integer m, then a two-phase prediction is done: First only the assignment trunk
+        # and the cluster count output are calculated, then only the assignment heads for the m most probable cluster
+        # counts of each collection (see __predict_top_cluster_counts). The result is a TopClusterPrediction object (or
+        # its list format); the debug outputs are not calculated.
         if debug_mode is None:
             debug_mode = self.debug_mode
 
-        X_hints = self.__hints_to_np_arr(hints, len(X))
-
-        data_shape = self.data_provider.get_data_shape()
-        X_preprocessed = [
-            np.zeros((len(X),) + data_shape, dtype=np.float32) for i in range(self._input_count)
-        ]
-        for c in range(len(X)):
-            ci = X[c]
-            if len(ci) != self._input_count:
-                print("len(ci)={}, but self._input_count={}: Unwanted behaviour may occur!".format(len(ci), self._input_count))
-            for i in range(min(len(ci), self._input_count)):
-                X_preprocessed[i][c] = self._normalize_array_if_required(X[c][i])
-
-        # Add the hints input
-        # TODO (this breaks the current interface!); Maybe add a method get_clustering_hints() to get the hints inside
-        # the build neural network function
-        nw_input = X_preprocessed + [X_hints]
+        nw_input = self.__build_prediction_input(X, hints)
+        if top_cluster_counts is not None:
+            result = self.__predict_top_cluster_counts(nw_input, top_cluster_counts)
+            if compact_result:
+                return result
+            return result.to_list()
 
         # obsolete: TODO: Prepare X (use it directly from the data provider)
         prediction = self._model_prediction.predict(nw_input, batch_size=self._minibatch_size)
@@ -1008,46 +1285,131 @@ class ClusterNN(BaseNN):
         #    },
         #    ...
         # ]
+        # The data is stored in a ClusterPrediction object (see ClusterPrediction for more details); this structure is
+        # created out of it if no compact result is required.
 
         cluster_counts = self._get_cluster_counts()
-        k_min = cluster_counts[0]
-
-        result = []
+        additional_prediction_outputs = {
+            self._additional_prediction_outputs[j]['name']: additional_prediction_outputs[j]
+            for j in range(len(self._additional_prediction_outputs))
+        }
+        if self.shared_assignment_head_active:
+
+            # There is one (B, N, K, k_max) output for all cluster counts; the last output contains the cluster distribution
+            result = ClusterPrediction.from_shared_outputs(
+                cluster_counts, prediction_outputs[0], prediction_outputs[-1], additional_prediction_outputs
+            )
+        elif self.packed_input_active:
 
-        # Iterate through each data record of the minibatch
-        for r in range(X_preprocessed[0].shape[0]):
+            # There is a (B, N, k) output for each cluster count; the last output contains the cluster distribution
+            result = ClusterPrediction.from_stacked_outputs(
+                cluster_counts, prediction_outputs[:len(cluster_counts)], prediction_outputs[-1],
+                additional_prediction_outputs
+            )
+        else:
 
-            # Get the cluster distribution
-            cluster_count = prediction_outputs[-1][r] # The latest element contains the cluster distribution
-            elements = []
+            # For each element we get len(cluster_count) distributions; the last output contains the cluster distribution
+            result = ClusterPrediction.from_outputs(
+                cluster_counts, prediction_outputs[:(len(cluster_counts) * self._input_count)], prediction_outputs[-1],
+                additional_prediction_outputs
+            )
 
-            # Go through each input element
-            for i in range(self._input_count):
-                clusters = {}
+        if compact_result:
+            return result
+        return result.to_list()
 
-                # Go through each possible cluster count
-                for k in cluster_counts:
-                    # Index:
-                    # len(cluster_count) * i +  # For each element we get len(cluster_count) distributions
-                    # (k - k_min)               # The index for the cluster k
-                    distribution = prediction_outputs[len(cluster_counts) * i + (k - k_min)][r, 0]
-                    clusters[k] = distribution
+    def __build_prediction_input(self, X, hints=None):
+        """
+        Build the network input for a prediction (see predict for the supported formats of X and hints).
+        """
+        data_shape = self.data_provider.get_data_shape()
+        if isinstance(X, np.ndarray) and X.ndim == len(data_shape) + 2:
+
+            # X is a (B, N, *data_shape) array (e.g. from a ClusterBatch): The inputs are just slices of it
+            if X.shape[1] != self._input_count:
+                print("X.shape[1]={}, but self._input_count={}: Unwanted behaviour may occur!".format(X.shape[1], self._input_count))
+            if self._normalize_network_input:
+                X = self._normalize_elements(X)
+            if self.packed_input_active and X.shape[1] == self._input_count:
+                X_preprocessed = [X]
+            else:
+                X_preprocessed = [
+                    X[:, i] if i < X.shape[1] else np.zeros((len(X),) + data_shape, dtype=np.float32) for i in range(self._input_count)
+                ]
+        else:
+            X_preprocessed = [
+                np.zeros((len(X),) + data_shape, dtype=np.float32) for i in range(self._input_count)
+            ]
+            for c in range(len(X)):
+                ci = X[c]
+                if len(ci) != self._input_count:
+                    print("len(ci)={}, but self._input_count={}: Unwanted behaviour may occur!".format(len(ci), self._input_count))
+                for i in range(min(len(ci), self._input_count)):
+                    X_preprocessed[i][c] = self._normalize_array_if_required(X[c][i])
+        if self.packed_input_active and len(X_preprocessed) > 1:
+            X_preprocessed = [np.stack(X_preprocessed, axis=1)]
 
-                elements.append(clusters)
+        # Add the hints input
+        # TODO (this breaks the current interface!); Maybe add a method get_clustering_hints() to get the hints inside
+        # the build neural network function
+        nw_input = X_preprocessed
+        if self.hints_input_active:
+            nw_input = nw_input + [self.__hints_to_np_arr(hints, len(X))]
+        return nw_input
 
-            # Get all additional prediction outputs
-            current_additional_prediction_outputs = {}
-            for j in range(len(self._additional_prediction_outputs)):
-                additional_prediction_output = self._additional_prediction_outputs[j]
-                current_additional_prediction_outputs[additional_prediction_output['name']] = additional_prediction_outputs[j][r]
+    def __predict_top_cluster_counts(self, nw_input, m=1):
+        """
+        The two-phase prediction: The trunk model calculates the input of the assignment heads and the cluster count
+        distribution; then only the heads of the m most probable cluster counts are evaluated on the cached trunk
+        outputs (the collections are grouped by their candidate cluster counts).
+        :param nw_input: The network input
+        :param m: The amount of cluster counts that are evaluated for each collection
+        :return: A TopClusterPrediction object
+        """
+        if self._model_prediction_trunk is None:
+            raise Exception("The network does not support the two-phase prediction (no assignment trunk is registered)")
+        cluster_counts = self._get_cluster_counts()
+        m = max(1, min(m, len(cluster_counts)))
+
+        outputs = self._model_prediction_trunk.predict(nw_input, batch_size=self._minibatch_size)
+        trunk, cluster_count = outputs[:2]
+        additional_prediction_outputs = {
+            self._additional_prediction_outputs[j]['name']: outputs[2 + j]
+            for j in range(len(self._additional_prediction_outputs))
+        }
+
+        # The candidate indices are sorted by their probability (a stable sort: ties are ordered like np.argmax does)
+        candidates = np.argsort(-cluster_count, axis=1, kind='mergesort')[:, :m]
+        assignments = np.zeros((len(cluster_count), m, self._input_count, max(cluster_counts)), dtype=cluster_count.dtype)
+        for j in range(len(cluster_counts)):
+            k = cluster_counts[j]
+            collections, ranks = np.nonzero(candidates == j)
+            if len(collections) > 0:
+                assignments[collections, ranks, :, :k] = self._model_prediction_heads[k].predict(
+                    trunk[collections], batch_size=self._minibatch_size
+                )
 
-            result.append({
-                'cluster_count': cluster_count,
-                'elements': elements,
-                'additional_outputs': current_additional_prediction_outputs
-            })
+        return TopClusterPrediction(
+            cluster_counts, cluster_count, np.asarray(cluster_counts)[candidates], assignments, additional_prediction_outputs
+        )
 
-        return result
+    def _build_checkpointed_blocks(self, x, block_count, block_f, checkpoint_every_nth_block=None):
+        """
+        Apply some blocks (e.g. residual LSTM layers): x = block_f(i, x) for i in range(block_count). If
+        checkpoint_every_nth_block is set, then only the input of every nth block is stored for the backward pass and
+        all other activations are recomputed (see gradient_checkpointed_blocks). A smaller n stores more block inputs,
+        a larger n keeps more activations of the recomputed segment alive: The peak memory is usually lowest for
+        n ~ sqrt(block_count). The additional time is about one forward pass of the blocks.
+        :param x: The input tensor
+        :param block_count: The amount of blocks
+        :param block_f: block_f(i, x) applies the block i to x; it has to use shared layers (self._s_layer)
+        :param checkpoint_every_nth_block: Store only every nth block input (None: no gradient checkpointing)
+        :return: The output of the last block and the input of the last block
+        """
+        x, second_last, chain = gradient_checkpointed_blocks(x, block_count, block_f, checkpoint_every_nth_block)
+        if chain is not None:
+            self._gradient_checkpoint_chains.append(chain)
+        return x, second_last
 
     def __reset_debug_outputs(self):
         self._prediction_debug_outputs = []
@@ -1075,6 +1437,7 @@ class ClusterNN(BaseNN):
         })
 
     def _get_clustering_hint(self):
+        self.__clustering_hint_requested = True
         return self.__nw_clustering_hint
 
     def _try_get_additional_build_config_value(self, key, default_value=None):
@@ -1096,14 +1459,42 @@ class ClusterNN(BaseNN):
         # Build the prediction model
         nw_input = self.__build_elements_inputs()
         self.__nw_clustering_hint = Input(((self.input_count * (self.input_count - 1)) // 2,))
+        self.__clustering_hint_requested = False
         nw_output = []
         additional_network_outputs = {}
         self.__reset_debug_outputs()
         self.__reset_additional_prediction_outputs()
-        self._build_network(nw_input, nw_output, additional_network_outputs)
+        self._gradient_checkpoint_chains = []
+        if self.packed_input_active:
+            print("Use a packed input")
+            if self.shared_assignment_head_active:
+                print("Use a shared assignment head")
+            self._build_network(nw_input[0], nw_output, additional_network_outputs)
+        else:
+            if self._packed_input:
+                print("The network does not support a packed input: Use one input for each element")
+            self._build_network(nw_input, nw_output, additional_network_outputs)
+
+        # Build the loss network before any model is created: It may also use the hints input
+        if build_training_model:
+
+            # Build the training model (it is based on the prediction model).
+            # This can be quite expensive and is not required if only predictions
+            # are done.
+            loss_output = []
+            self._build_loss_network(nw_output, loss_output, additional_network_outputs)
+
+        # Is the hints input required?
+        if self._uses_clustering_hints is None:
+            self.__hints_input_active = self.__clustering_hint_requested
+        else:
+            self.__hints_input_active = self._uses_clustering_hints
+        print("Hints input is {}".format('active' if self.__hints_input_active else 'not used'))
+        model_input = nw_input + ([self.__nw_clustering_hint] if self.__hints_input_active else [])
+
         self._model_prediction = Model(
             # nw_input, nw_output +
-            nw_input + [self.__nw_clustering_hint], nw_output +
+            model_input, nw_output +
             list(map(lambda a: a['layer'], self._prediction_debug_outputs)) +
             list(map(lambda a: a['layer'], self._additional_prediction_outputs))
         )
@@ -1111,22 +1502,23 @@ class ClusterNN(BaseNN):
             self._model_prediction.summary()
         # self._model_prediction.summary()
 
-        if build_training_model:
+        # Build the models for the two-phase prediction (see predict). They share all weights with the prediction model.
+        self.__build_two_phase_prediction_models(model_input, additional_network_outputs)
 
-            # Build the training model (it is based on the prediction model).
-            # This can be quite expensive and is not required if only predictions
-            # are done.
-            loss_output = []
-            self._build_loss_network(nw_output, loss_output, additional_network_outputs)
-            self._model_training = Model(nw_input + [self.__nw_clustering_hint], loss_output)
+        if build_training_model:
+            self._model_training = Model(model_input, loss_output)
             # self._model_training = Model(nw_input, loss_output)
             if print_summaries:
                 self._model_training.summary()
             # self._model_training.summary()
 
-            # Compile the training model
+            # Compile the training model (if required: recompute the checkpointed blocks in the backward pass)
+            optimizer = self._optimizer
+            if len(self._gradient_checkpoint_chains) > 0:
+                print("Use gradient checkpointing ({} checkpoints)".format(sum(map(len, self._gradient_checkpoint_chains))))
+                optimizer = use_checkpointed_gradients(optimizer, self._gradient_checkpoint_chains)
             self._model_training.compile(
-                optimizer=self._optimizer,
+                optimizer=optimizer,
                 loss=self._get_weighted_keras_loss(),
                 metrics=self._get_keras_metrics()
             )
@@ -1151,6 +1543,23 @@ class ClusterNN(BaseNN):
         # The networks are now built:)
         self._network_built = True
 
+    def __build_two_phase_prediction_models(self, model_input, additional_network_outputs):
+        # The network has to register the input of its assignment heads as 'assignment_trunk' and a dictionary with
+        # a layer for each cluster count as 'assignment_heads' (the heads are applied to the trunk output)
+        self._model_prediction_trunk = None
+        self._model_prediction_heads = None
+        if 'assignment_trunk' not in additional_network_outputs:
+            return
+        trunk = additional_network_outputs['assignment_trunk']
+        self._model_prediction_trunk = Model(
+            model_input, [trunk, additional_network_outputs['cluster_count_output']] +
+            list(map(lambda a: a['layer'], self._additional_prediction_outputs))
+        )
+        self._model_prediction_heads = {}
+        for k, head in additional_network_outputs['assignment_heads'].items():
+            trunk_input = Input(trunk._keras_shape[1:])
+            self._model_prediction_heads[k] = Model(trunk_input, head(trunk_input))
+
     def test_network(self, count=1, output_directory=None, data_type='test', create_date_dir=True, include_metrics=True, shuffle_data=True, data=None,
                      only_store_scores=False, add_alternative_cluster_count_guessing_f=None):
 
@@ -13,6 +13,7 @@ from keras.layers import Lambda, Activation, Concatenate, GaussianNoise, Dense,
 from keras.models import Sequential
 from keras.objectives import kullback_leibler_divergence
 from keras.legacy import interfaces
+from keras import optimizers
 import keras.backend as K
 
 from core.nn.history import History
@@ -189,6 +190,158 @@ def weighted_sum(inputs, weights):
     return res
 
 
+_PAIR_INDICES_CACHE = {}
+
+
+def get_pair_indices(n, include_self_comparison=True):
+    """
+    Get the indices of all compared pairs (the upper triangle of an n x n matrix) in the order that is used for the
+    similarities output: (0, 0), (0, 1), ..., (0, n-1), (1, 1), ... The diagonal is only included if
+    include_self_comparison is True. The indices are cached for each n.
+    :param n: The input count
+    :param include_self_comparison:
+    :return: (i_source, i_target): Two index arrays
+    """
+    key = (n, include_self_comparison)
+    if key not in _PAIR_INDICES_CACHE:
+        i_source, i_target = np.triu_indices(n, k=0 if include_self_comparison else 1)
+        i_source.setflags(write=False)
+        i_target.setflags(write=False)
+        _PAIR_INDICES_CACHE[key] = (i_source, i_target)
+    return _PAIR_INDICES_CACHE[key]
+
+
+def cluster_indices_to_similarities(cluster_indices, include_self_comparison=True):
+    """
+    Convert a (B, N) array with cluster indices to the (B, P) similarities array (1 if both elements of a pair are in the
+    same cluster, otherwise 0).
+    """
+    cluster_indices = np.asarray(cluster_indices)
+    i_source, i_target = get_pair_indices(cluster_indices.shape[1], include_self_comparison)
+    return (cluster_indices[:, i_source] == cluster_indices[:, i_target]).astype(np.float32)
+
+
+def cluster_indices_to_similarities_tensor(cluster_indices, n, include_self_comparison=True):
+    """
+    The same as cluster_indices_to_similarities, but for a (B, N) tensor. The pair targets are built inside the graph,
+    this means only the cluster indices have to be fed.
+    :param n: The input count (it is passed explicitly, because the shape of keras target placeholders is unknown)
+    """
+    i_source, i_target = get_pair_indices(n, include_self_comparison)
+    equal = K.cast(K.equal(K.expand_dims(cluster_indices, 2), K.expand_dims(cluster_indices, 1)), K.floatx())
+    equal = K.reshape(equal, (-1, n * n))
+
+    # K.gather only works for the first axis, therefore the matrix has to be transposed
+    similarities = K.gather(K.transpose(equal), K.constant(i_source * n + i_target, dtype='int32'))
+    return K.transpose(similarities)
+
+
+def pairwise_cluster_similarities_tensor(softmax_dists, cluster_count_dist, n, include_self_comparison=True):
+    """
+    Calculate the predicted similarity of all element pairs: sum_k p(k) * <s_i_k, s_j_k>, where s_i_k is the softmax
+    distribution of the element i (assuming there are k clusters) and p is the cluster count distribution. For each
+    cluster count all dot products are calculated with one batched matrix product S_k * S_k^T. The pairs are ordered
+    like get_pair_indices.
+    :param softmax_dists: A list with a (B, N, k) tensor for each cluster count
+    :param cluster_count_dist: The (B, K) cluster count distribution
+    :param n: The input count
+    :param include_self_comparison: Include the comparisons of the elements with themselves
+    :return: A (B, P) tensor
+    """
+    i_source, i_target = get_pair_indices(n, include_self_comparison)
+
+    # (B, N, N, K) => (N * N, B, K): K.gather only works for the first axis
+    dot_products = K.stack([K.batch_dot(s, s, axes=(2, 2)) for s in softmax_dists], axis=3)
+    dot_products = K.permute_dimensions(K.reshape(dot_products, (-1, n * n, len(softmax_dists))), (1, 0, 2))
+    dot_products = K.gather(dot_products, K.constant(i_source * n + i_target, dtype='int32'))
+
+    # Weight the dot products with the cluster count distribution: (P, B, K) => (B, P)
+    return K.transpose(K.sum(dot_products * K.expand_dims(cluster_count_dist, 0), axis=2))
+
+
+def sample_pairs(cluster_indices, sample_count, include_self_comparison=True, positive_fraction=0.5, rand=np.random):
+    """
+    Sample a fixed amount of pairs for each collection. The sampling is stratified: About positive_fraction of the pairs
+    are positive (both elements are in the same cluster) pairs, the others are negative pairs (if there are no pairs of
+    one type, then only the other type is sampled). Within a stratum the pairs are sampled uniformly (without
+    replacement if the stratum is large enough).
+
+    Each sampled pair gets the weight sample_count * stratum_size / (stratum_sample_count * P), this means the weighted
+    mean over the sampled pairs is an unbiased estimate of the mean over all P pairs. A single pair cannot be
+    stratified: If sample_count is 1, the type of the pair is chosen with the probability of its share of all pairs
+    (this is uniform sampling and the weight is 1).
+    :param cluster_indices: A (B, N) array with the cluster index of each element
+    :param sample_count: The amount of sampled pairs for each collection
+    :param include_self_comparison: Include the pairs of the elements with themselves
+    :param positive_fraction: The target fraction of positive pairs
+    :param rand: The random number generator
+    :return: (i_source, i_target, weights): Three (B, sample_count) arrays
+    """
+    cluster_indices = np.asarray(cluster_indices)
+    i_source, i_target = get_pair_indices(cluster_indices.shape[1], include_self_comparison)
+    pair_count = i_source.shape[0]
+
+    sampled_pairs = np.zeros((cluster_indices.shape[0], sample_count), dtype=np.int32)
+    weights = np.zeros((cluster_indices.shape[0], sample_count), dtype=np.float32)
+    for c in range(cluster_indices.shape[0]):
+        positive = cluster_indices[c, i_source] == cluster_indices[c, i_target]
+        positive_pairs = np.flatnonzero(positive)
+        negative_pairs = np.flatnonzero(~positive)
+
+        # Get the amount of positive and negative samples
+        stratified = True
+        if positive_pairs.shape[0] == 0:
+            positive_count = 0
+        elif negative_pairs.shape[0] == 0:
+            positive_count = sample_count
+        elif sample_count == 1:
+            positive_count = int(rand.uniform() < positive_pairs.shape[0] / pair_count)
+            stratified = False
+        else:
+            positive_count = min(max(int(round(sample_count * positive_fraction)), 1), sample_count - 1)
+
+        offset = 0
+        for pairs, count in [(positive_pairs, positive_count), (negative_pairs, sample_count - positive_count)]:
+            if count == 0:
+                continue
+            sampled_pairs[c, offset:(offset + count)] = rand.choice(pairs, count, replace=count > pairs.shape[0])
+            weights[c, offset:(offset + count)] = sample_count * pairs.shape[0] / (count * pair_count) if stratified else 1.
+            offset += count
+
+    return i_source[sampled_pairs], i_target[sampled_pairs], weights
+
+
+def batch_gather_tensor(x, indices):
+    """
+    Gather elements with different indices for each sample.
+    :param x: A (B, N, ...) tensor
+    :param indices: A (B, S) tensor with indices of the second axis (it is casted to int32)
+    :return: A (B, S, ...) tensor
+    """
+    shape = K.shape(x)
+    indices = K.cast(indices, 'int32')
+
+    # K.gather only works for the first axis, therefore the first two axes are merged
+    offsets = K.expand_dims(K.arange(0, shape[0]) * shape[1], 1)
+    x = K.reshape(x, K.concatenate([K.stack([shape[0] * shape[1]]), shape[2:]], axis=0))
+    result = K.gather(x, K.flatten(indices + offsets))
+    return K.reshape(result, K.concatenate([K.shape(indices), shape[2:]], axis=0))
+
+
+def sampled_pair_similarities_tensor(softmax_dists, cluster_count_dist, i_source, i_target):
+    """
+    Calculate the predicted similarity (see pairwise_cluster_similarities_tensor) only for some sampled pairs.
+    :param softmax_dists: The (B, N, K, k_max) softmax distributions of all cluster counts (the values for the cluster
+    count k are padded with zeros to k_max values)
+    :param cluster_count_dist: The (B, K) cluster count distribution
+    :param i_source: A (B, S) tensor with the first element index of each pair
+    :param i_target: A (B, S) tensor with the second element index of each pair
+    :return: A (B, S) tensor
+    """
+    dot_products = K.sum(batch_gather_tensor(softmax_dists, i_source) * batch_gather_tensor(softmax_dists, i_target), axis=3)
+    return K.sum(dot_products * K.expand_dims(cluster_count_dist, 1), axis=2)
+
+
 def similarity_array_to_similarity_matrix(arr, n, diagonal_default_value=1.):
     # Important: Only the upper half (including the diagonal) of the matrix will be defined
     if arr.shape[1] == n * (n + 1) // 2:
@@ -245,6 +398,70 @@ def reweight_values(inputs, similarity_array, diagonal_default_value=1.):
     return outputs
 
 
+def similarity_array_to_similarity_matrix_tensor(arr, n, diagonal_default_value=1.):
+    """
+    The same as similarity_array_to_similarity_matrix, but the symmetric (B, N, N) matrix is built with one gather
+    (instead of a nested list with a slice for each pair). The lower half is mirrored from the upper half.
+    :param arr: A (B, P) tensor (the second dimension must be known)
+    :param n: The input count
+    :param diagonal_default_value: The diagonal values if arr does not contain the self comparisons
+    :return: A (B, N, N) tensor
+    """
+    if K.int_shape(arr)[1] == n * (n + 1) // 2:
+        include_self_comparison = True
+    elif K.int_shape(arr)[1] == n * (n - 1) // 2:
+        include_self_comparison = False
+    else:
+        raise Exception("Invalid input array size")
+    i_source, i_target = get_pair_indices(n, include_self_comparison)
+
+    # Each matrix entry gets the index of its pair; the missing diagonal points to an additional default value column
+    pair_count = i_source.shape[0]
+    indices = np.full((n, n), pair_count, dtype=np.int32)
+    indices[i_source, i_target] = np.arange(pair_count)
+    indices[i_target, i_source] = np.arange(pair_count)
+    arr = K.concatenate([arr, K.ones_like(arr[:, :1]) * diagonal_default_value], axis=1)
+
+    # K.gather only works for the first axis, therefore the array has to be transposed
+    m = K.transpose(K.gather(K.transpose(arr), K.constant(indices.reshape((-1,)), dtype='int32')))
+    return K.reshape(m, (-1, n, n))
+
+
+def reweight_values_vectorized(inputs, similarity_array, diagonal_default_value=1.):
+    """
+    The same as reweight_values, but all weighted sums are calculated with one batched matrix product:
+    outputs = S * E / rowsum(S)
+    It only uses backend functions, therefore it can be used inside loss functions.
+    :param inputs: A (B, N, D) tensor (or a list of (B, 1, D) tensors)
+    :param similarity_array: A (B, P) tensor with the upper half of the similarity matrix
+    :param diagonal_default_value: The diagonal values if similarity_array does not contain the self comparisons
+    :return: A (B, N, D) tensor
+    """
+    inputs = __stack_elements(inputs)
+    s_m = similarity_array_to_similarity_matrix_tensor(similarity_array, K.int_shape(inputs)[1], diagonal_default_value)
+    return K.batch_dot(s_m, inputs, axes=(2, 1)) / (K.sum(s_m, axis=2, keepdims=True) + K.epsilon())
+
+
+def pairwise_comparisons_tensor(embeddings, comparator_f, n, include_self_comparison=True):
+    """
+    Evaluate comparator_f(e_i, e_j, similar) for all pairs (ordered like get_pair_indices): once assuming that the
+    elements are in the same cluster (similar=1) and once assuming they are not (similar=0). The comparator is called
+    only twice, with (B, P, D) tensors that contain the gathered sources and targets of all pairs.
+    :param embeddings: A (B, N, D) tensor
+    :param comparator_f: A function (x, y, similar) that reduces the last axis, e.g. lukic_kl_divergence
+    :param n: The input count
+    :param include_self_comparison: Include the comparisons of the elements with themselves
+    :return: A (B, 2 * P) tensor: First all comparisons for similar=1, then all for similar=0
+    """
+    i_source, i_target = get_pair_indices(n, include_self_comparison)
+
+    # (B, N, D) => (N, B, D): K.gather only works for the first axis
+    embeddings = K.permute_dimensions(embeddings, (1, 0, 2))
+    e_source = K.permute_dimensions(K.gather(embeddings, K.constant(i_source, dtype='int32')), (1, 0, 2))
+    e_target = K.permute_dimensions(K.gather(embeddings, K.constant(i_target, dtype='int32')), (1, 0, 2))
+    return K.concatenate([comparator_f(e_source, e_target, 1.), comparator_f(e_source, e_target, 0.)], axis=1)
+
+
 def concat_layer(axis=-1, name=None, input_count=None):
     if input_count is None or input_count > 1:
         return Concatenate(axis=axis, name=name)
@@ -316,7 +533,7 @@ def loss_homogeneity_score(y_true, y_pred):
     pass
 
 
-def regularizer_cluster_assignment(softmax_outputs, use_v02_loss=False):
+def regularizer_cluster_assignment(softmax_outputs, use_v02_loss=False, vectorized=False):
     """
     See "ClusterzuordnungsImplikationsregel.docx".
 
@@ -331,8 +548,11 @@ def regularizer_cluster_assignment(softmax_outputs, use_v02_loss=False):
         k_max: [sm_0, sm_1, ...]
     }
     :param softmax_outputs:
+    :param vectorized: Use regularizer_cluster_assignment_vectorized (the result is the same)
     :return:
     """
+    if vectorized:
+        return regularizer_cluster_assignment_vectorized(softmax_outputs, use_v02_loss)
     ks = sorted(list(softmax_outputs.keys()))
     k_min = ks[0]
     k_max = ks[-1]
@@ -393,7 +613,7 @@ def regularizer_cluster_assignment(softmax_outputs, use_v02_loss=False):
     return s
 
 
-def regularizer_cluster_assignment_new(softmax_outputs, use_v02_loss=False):
+def regularizer_cluster_assignment_new(softmax_outputs, use_v02_loss=False, vectorized=False):
     """
     See "ClusterzuordnungsImplikationsregel.docx".
 
@@ -408,8 +628,11 @@ def regularizer_cluster_assignment_new(softmax_outputs, use_v02_loss=False):
         k_max: [sm_0, sm_1, ...]
     }
     :param softmax_outputs:
+    :param vectorized: Use regularizer_cluster_assignment_new_vectorized (the result is the same)
     :return:
     """
+    if vectorized:
+        return regularizer_cluster_assignment_new_vectorized(softmax_outputs, use_v02_loss)
     ks = sorted(list(softmax_outputs.keys()))
     k_min = ks[0]
     k_max = ks[-1]
@@ -469,6 +692,82 @@ def regularizer_cluster_assignment_new(softmax_outputs, use_v02_loss=False):
     # Thats it:)
     return s
 
+
+def __regularizer_cluster_assignment_vectorized(softmax_outputs, use_v02_loss=False, log_loss=False):
+    """
+    A vectorized version of regularizer_cluster_assignment (log_loss=False) and regularizer_cluster_assignment_new
+    (log_loss=True). Instead of a node for each element pair, the dot products of all pairs are calculated with one
+    batched matrix product for each cluster count and then reduced over the upper triangle (without the diagonal).
+
+    The softmax outputs of a cluster count may be a list of (B, 1, k) tensors or a stacked (B, N, k) tensor.
+    """
+    ks = sorted(list(softmax_outputs.keys()))
+    k_min = ks[0]
+    k_max = ks[-1]
+
+    # Stack the softmax outputs: (B, N, k)
+    stacked = [
+        softmax_outputs[k] if not isinstance(softmax_outputs[k], list) else concat(softmax_outputs[k], axis=1)
+        for k in range(k_min, k_max + 1)
+    ]
+    element_count = K.int_shape(stacked[0])[1]
+    upper_triangle = K.constant(np.triu(np.ones((element_count, element_count)), k=1))
+
+    def regularizer(stacked):
+
+        # The result
+        s = 0
+
+        # If there is only one possible cluster count, the V01 code has nothing to do
+        if k_min != k_max:
+
+            # All pairwise dot products for each cluster count: (B, N, N)
+            dot_products = [K.batch_dot(sm, sm, axes=(2, 2)) for sm in stacked]
+            for i in range(k_max - k_min):
+                implication = dot_products[i + 1] * (1 - dot_products[i])
+                if log_loss:
+                    s -= K.sum(K.log(1 - implication + K.epsilon()) * upper_triangle, axis=(1, 2))
+                else:
+                    s += K.sum(implication * upper_triangle, axis=(1, 2))
+            s = K.expand_dims(s, axis=1)
+
+            # Normalize the result
+            if log_loss:
+                s *= 1 / (k_max - k_min)
+            else:
+                s *= 2 / ((k_max - k_min) * element_count * (element_count - 1))
+
+        # See regularizer_cluster_assignment
+        if use_v02_loss:
+            l_m = 0.
+            for sm_k in stacked:
+                l_m += K.mean(K.max(sm_k, axis=1), axis=1)
+            l_m /= k_max - k_min + 1
+            l_m = 1 - l_m
+
+            s += l_m
+
+        return s
+
+    return Lambda(regularizer)(stacked)
+
+
+def regularizer_cluster_assignment_vectorized(softmax_outputs, use_v02_loss=False):
+    """
+    The same as regularizer_cluster_assignment, but with a few batched matrix products instead of a node for each
+    element pair.
+    """
+    return __regularizer_cluster_assignment_vectorized(softmax_outputs, use_v02_loss, log_loss=False)
+
+
+def regularizer_cluster_assignment_new_vectorized(softmax_outputs, use_v02_loss=False):
+    """
+    The same as regularizer_cluster_assignment_new, but with a few batched matrix products instead of a node for each
+    element pair.
+    """
+    return __regularizer_cluster_assignment_vectorized(softmax_outputs, use_v02_loss, log_loss=True)
+
+
 class DynamicGaussianNoise(Layer):
 
     def __init__(self, stddev=1., mean=0., only_execute_for_training=True, **kwargs):
@@ -1016,6 +1315,88 @@ def get_cluster_cohesion(cluster_centers, embeddings, cluster_classification, di
     return avg_distance
 
 
+def __stack_elements(elements):
+    # A list of (B, 1, ...) tensors is stacked to a (B, N, ...) tensor; a tensor is returned as it is
+    if isinstance(elements, list):
+        return concat(elements, axis=1)
+    return elements
+
+
+def pairwise_squared_euclidean_distances(x, y):
+    """
+    Calculate the squared euclidean distances of all vectors of x and y with a batched matrix product.
+    :param x: A (B, M, D) tensor
+    :param y: A (B, L, D) tensor
+    :return: A (B, M, L) tensor
+    """
+    x_sq = K.sum(K.square(x), axis=2, keepdims=True)
+    y_sq = K.permute_dimensions(K.sum(K.square(y), axis=2, keepdims=True), (0, 2, 1))
+    return K.relu(x_sq + y_sq - 2 * K.batch_dot(x, y, axes=(2, 2)))
+
+
+def get_cluster_centers_vectorized(embeddings, cluster_classification):
+    """
+    The same as get_cluster_centers, but the centers are calculated with one batched matrix product:
+    centers = A^T * E / colsum(A)
+    :param embeddings: A (B, N, D) tensor (or a list of (B, 1, D) embeddings)
+    :param cluster_classification: A (B, N, K) tensor (or a list of (B, 1, K) softmaxs)
+    :return: A (B, K, D) tensor with the cluster centers
+    """
+    embeddings = __stack_elements(embeddings)
+    cluster_classification = __stack_elements(cluster_classification)
+
+    def centers(x):
+        e, a = x
+        s = K.batch_dot(K.permute_dimensions(a, (0, 2, 1)), e, axes=(2, 1))
+        c = K.expand_dims(K.sum(a, axis=1), axis=2) + 1e-10
+        return s / c
+    return Lambda(centers)([embeddings, cluster_classification])
+
+
+def get_cluster_separation_vectorized(cluster_centers, cluster_classification, distance_f=pairwise_squared_euclidean_distances):
+    """
+    The same as get_cluster_separation, but for stacked tensors.
+
+    Important: The result has to be negated if it is used inside a loss function.
+
+    :param cluster_centers: A (B, K, D) tensor (see get_cluster_centers_vectorized)
+    :param cluster_classification: A (B, N, K) tensor (or a list of (B, 1, K) softmaxs)
+    :param distance_f: A function that calculates all pairwise distances of a (B, M, D) and a (B, L, D) tensor
+    :return: A (B, 1) tensor
+    """
+    cluster_centers = __stack_elements(cluster_centers)
+    cluster_classification = __stack_elements(cluster_classification)
+
+    def separation(x):
+        centers, a = x
+        element_count = K.int_shape(a)[1]
+        cluster_count = K.int_shape(a)[2]
+        weights = K.sum(a, axis=1)
+        distance_sums = K.sum(distance_f(centers, centers), axis=2)
+        return K.sum(weights * distance_sums, axis=1, keepdims=True) / (element_count * cluster_count)
+    return Lambda(separation)([cluster_centers, cluster_classification])
+
+
+def get_cluster_cohesion_vectorized(cluster_centers, embeddings, cluster_classification, distance_f=pairwise_squared_euclidean_distances):
+    """
+    The same as get_cluster_cohesion, but for stacked tensors.
+    :param cluster_centers: A (B, K, D) tensor (see get_cluster_centers_vectorized)
+    :param embeddings: A (B, N, D) tensor (or a list of (B, 1, D) embeddings)
+    :param cluster_classification: A (B, N, K) tensor (or a list of (B, 1, K) softmaxs)
+    :param distance_f: A function that calculates all pairwise distances of a (B, M, D) and a (B, L, D) tensor
+    :return: A (B, 1) tensor
+    """
+    cluster_centers = __stack_elements(cluster_centers)
+    embeddings = __stack_elements(embeddings)
+    cluster_classification = __stack_elements(cluster_classification)
+
+    def cohesion(x):
+        centers, e, a = x
+        element_count = K.int_shape(e)[1]
+        return K.expand_dims(K.sum(distance_f(e, centers) * a, axis=(1, 2)), axis=1) / element_count
+    return Lambda(cohesion)([cluster_centers, embeddings, cluster_classification])
+
+
 # An implementation of the KL-divergence proposed by Lukic et al. (Learning embeddings for speaker clustering based on voice equality)
 def lukic_kl_divergence(x, y, similar, margin=2.):
     def cost(p, q):
@@ -1137,6 +1518,386 @@ class ExtendedDropout(Layer):
         base_config = super(ExtendedDropout, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
 
+
+def cluster_count_mask(cluster_counts):
+    """
+    Get the mask for a tensor that contains k_max values for each cluster count: For the cluster count k only the first
+    k values are valid.
+    :param cluster_counts: The possible cluster counts
+    :return: A (K, k_max) float32 array with ones for the valid values and zeros for all others
+    """
+    k_max = max(cluster_counts)
+    return np.asarray([[1.] * k + [0.] * (k_max - k) for k in cluster_counts], dtype=np.float32)
+
+
+def masked_cluster_softmax(logits, cluster_counts):
+    """
+    Calculate the softmax distributions of all cluster counts from one shared logit tensor: The distribution for the
+    cluster count k is the softmax of the first k logits.
+    :param logits: A (B, N, k_max) tensor
+    :param cluster_counts: The possible cluster counts
+    :return: A (B, N, K, k_max) tensor; the values that are not part of a distribution are 0
+    """
+    mask = cluster_count_mask(cluster_counts)
+    mask = K.constant(mask.reshape((1, 1) + mask.shape))
+
+    # (B, N, 1, k_max) => (B, N, K, k_max): Each distribution is shifted by its own max. logit
+    logits = K.expand_dims(logits, 2) * mask - (1. - mask) * 1e9
+    e = K.exp(logits - K.max(logits, axis=3, keepdims=True)) * mask
+    return e / K.sum(e, axis=3, keepdims=True)
+
+
+class DifferentiableKMeans(Layer):
+    """
+    A differentiable (soft) k-means for several cluster counts at once. Each iteration recalculates the cluster centers
+    (except the first iteration, it uses the initial centers) and then the soft assignments:
+    p_nj = softmax_j(-(1 + |e_n - c_j|^2)^2)
+    c_j = sum_n p_nj * e_n / (center_epsilon + sum_n p_nj)
+    All point-center distances of all cluster counts are calculated with one broadcast operation per iteration. The
+    centers of all cluster counts are stored in one (B, C, k_max, D) tensor: For the cluster count k only the first k
+    centers are used, the others are masked.
+
+    Inputs: The (B, N, D) points and the (B, C, k_max, D) initial centers (C is the amount of cluster counts)
+    Outputs: The (B, C, N, k_max) assignments (the assignments to the masked centers are 0) and, if return_centers is
+    True, the (B, C, k_max, D) final centers
+    """
+    def __init__(self, cluster_counts, iterations=1, center_epsilon=1e-8, return_centers=False, **kwargs):
+        super(DifferentiableKMeans, self).__init__(**kwargs)
+        assert iterations > 0
+        self.cluster_counts = list(cluster_counts)
+        self.iterations = iterations
+        self.center_epsilon = center_epsilon
+        self.return_centers = return_centers
+
+    def call(self, inputs):
+        points, centers = inputs
+        mask = cluster_count_mask(self.cluster_counts)
+        mask = K.constant(mask.reshape((1, mask.shape[0], 1, mask.shape[1])))
+
+        # (B, N, D) => (B, 1, N, 1, D)
+        points = K.expand_dims(K.expand_dims(points, 1), 3)
+        assignments = None
+        for i in range(self.iterations):
+
+            # Recalculate the cluster centers (if required): (B, C, N, k_max, 1) * (B, 1, N, 1, D) => (B, C, k_max, D)
+            if i > 0:
+                weights = K.expand_dims(assignments, 4)
+                centers = K.sum(weights * points, axis=2) / (self.center_epsilon + K.sum(weights, axis=2))
+
+            # Calculate the distances of all points to all centers: (B, C, N, k_max)
+            distances = K.sum(K.square(points - K.expand_dims(centers, 2)), axis=4)
+
+            # Calculate the softmax only over the valid centers
+            logits = -K.square(1 + distances) * mask - (1. - mask) * 1e9
+            assignments = K.exp(logits - K.max(logits, axis=3, keepdims=True)) * mask
+            assignments = assignments / K.sum(assignments, axis=3, keepdims=True)
+
+        if self.return_centers:
+            return [assignments, centers]
+        return assignments
+
+    def compute_output_shape(self, input_shape):
+        points_shape, centers_shape = input_shape
+        assignments_shape = (points_shape[0], centers_shape[1], points_shape[1], centers_shape[2])
+        if self.return_centers:
+            return [assignments_shape, tuple(centers_shape)]
+        return assignments_shape
+
+    def compute_mask(self, inputs, mask=None):
+        if self.return_centers:
+            return [None, None]
+        return None
+
+    def get_config(self):
+        config = {'cluster_counts': self.cluster_counts,
+                  'iterations': self.iterations,
+                  'center_epsilon': self.center_epsilon,
+                  'return_centers': self.return_centers}
+        base_config = super(DifferentiableKMeans, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def differentiable_kmeans(points, initial_centers, iterations, center_epsilon=1e-8):
+    """
+    Apply DifferentiableKMeans to the outputs of a network with one output for each element.
+    :param points: A list of (B, 1, D) points (or a (B, N, D) tensor)
+    :param initial_centers: A dictionary with a list of k (B, 1, D) initial centers (or a (B, k, D) tensor) for each
+    cluster count k
+    :param iterations: The amount of k-means iterations
+    :param center_epsilon: Avoids zero-divisions for the center calculation
+    :return: Two dictionaries: The (B, 1, k) assignments for each cluster count and point and the (B, k, D) final centers
+    for each cluster count
+    """
+    cluster_counts = sorted(initial_centers.keys())
+    k_max = max(cluster_counts)
+    points = __stack_elements(points)
+    n = K.int_shape(points)[1]
+
+    # Pad the initial centers to k_max centers and stack them to a (B, C, k_max, D) tensor
+    def stack_centers(centers):
+        return K.stack([
+            K.concatenate([c] + [K.zeros_like(c[:, :1])] * (k_max - K.int_shape(c)[1]), axis=1) for c in centers
+        ], axis=1)
+    initial_centers = Lambda(stack_centers)([__stack_elements(initial_centers[k]) for k in cluster_counts])
+
+    assignments, centers = DifferentiableKMeans(
+        cluster_counts, iterations=iterations, center_epsilon=center_epsilon, return_centers=True
+    )([points, initial_centers])
+    return {
+        k: [Lambda(lambda x, i_k=i_k, k=k, i=i: x[:, i_k, i:(i + 1), :k])(assignments) for i in range(n)]
+        for i_k, k in enumerate(cluster_counts)
+    }, {
+        k: Lambda(lambda x, i_k=i_k, k=k: x[:, i_k, :k])(centers) for i_k, k in enumerate(cluster_counts)
+    }
+
+
+def gradient_checkpointed_blocks(x, block_count, block_f, checkpoint_every_nth_block=None):
+    """
+    Apply some blocks (e.g. residual LSTM layers) to x: x = block_f(i, x) for i in range(block_count).
+
+    If checkpoint_every_nth_block is set, then only the input of every nth block is stored for the backward pass: The
+    gradient does not flow through the checkpoints (they are stop_gradient tensors), therefore the activations inside
+    a segment are not kept alive. The gradients must then be calculated with checkpointed_gradients, it recomputes the
+    segments block by block in the backward pass (block_f is just called again, so block_f must reuse its layers).
+    :param x: The input tensor
+    :param block_count: The amount of blocks
+    :param block_f: block_f(i, x) applies the block i to x
+    :param checkpoint_every_nth_block: Store only every nth block input (None: no gradient checkpointing)
+    :return: The output of the last block, the input of the last block and the checkpoint chain (a list of
+    {'tensor': checkpoint, 'recompute_f': f} dicts; f recomputes the stop_gradient input of the checkpoint from the
+    previous checkpoint; the first entry is the input x). The chain is None if no checkpoints are used.
+    """
+    def apply_blocks(x, i_start, i_end):
+        for i in range(i_start, i_end):
+            x = block_f(i, x)
+        return x
+
+    chain = [{'tensor': x, 'recompute_f': None}]
+    i_segment_start = 0
+    second_last = None
+    for i in range(block_count):
+        if checkpoint_every_nth_block is not None and i > 0 and i % checkpoint_every_nth_block == 0:
+            x = Lambda(K.stop_gradient)(x)
+            chain.append({
+                'tensor': x,
+                'recompute_f': lambda x, i_start=i_segment_start, i_end=i: apply_blocks(x, i_start, i_end)
+            })
+            i_segment_start = i
+        second_last = x
+        x = block_f(i, x)
+    return x, second_last, (chain if len(chain) > 1 else None)
+
+
+def checkpointed_gradients(loss, params, checkpoint_chains):
+    """
+    Calculate the gradients of the loss for a network that uses gradient checkpoints (see
+    gradient_checkpointed_blocks). At first the gradients of all parameters and checkpoints are calculated without the
+    checkpointed segments. Then the segments are recomputed from the last to the first one and the gradients are
+    backpropagated through each segment. The recomputation depends on the incoming gradient, therefore the activations
+    of only one segment are alive at once.
+    :param loss: The loss tensor
+    :param params: The parameters
+    :param checkpoint_chains: A list of checkpoint chains
+    :return: The gradients of all parameters (None if a parameter is not connected to the loss)
+    """
+    import tensorflow as tf
+
+    def add(x, y):
+        if x is None:
+            return y
+        if y is None:
+            return x
+        return tf.add_n([tf.convert_to_tensor(x), tf.convert_to_tensor(y)])
+
+    checkpoints = [c['tensor'] for chain in checkpoint_chains for c in chain[1:]]
+    gradients = tf.gradients(loss, list(params) + checkpoints, colocate_gradients_with_ops=True)
+    param_gradients = gradients[:len(params)]
+    checkpoint_gradients = dict(zip(checkpoints, gradients[len(params):]))
+
+    for chain in checkpoint_chains:
+        input_gradient = None
+        for i in reversed(range(1, len(chain))):
+            gradient = checkpoint_gradients[chain[i]['tensor']]
+            if gradient is None:
+                continue
+
+            # Recompute the segment (after the gradient is available) and backpropagate the gradient through it. The
+            # segment input is cut off, otherwise the gradient would also flow into the network before the chain
+            # (this part is backpropagated once with input_gradient)
+            with tf.control_dependencies([gradient]):
+                segment_input = tf.stop_gradient(chain[i - 1]['tensor'])
+            segment_output = chain[i]['recompute_f'](segment_input)
+            gradients = tf.gradients(
+                segment_output, [segment_input] + list(params), grad_ys=gradient, colocate_gradients_with_ops=True
+            )
+            param_gradients = [add(x, y) for x, y in zip(param_gradients, gradients[1:])]
+            if i > 1:
+                checkpoint_gradients[chain[i - 1]['tensor']] = add(checkpoint_gradients[chain[i - 1]['tensor']], gradients[0])
+            else:
+                input_gradient = gradients[0]
+
+        # Backpropagate the gradient of the first segment to the network that computes the input of the chain
+        if input_gradient is not None:
+            gradients = tf.gradients(chain[0]['tensor'], list(params), grad_ys=input_gradient, colocate_gradients_with_ops=True)
+            param_gradients = [add(x, y) for x, y in zip(param_gradients, gradients)]
+
+    return param_gradients
+
+
+def use_checkpointed_gradients(optimizer, checkpoint_chains):
+    """
+    Make a keras optimizer use checkpointed_gradients instead of K.gradients. The gradient clipping works as usual.
+    :param optimizer: The optimizer (an instance or a name)
+    :param checkpoint_chains: A list of checkpoint chains
+    :return: The optimizer instance
+    """
+    optimizer = optimizers.get(optimizer)
+
+    def get_gradients(loss, params):
+        grads = checkpointed_gradients(loss, params, checkpoint_chains)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. '
+                             'Please make sure that all of your ops have a '
+                             'gradient defined (i.e. are differentiable).')
+        if hasattr(optimizer, 'clipnorm') and optimizer.clipnorm > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [optimizers.clip_norm(g, optimizer.clipnorm, norm) for g in grads]
+        if hasattr(optimizer, 'clipvalue') and optimizer.clipvalue > 0:
+            grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) for g in grads]
+        return grads
+    optimizer.get_gradients = get_gradients
+    return optimizer
+
+
+class LayerNormalization(Layer):
+    """
+    See: https://arxiv.org/pdf/1607.06450.pdf
+
+    Normalizes each feature vector (the last axis) to zero mean and unit variance and applies a learned scale and shift.
+    In contrast to the batch normalization the result does not depend on the other samples of the batch or on the
+    other elements of the set.
+    """
+    def __init__(self, epsilon=1e-6, **kwargs):
+        super(LayerNormalization, self).__init__(**kwargs)
+        self.epsilon = epsilon
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        self.gamma = self.add_weight(name='gamma', shape=(input_shape[-1],), initializer='ones', trainable=True)
+        self.beta = self.add_weight(name='beta', shape=(input_shape[-1],), initializer='zeros', trainable=True)
+        super(LayerNormalization, self).build(input_shape)
+
+    def call(self, inputs):
+        mean = K.mean(inputs, axis=-1, keepdims=True)
+        variance = K.mean(K.square(inputs - mean), axis=-1, keepdims=True)
+        return (inputs - mean) / K.sqrt(variance + self.epsilon) * self.gamma + self.beta
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = {'epsilon': self.epsilon}
+        base_config = super(LayerNormalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class MultiHeadAttention(Layer):
+    """
+    See: https://arxiv.org/pdf/1706.03762.pdf
+
+    Scaled dot-product attention with several heads. All queries attend to all keys at once (there is no sequential
+    dependency like in a recurrent layer) and the result does not depend on the order of the keys.
+
+    Inputs: The (B, N_q, D_q) queries and the (B, N_kv, D_kv) keys / values (for a self-attention both are the same
+    tensor)
+    Outputs: The (B, N_q, units) attention results
+    """
+    def __init__(self, units, heads=4, **kwargs):
+        super(MultiHeadAttention, self).__init__(**kwargs)
+        if units % heads != 0:
+            raise ValueError("The units ({}) must be a multiple of the heads ({})".format(units, heads))
+        self.units = units
+        self.heads = heads
+
+    def build(self, input_shape):
+        query_shape, key_value_shape = input_shape
+        self.query_kernel = self.add_weight(name='query_kernel', shape=(query_shape[-1], self.units), initializer='glorot_uniform')
+        self.key_kernel = self.add_weight(name='key_kernel', shape=(key_value_shape[-1], self.units), initializer='glorot_uniform')
+        self.value_kernel = self.add_weight(name='value_kernel', shape=(key_value_shape[-1], self.units), initializer='glorot_uniform')
+        self.output_kernel = self.add_weight(name='output_kernel', shape=(self.units, self.units), initializer='glorot_uniform')
+        self.output_bias = self.add_weight(name='output_bias', shape=(self.units,), initializer='zeros')
+        super(MultiHeadAttention, self).build(input_shape)
+
+    def call(self, inputs):
+        queries, keys_values = inputs
+        head_units = self.units // self.heads
+
+        # (B, N, D) => (B * heads, N, units / heads)
+        def split_heads(x):
+            shape = K.shape(x)
+            x = K.reshape(x, (shape[0], shape[1], self.heads, head_units))
+            return K.reshape(K.permute_dimensions(x, (0, 2, 1, 3)), (shape[0] * self.heads, shape[1], head_units))
+        q = split_heads(K.dot(queries, self.query_kernel))
+        k = split_heads(K.dot(keys_values, self.key_kernel))
+        v = split_heads(K.dot(keys_values, self.value_kernel))
+
+        # (B * heads, N_q, N_kv) attention weights
+        attention = K.softmax(K.batch_dot(q, k, axes=[2, 2]) / np.sqrt(head_units))
+        result = K.batch_dot(attention, v, axes=[2, 1])
+
+        # (B * heads, N_q, units / heads) => (B, N_q, units)
+        shape = K.shape(queries)
+        result = K.reshape(result, (shape[0], self.heads, shape[1], head_units))
+        result = K.reshape(K.permute_dimensions(result, (0, 2, 1, 3)), (shape[0], shape[1], self.units))
+        return K.dot(result, self.output_kernel) + self.output_bias
+
+    def compute_output_shape(self, input_shape):
+        query_shape = input_shape[0]
+        return (query_shape[0], query_shape[1], self.units)
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def get_config(self):
+        config = {'units': self.units,
+                  'heads': self.heads}
+        base_config = super(MultiHeadAttention, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class InducingPoints(Layer):
+    """
+    See: https://arxiv.org/pdf/1810.00825.pdf
+
+    A set of trainable points that is the same for all samples. The input is only used to get the batch size.
+
+    Inputs: Any tensor with the batch size on the first axis
+    Outputs: The (B, count, units) inducing points
+    """
+    def __init__(self, count, units, **kwargs):
+        super(InducingPoints, self).__init__(**kwargs)
+        self.count = count
+        self.units = units
+
+    def build(self, input_shape):
+        self.points = self.add_weight(name='points', shape=(self.count, self.units), initializer='glorot_uniform')
+        super(InducingPoints, self).build(input_shape)
+
+    def call(self, inputs):
+        return K.tile(K.expand_dims(self.points, 0), K.stack([K.shape(inputs)[0], 1, 1]))
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.count, self.units)
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def get_config(self):
+        config = {'count': self.count,
+                  'units': self.units}
+        base_config = super(InducingPoints, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
 if __name__ == '__main__':
     from random import random
     from time import time
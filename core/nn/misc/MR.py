@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 from scipy.stats import entropy
 # See:
 # - Learning embeddings for speaker clustering based on voice equality
@@ -184,7 +185,52 @@ def misclassification_rate_BV01(y_true, y_pred):
     MR = sum_e_j / y_true.shape[0]
     return MR
 
-misclassification_rate = misclassification_rate_BV01
+def misclassification_rate_exact(y_true, y_pred):
+    """
+    The exact misclassification rate: Each true cluster is assigned to at most one predicted cluster (and vice versa),
+    such that the amount of correctly assigned elements is maximal. The optimal assignment is calculated with the
+    hungarian method on the contingency matrix. The result is always smaller or equal to misclassification_rate_BV01.
+
+    :param y_true:
+    :param y_pred:
+    :return:
+    """
+    return misclassification_rate_exact_batch(y_true, [y_pred])[0]
+
+
+def misclassification_rate_exact_batch(y_true, y_preds):
+    """
+    Calculate the exact misclassification rate for many clusterings of the same elements (e.g. for all thresholds of a
+    hierarchical clustering). The ground truth is encoded only once.
+
+    :param y_true: The true labels (N values)
+    :param y_preds: The predicted labels of each clustering (B x N values)
+    :return: A (B,) array with the misclassification rates
+    """
+    _, true_codes = np.unique(np.asarray(y_true), return_inverse=True)
+    true_codes = true_codes.ravel()
+    n = true_codes.shape[0]
+    R = int(np.max(true_codes)) + 1 if n > 0 else 0
+
+    result = np.zeros((len(y_preds),), dtype=np.float64)
+    for i in range(len(y_preds)):
+        y_pred = np.asarray(y_preds[i])
+        assert y_pred.shape[0] == n
+        if n == 0:
+            continue
+        _, pred_codes = np.unique(y_pred, return_inverse=True)
+        pred_codes = pred_codes.ravel()
+        C = int(np.max(pred_codes)) + 1
+
+        # Build the contingency matrix and find the assignment with the maximum amount of shared elements
+        contingency = np.bincount(true_codes * C + pred_codes, minlength=R * C).reshape((R, C))
+        row_ind, col_ind = linear_sum_assignment(-contingency)
+        result[i] = 1. - np.sum(contingency[row_ind, col_ind]) / n
+    return result
+
+
+# The BV01 version is still available to compare results with older results
+misclassification_rate = misclassification_rate_exact
 
 if __name__ == '__main__':
     def flt_eq(x, y):
@@ -218,6 +264,15 @@ if __name__ == '__main__':
     y_pred = [0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
     assert flt_eq(misclassification_rate_BV01(y_true, y_pred), 5 / 13)
 
+    y_true = [0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0, 1]
+    y_pred = [0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1]
+    assert flt_eq(misclassification_rate_exact(y_true, y_pred), 5 / 13)
+
+    # The heuristic of BV01 is not optimal for this clustering
+    y_true = [0, 0, 0, 0, 1, 2, 2, 2, 3, 3, 4, 2, 2, 2, 2, 3, 1, 1, 1, 1]
+    y_pred = [0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2]
+    assert misclassification_rate_exact(y_true, y_pred) <= misclassification_rate_BV01(y_true, y_pred)
+
     # # This test-case shows that the implementation could be improved
     # y_true = [0, 0, 0, 0, 1, 2, 2, 2, 3, 3, 4, 2, 2, 2, 2, 3, 1, 1, 1, 1]
     # y_pred = [0, 0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 2, 2]
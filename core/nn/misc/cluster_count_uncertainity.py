@@ -53,13 +53,10 @@ def measure_cluster_count_uncertainity(network, nw_input, nw_hints=None, n_runs=
             # 1) Permute the inputs
             nw_input[0] = nw_input[0][p]
 
-            # 2) Permute the hints
+            # 2) Permute the hints (they contain element indices)
             if nw_hints[0] is not None:
-                from_to = list(range(n))[p]
-                nw_hints[0] = [list(map(
-                    lambda hint: tuple(map(lambda i: from_to[i], hint)),
-                    nw_hints[0]
-                ))]
+                inverse_p = np.argsort(p)
+                nw_hints[0] = [inverse_p[np.asarray(hint, dtype=np.int32)] for hint in nw_hints[0]]
 
         results.append(network.predict(nw_input, hints=nw_hints)[0])
 
@@ -0,0 +1,314 @@
+from inspect import signature
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.special import gammaln
+from sklearn import metrics
+
+# This file implements clustering metrics that are calculated from contingency tables. The tables of many clusterings
+# (e.g. all cluster collections of a validation batch) are built at once with a single bincount, and all metrics are
+# calculated from the same tables. The results are the same as the results of the sklearn metrics (and of purity_score
+# and BBN).
+
+
+def _get_sklearn_average_method(f_metric, legacy_average_method):
+    # Older versions of sklearn do not have the average_method parameter (or the default value is 'warn'): Use the same
+    # normalization as these versions
+    try:
+        average_method = signature(f_metric).parameters['average_method'].default
+    except (KeyError, ValueError, TypeError):
+        average_method = None
+    if average_method is None or average_method == 'warn':
+        average_method = legacy_average_method
+    return average_method
+
+
+def _generalized_average(u, v, average_method):
+    if average_method == 'min':
+        return np.minimum(u, v)
+    elif average_method == 'geometric':
+        return np.sqrt(u * v)
+    elif average_method == 'arithmetic':
+        return (u + v) / 2.
+    elif average_method == 'max':
+        return np.maximum(u, v)
+    raise Exception("Invalid average method: {}".format(average_method))
+
+
+def _comb2(n):
+    return n * (n - 1) / 2.
+
+
+def _entropy(counts, n):
+    # counts: (B, X); n: (B,)
+    p = counts / n[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.sum(np.where(counts > 0, p * np.log(np.where(counts > 0, p, 1.)), 0.), axis=1)
+
+
+class ContingencyTables:
+    """
+    The contingency tables of B clusterings. All values are calculated lazily and cached.
+    - table: A (B, R, C) array: table[b, i, j] is the amount of elements of the b-th clustering with the true label i and
+      the predicted label j (labels that do not occur just produce empty rows / columns)
+    - n: A (B,) array with the element counts
+    - true_counts: A (B, R) array with the row sums
+    - pred_counts: A (B, C) array with the column sums
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.true_counts = np.sum(table, axis=2)
+        self.pred_counts = np.sum(table, axis=1)
+        self.n = np.sum(self.true_counts, axis=1)
+        self.__cache = {}
+
+    @staticmethod
+    def from_labels(y_true, y_pred):
+        """
+        Build the contingency tables for many clusterings at once.
+        :param y_true: A (B, N) array with the true labels (non-negative integers)
+        :param y_pred: A (B, N) array with the predicted labels (non-negative integers)
+        :return: The contingency tables
+        """
+        y_true = np.asarray(y_true, dtype=np.int64)
+        y_pred = np.asarray(y_pred, dtype=np.int64)
+        if y_true.ndim == 1:
+            y_true = y_true[np.newaxis]
+            y_pred = y_pred[np.newaxis]
+        if y_true.shape != y_pred.shape:
+            raise Exception("The true and predicted labels must have the same shape (got {} and {})".format(y_true.shape, y_pred.shape))
+        batch_size = y_true.shape[0]
+        if y_true.size == 0:
+            return ContingencyTables(np.zeros((batch_size, 0, 0)))
+        R = int(np.max(y_true)) + 1
+        C = int(np.max(y_pred)) + 1
+
+        # Each (clustering, true label, predicted label) combination gets its own code
+        codes = (np.arange(batch_size)[:, np.newaxis] * R + y_true) * C + y_pred
+        table = np.bincount(codes.ravel(), minlength=batch_size * R * C).reshape((batch_size, R, C))
+        return ContingencyTables(table.astype(np.float64))
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def __cached(self, key, f):
+        if key not in self.__cache:
+            self.__cache[key] = f()
+        return self.__cache[key]
+
+    @property
+    def true_cluster_count(self):
+        return self.__cached('true_cluster_count', lambda: np.sum(self.true_counts > 0, axis=1))
+
+    @property
+    def pred_cluster_count(self):
+        return self.__cached('pred_cluster_count', lambda: np.sum(self.pred_counts > 0, axis=1))
+
+    @property
+    def h_true(self):
+        return self.__cached('h_true', lambda: _entropy(self.true_counts, self.n))
+
+    @property
+    def h_pred(self):
+        return self.__cached('h_pred', lambda: _entropy(self.pred_counts, self.n))
+
+    @property
+    def mutual_info(self):
+        def calculate():
+            t = self.table
+            outer = self.true_counts[:, :, np.newaxis] * self.pred_counts[:, np.newaxis, :]
+            n = self.n[:, np.newaxis, np.newaxis]
+            nz = t > 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mi = np.where(nz, (t / n) * (np.log(np.where(nz, t, 1.)) - np.log(n) - np.log(np.where(nz, outer, 1.)) + 2 * np.log(n)), 0.)
+            mi = np.where(np.abs(mi) < np.finfo(mi.dtype).eps, 0., mi)
+            mi = np.clip(np.sum(mi, axis=(1, 2)), 0., None)
+
+            # A labelling with only one cluster has zero entropy, therefore the mutual information is 0
+            mi[(self.true_cluster_count <= 1) | (self.pred_cluster_count <= 1)] = 0.
+            return mi
+        return self.__cached('mutual_info', calculate)
+
+    @property
+    def expected_mutual_info(self):
+        return self.__cached('expected_mutual_info', lambda: np.asarray([
+            self.__expected_mutual_info(b) for b in range(len(self))
+        ], dtype=np.float64))
+
+    def __expected_mutual_info(self, b):
+        # The same calculation as sklearn.metrics.cluster.expected_mutual_information, but vectorized over all
+        # (row, column, n_ij) combinations
+        N = self.n[b]
+        a = self.true_counts[b][self.true_counts[b] > 0][:, np.newaxis, np.newaxis]
+        c = self.pred_counts[b][self.pred_counts[b] > 0][np.newaxis, :, np.newaxis]
+        if a.size <= 1 or c.size <= 1:
+            return 0.
+        nij = np.arange(1, int(max(np.max(a), np.max(c))) + 1, dtype=np.float64)[np.newaxis, np.newaxis, :]
+        valid = (nij >= np.maximum(1, a + c - N)) & (nij <= np.minimum(a, c))
+
+        # Invalid combinations get some dummy values (they are masked anyway)
+        gln = gammaln(a + 1) + gammaln(c + 1) + gammaln(N - a + 1) + gammaln(N - c + 1) - gammaln(N + 1) - gammaln(nij + 1) \
+            - gammaln(np.where(valid, a - nij, 0) + 1) - gammaln(np.where(valid, c - nij, 0) + 1) \
+            - gammaln(np.where(valid, N - a - c + nij, 0) + 1)
+        terms = (nij / N) * (np.log(N) + np.log(nij) - np.log(a) - np.log(c)) * np.exp(gln)
+        return np.sum(np.where(valid, terms, 0.))
+
+    @property
+    def pair_counts(self):
+        """
+        :return: (sum of C(n_ij, 2), sum of C(a_i, 2), sum of C(b_j, 2))
+        """
+        return self.__cached('pair_counts', lambda: (
+            np.sum(_comb2(self.table), axis=(1, 2)),
+            np.sum(_comb2(self.true_counts), axis=1),
+            np.sum(_comb2(self.pred_counts), axis=1)
+        ))
+
+    def adjusted_rand_score(self):
+        sum_comb, sum_comb_true, sum_comb_pred = self.pair_counts
+        n_pairs = _comb2(self.n)
+        tp = sum_comb
+        fp = sum_comb_pred - sum_comb
+        fn = sum_comb_true - sum_comb
+        tn = n_pairs - tp - fp - fn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ari = 2. * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+        # Special cases: empty data or full agreement
+        return np.where((fn == 0) & (fp == 0), 1., ari)
+
+    def mutual_info_score(self):
+        return self.mutual_info
+
+    def normalized_mutual_info_score(self, average_method=None):
+        if average_method is None:
+            average_method = _get_sklearn_average_method(metrics.normalized_mutual_info_score, 'geometric')
+        normalizer = np.maximum(_generalized_average(self.h_true, self.h_pred, average_method), 1e-10)
+        nmi = np.where(self.mutual_info == 0, 0., self.mutual_info / normalizer)
+        return np.where(self.__single_cluster_special_case(), 1., nmi)
+
+    def adjusted_mutual_info_score(self, average_method=None):
+        if average_method is None:
+            average_method = _get_sklearn_average_method(metrics.adjusted_mutual_info_score, 'max')
+        emi = self.expected_mutual_info
+        denominator = _generalized_average(self.h_true, self.h_pred, average_method) - emi
+        eps = np.finfo(np.float64).eps
+        denominator = np.where(denominator < 0, np.minimum(denominator, -eps), np.maximum(denominator, eps))
+        numerator = self.mutual_info - emi
+        numerator = np.where(numerator < 0, np.minimum(numerator, -eps), np.maximum(numerator, eps))
+        ami = numerator / denominator
+
+        # If there is only one class or one cluster, the score is 0 (if there is only one of both, it is 1)
+        ami = np.where((self.true_cluster_count <= 1) | (self.pred_cluster_count <= 1), 0., ami)
+        return np.where(self.__single_cluster_special_case(), 1., ami)
+
+    def __single_cluster_special_case(self):
+        return (self.true_cluster_count == self.pred_cluster_count) & (self.true_cluster_count <= 1)
+
+    def homogeneity_score(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.h_true == 0, 1., self.mutual_info / self.h_true)
+
+    def completeness_score(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.h_pred == 0, 1., self.mutual_info / self.h_pred)
+
+    def v_measure_score(self, beta=1.):
+        homogeneity = self.homogeneity_score()
+        completeness = self.completeness_score()
+        s = beta * homogeneity + completeness
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(s == 0, 0., (1 + beta) * homogeneity * completeness / s)
+
+    def fowlkes_mallows_score(self):
+        tk = np.sum(self.table ** 2, axis=(1, 2)) - self.n
+        pk = np.sum(self.true_counts ** 2, axis=1) - self.n
+        qk = np.sum(self.pred_counts ** 2, axis=1) - self.n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(tk == 0, 0., np.sqrt(tk / pk) * np.sqrt(tk / qk))
+
+    def purity_score(self):
+        # Each predicted cluster is assigned to its most frequent true label
+        return np.sum(np.max(self.table, axis=1), axis=1) / self.n
+
+    def misclassification_rate(self):
+        # The exact misclassification rate (see MR.misclassification_rate_exact): The true clusters are assigned to the
+        # predicted clusters such that the amount of correctly assigned elements is maximal
+        result = np.zeros((len(self),), dtype=np.float64)
+        for b in range(len(self)):
+            if self.n[b] == 0:
+                continue
+            row_ind, col_ind = linear_sum_assignment(-self.table[b])
+            result[b] = 1. - np.sum(self.table[b][row_ind, col_ind]) / self.n[b]
+        return result
+
+    def bbn(self, Q=0., normalize=False):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.sum(np.where(self.pred_counts[:, np.newaxis, :] > 0, self.table ** 2 / self.pred_counts[:, np.newaxis, :], 0.), axis=(1, 2))
+        s -= Q * self.pred_cluster_count
+        if normalize:
+
+            # The maximum value is reached if the predicted clusters are equal to the true clusters
+            max_v = self.n - Q * self.true_cluster_count
+            return [None if max_v[b] == 0 else s[b] / max_v[b] for b in range(len(self))]
+        return s
+
+
+class ContingencyMetric:
+    """
+    A clustering metric that is calculated from contingency tables. It can be used like any other metric function
+    (f(y_true, y_pred)), but it is also possible to calculate it for many clusterings at once with shared contingency
+    tables (see calculate_metrics).
+    """
+
+    def __init__(self, f_tables):
+        """
+        :param f_tables: A function that gets a ContingencyTables object and returns a value for each table.
+        """
+        self.f_tables = f_tables
+
+    def __call__(self, y_true, y_pred):
+        return self.f_tables(ContingencyTables.from_labels([y_true], [y_pred]))[0]
+
+
+def get_default_contingency_metrics():
+    """
+    Get the contingency table based versions of the default evaluation metrics of ClusterNN.
+    :return: A list of (name, metric) tuples
+    """
+    return [
+        ('adjusted_rand_score', ContingencyMetric(lambda t: t.adjusted_rand_score())),
+        ('adjusted_mutual_info_score', ContingencyMetric(lambda t: t.adjusted_mutual_info_score())),
+        ('normalized_mutual_info_score', ContingencyMetric(lambda t: t.normalized_mutual_info_score())),
+        ('mutual_info_score', ContingencyMetric(lambda t: t.mutual_info_score())),
+        ('homogeneity_score', ContingencyMetric(lambda t: t.homogeneity_score())),
+        ('completeness_score', ContingencyMetric(lambda t: t.completeness_score())),
+        ('v_measure_score', ContingencyMetric(lambda t: t.v_measure_score())),
+        ('fowlkes_mallows_score', ContingencyMetric(lambda t: t.fowlkes_mallows_score())),
+        ('purity_score', ContingencyMetric(lambda t: t.purity_score())),
+        ('misclassification_rate', ContingencyMetric(lambda t: t.misclassification_rate())),
+        ('bbn_q0', ContingencyMetric(lambda t: t.bbn(Q=0, normalize=False))),
+        ('bbn_q0_normalized', ContingencyMetric(lambda t: t.bbn(Q=0, normalize=True))),
+    ]
+
+
+def calculate_metrics(evaluation_metrics, y_true, y_pred):
+    """
+    Calculate many metrics for many clusterings. All contingency table based metrics share the same tables; all other
+    metrics are called for each clustering.
+    :param evaluation_metrics: A dictionary: name => metric (a ContingencyMetric or a function f(y_true, y_pred))
+    :param y_true: A (B, N) array with the true labels
+    :param y_pred: A (B, N) array with the predicted labels
+    :return: A dictionary: name => list with the value for each clustering
+    """
+    tables = None
+    result = {}
+    for name, f_metric in evaluation_metrics.items():
+        if isinstance(f_metric, ContingencyMetric):
+            if tables is None:
+                tables = ContingencyTables.from_labels(y_true, y_pred)
+            result[name] = list(f_metric.f_tables(tables))
+        else:
+            result[name] = [f_metric(y_true[b], y_pred[b]) for b in range(len(y_true))]
+    return result
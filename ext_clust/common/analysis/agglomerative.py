@@ -0,0 +1,276 @@
+import tracemalloc
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import cdist, pdist
+
+SUPPORTED_METRICS = ('cosine', 'euclidean')
+SUPPORTED_METHODS = ('single', 'complete', 'average', 'weighted', 'ward')
+SUPPORTED_BACKENDS = ('auto', 'condensed', 'embeddings', 'scipy')
+
+
+def condensed_distances(embeddings, metric='cosine', dtype=np.float32, block_size=None):
+    """
+    Calculates the condensed distance vector (like scipy.spatial.distance.pdist), but block by block and stored with
+    the given dtype. Therefore no full (n, n) matrix and no float64 copy of the condensed vector is ever allocated.
+
+    :param embeddings: The (n, d) embeddings
+    :param metric: The metric (see scipy.spatial.distance.cdist)
+    :param dtype: The dtype of the condensed vector
+    :param block_size: The amount of rows that are calculated at once (default: about 2^20 distances)
+    :return: The condensed distance vector (n * (n - 1) / 2 values)
+    """
+    x = np.asarray(embeddings, dtype=np.float64)
+    n = x.shape[0]
+    if block_size is None:
+        block_size = max(1, 2 ** 20 // max(1, n))
+    distances = np.empty((n * (n - 1) // 2,), dtype=dtype)
+    offset = 0
+    for i0 in range(0, n - 1, block_size):
+        i1 = min(i0 + block_size, n - 1)
+        block = cdist(x[i0:i1], x[i0:], metric)
+        for i in range(i0, i1):
+            row = block[i - i0, (i - i0 + 1):]
+            distances[offset:(offset + row.shape[0])] = row
+            offset += row.shape[0]
+    return distances
+
+
+def _lance_williams(method, d_xi, d_yi, d_xy, size_x, size_y, size_i):
+    """
+    Calculates the distances of the clusters i to the merged cluster x + y.
+    """
+    if method == 'single':
+        return np.minimum(d_xi, d_yi)
+    if method == 'complete':
+        return np.maximum(d_xi, d_yi)
+    if method == 'average':
+        return (size_x * d_xi + size_y * d_yi) / (size_x + size_y)
+    if method == 'weighted':
+        return 0.5 * (d_xi + d_yi)
+    if method == 'ward':
+        t = 1. / (size_x + size_y + size_i)
+        return np.sqrt(np.maximum(
+            (size_x + size_i) * t * d_xi * d_xi + (size_y + size_i) * t * d_yi * d_yi - size_i * t * d_xy * d_xy, 0.
+        ))
+    raise ValueError("Unsupported linkage method: {}".format(method))
+
+
+def _label_merges(merges, n):
+    """
+    Sorts the merges by their distance and converts the slot indices to the cluster indices of a linkage matrix (this
+    is the same as in scipy's nearest-neighbor-chain implementation).
+    """
+    merges = merges[np.argsort(merges[:, 2], kind='mergesort')]
+    parent = np.arange(2 * n - 1)
+    size = np.ones((2 * n - 1,), dtype=np.int64)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for i in range(n - 1):
+        x = find(int(merges[i, 0]))
+        y = find(int(merges[i, 1]))
+        merges[i, 0] = min(x, y)
+        merges[i, 1] = max(x, y)
+        parent[x] = n + i
+        parent[y] = n + i
+        size[n + i] = size[x] + size[y]
+        merges[i, 3] = size[n + i]
+    return merges
+
+
+def _nn_chain(n, get_distances, merge):
+    """
+    The nearest-neighbor-chain algorithm. Each cluster is stored in a slot; the merged cluster reuses the slot of the
+    second cluster.
+
+    :param n: The amount of elements
+    :param get_distances: A function (x, slots) => the distances of the cluster x to the clusters in the given slots
+    :param merge: A function (x, y, d_xy, slots) that is called before the cluster x is merged into the cluster y
+    (slots contains the other active clusters)
+    :return: The linkage matrix
+    """
+    merges = np.empty((n - 1, 4), dtype=np.float64)
+    active = np.ones((n,), dtype=bool)
+    size = np.ones((n,), dtype=np.int64)
+    chain = []
+    for k in range(n - 1):
+        if len(chain) == 0:
+            chain.append(int(np.argmax(active)))
+
+        while True:
+            x = chain[-1]
+            active[x] = False
+            slots = np.flatnonzero(active)
+            active[x] = True
+            distances = get_distances(x, slots)
+            j = int(np.argmin(distances))
+            y = int(slots[j])
+            d_xy = distances[j]
+
+            # Prefer the previous chain element (otherwise the chain could cycle on ties)
+            if len(chain) > 1:
+                d_prev = get_distances(x, np.asarray([chain[-2]]))[0]
+                if d_prev <= d_xy:
+                    y = chain[-2]
+                    d_xy = d_prev
+                    break
+            chain.append(y)
+
+        chain = chain[:-2]
+        x, y = min(x, y), max(x, y)
+        merges[k] = (x, y, d_xy, size[x] + size[y])
+
+        active[x] = False
+        active[y] = False
+        merge(x, y, d_xy, np.flatnonzero(active))
+        active[y] = True
+        size[y] += size[x]
+
+    return _label_merges(merges, n)
+
+
+def condensed_linkage(distances, n, method='complete'):
+    """
+    Calculates the linkage matrix out of a condensed distance vector with the nearest-neighbor-chain algorithm. The
+    distances are updated in place (Lance-Williams) and keep their dtype, so a float32 vector needs half the memory
+    of scipy's linkage (which always works on a float64 copy).
+
+    :param distances: The condensed distance vector (is overwritten)
+    :param n: The amount of elements
+    :param method: The linkage method (single, complete, average, weighted or ward)
+    :return: The linkage matrix
+    """
+    if method not in SUPPORTED_METHODS:
+        raise ValueError("Unsupported linkage method: {}".format(method))
+    if distances.shape[0] != n * (n - 1) // 2:
+        raise ValueError('The condensed distance vector does not match the amount of elements')
+    if n < 2:
+        return np.empty((0, 4), dtype=np.float64)
+
+    # The condensed index of (i, j) with i < j is row_offsets[i] + j
+    i = np.arange(n, dtype=np.int64)
+    row_offsets = n * i - i * (i + 1) // 2 - i - 1
+    size = np.ones((n,), dtype=np.float64)
+
+    def indices(x, slots):
+        return np.where(slots < x, row_offsets[slots] + x, row_offsets[x] + slots)
+
+    def get_distances(x, slots):
+        return distances[indices(x, slots)].astype(np.float64)
+
+    def merge(x, y, d_xy, slots):
+        if slots.shape[0] > 0:
+            y_indices = indices(y, slots)
+            distances[y_indices] = _lance_williams(
+                method, get_distances(x, slots), distances[y_indices].astype(np.float64), d_xy, size[x], size[y],
+                size[slots]
+            )
+        size[y] += size[x]
+
+    return _nn_chain(n, get_distances, merge)
+
+
+def ward_linkage(embeddings):
+    """
+    Calculates the ward linkage matrix (euclidean metric) directly on the embeddings with the nearest-neighbor-chain
+    algorithm. The ward distance of two clusters only depends on their sizes and centroids, therefore only O(n * d)
+    memory is required (no distance matrix).
+
+    :param embeddings: The (n, d) embeddings
+    :return: The linkage matrix
+    """
+    centroids = np.array(embeddings, dtype=np.float64)
+    n = centroids.shape[0]
+    if n < 2:
+        return np.empty((0, 4), dtype=np.float64)
+    size = np.ones((n,), dtype=np.float64)
+
+    def get_distances(x, slots):
+        delta = centroids[slots] - centroids[x]
+        return np.sqrt(2. * size[slots] * size[x] / (size[slots] + size[x]) * np.sum(delta * delta, axis=1))
+
+    def merge(x, y, d_xy, slots):
+        centroids[y] = (size[x] * centroids[x] + size[y] * centroids[y]) / (size[x] + size[y])
+        size[y] += size[x]
+
+    return _nn_chain(n, get_distances, merge)
+
+
+def agglomerative_linkage(embeddings, metric='cosine', method='complete', backend='auto', dtype=np.float32,
+                          max_distance_memory=2 ** 30, keep_distances=False, trace_memory=False):
+    """
+    Calculates the linkage matrix of the embeddings. The result is the same as
+    scipy.cluster.hierarchy.linkage(embeddings, method, metric) (up to the precision of the distances), but the memory
+    stays bounded. The ward method is only defined for euclidean distances: With the cosine metric it is calculated on
+    the normalized embeddings (their euclidean distance is sqrt(2 * cosine distance)).
+    - condensed: The distances are stored in a condensed vector with the given dtype (n * (n - 1) / 2 values)
+    - embeddings: The clustering works directly on the embeddings (only for the ward method)
+    - scipy: scipy's linkage on the float64 condensed vector (reference)
+    - auto: condensed, except for the ward method if the condensed vector would need more than max_distance_memory
+      bytes (the embeddings backend needs less memory, but is slower)
+
+    :param embeddings: The (n, d) embeddings
+    :param metric: cosine or euclidean
+    :param method: single, complete, average, weighted or ward
+    :param backend: auto, condensed, embeddings or scipy
+    :param dtype: The dtype of the condensed distance vector
+    :param max_distance_memory: The memory limit for the condensed vector of the auto backend (in bytes)
+    :param keep_distances: Return the condensed distances (the condensed backend then needs a second vector, because
+    the linkage overwrites the distances)
+    :param trace_memory: Measure the peak memory (with tracemalloc). It is relative to the traced memory before the
+    call; if tracing was already started before and the previous peak is not exceeded, then it is an upper bound.
+    :return: The condensed distances (None if they are not kept or for the embeddings backend), the linkage matrix and
+    the peak memory in bytes (None if it is not measured)
+    """
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError("Unsupported metric: {}".format(metric))
+    if method not in SUPPORTED_METHODS:
+        raise ValueError("Unsupported linkage method: {}".format(method))
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError("Unsupported backend: {}".format(backend))
+    embeddings = np.asarray(embeddings)
+    n = embeddings.shape[0]
+    if backend == 'auto':
+        distance_memory = n * (n - 1) // 2 * np.dtype(dtype).itemsize
+        backend = 'embeddings' if method == 'ward' and distance_memory > max_distance_memory else 'condensed'
+    if backend == 'embeddings' and method != 'ward':
+        raise ValueError('The embeddings backend only supports the ward method')
+
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if trace_memory:
+
+        # tracemalloc.reset_peak requires Python 3.9: The peak is measured relative to the current traced memory (if
+        # tracing was started here, then the peak is exact)
+        base_memory = tracemalloc.get_traced_memory()[0]
+
+    if method == 'ward' and metric == 'cosine':
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+        metric = 'euclidean'
+    if backend == 'embeddings':
+        distances = None
+        embeddings_linkage = ward_linkage(embeddings)
+    elif backend == 'condensed':
+        distances = condensed_distances(embeddings, metric, dtype=dtype)
+        embeddings_linkage = condensed_linkage(distances.copy() if keep_distances else distances, n, method)
+    else:
+        distances = pdist(embeddings, metric)
+        embeddings_linkage = linkage(distances, method)
+    if not keep_distances:
+        distances = None
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] - base_memory
+        if started_tracing:
+            tracemalloc.stop()
+
+    return distances, embeddings_linkage, peak_memory
@@ -1,10 +1,11 @@
 import matplotlib.pyplot as plt
-from scipy.cluster.hierarchy import fcluster, linkage, dendrogram
-from scipy.spatial.distance import cdist
+from scipy.cluster.hierarchy import fcluster, dendrogram, is_monotonic
 from sklearn.metrics import *
 import numpy as np
 
-from ext_clust.common.analysis.mr import misclassification_rate
+from ext_clust.common.analysis.agglomerative import agglomerative_linkage
+from ext_clust.common.analysis.mr import misclassification_rate_exact_batch
+from ext_clust.common.analysis.sweep import sweep_linkage
 from ext_clust.common.utils.logger import *
 from ext_clust.common.utils.paths import *
 from ext_clust.common.utils.pickler import load, save
@@ -181,20 +182,28 @@ def add_cluster_subplot(fig, position, title):
     return subplot
 
 
-def cluster_embeddings(embeddings, metric='cosine', method='complete'):
+def cluster_embeddings(embeddings, metric='cosine', method='complete', backend='auto', keep_distances=False,
+                       trace_memory=False):
     """
-    Calculates the distance and the linkage matrix for these embeddings.
+    Calculates the distance and the linkage matrix for these embeddings. The linkage is calculated on the condensed
+    distance vector (float32) or directly on the embeddings, see agglomerative.agglomerative_linkage.
 
     :param embeddings: The embeddings we want to calculate on
-    :param metric: The metric used for the distance and linkage
-    :param method: The linkage method used.
-    :return: The embedding Distance and the embedding linkage
+    :param metric: The metric used for the distance and linkage (cosine or euclidean)
+    :param method: The linkage method used (complete, average, ward, ...)
+    :param backend: The clustering backend (auto, condensed, embeddings or scipy)
+    :param keep_distances: Return the condensed embedding distances (otherwise None is returned)
+    :param trace_memory: Log the peak memory of the clustering
+    :return: The (condensed) embedding distance and the embedding linkage
     """
     logger = get_logger('analysis', logging.INFO)
     logger.info('Cluster embeddings')
 
-    embeddings_distance = cdist(embeddings, embeddings, metric)
-    embeddings_linkage = linkage(embeddings_distance, method, metric)
+    embeddings_distance, embeddings_linkage, peak_memory = agglomerative_linkage(
+        embeddings, metric, method, backend=backend, keep_distances=keep_distances, trace_memory=trace_memory
+    )
+    if peak_memory is not None:
+        logger.info('Clustering peak memory: {:.1f} MiB'.format(peak_memory / 2 ** 20))
 
     return embeddings_distance, embeddings_linkage
 
@@ -213,20 +222,33 @@ def calculate_analysis_values(embeddings_linkage, true_clusters):
     thresholds = embeddings_linkage[:, 2]
     threshold_shape = thresholds.shape
 
+    # For monotonic linkages (e.g. single, complete, average or ward) all scores are calculated in one pass over the
+    # merges. fcluster(threshold) contains all merges with a height <= threshold, therefore equal heights are resolved
+    # to the last merge with this height.
+    if len(thresholds) > 0 and is_monotonic(embeddings_linkage):
+        mrs, homogeneity_scores, completeness_scores = sweep_linkage(embeddings_linkage, true_clusters)
+        last_merge = np.searchsorted(thresholds, thresholds, side='right') - 1
+        return mrs[last_merge], homogeneity_scores[last_merge], completeness_scores[last_merge], thresholds
+
     # Initialize output
     mrs = np.ones(threshold_shape)
     homogeneity_scores = np.ones(threshold_shape)
     completeness_scores = np.ones(threshold_shape)
 
     # Loop over all possible clustering
+    set_of_predicted_clusters = []
     for i, threshold in enumerate(thresholds):
         predicted_clusters = fcluster(embeddings_linkage, threshold, 'distance')
+        set_of_predicted_clusters.append(predicted_clusters)
 
         # Calculate different analysis's
-        mrs[i] = misclassification_rate(true_clusters, predicted_clusters)
         homogeneity_scores[i] = homogeneity_score(true_clusters, predicted_clusters)
         completeness_scores[i] = completeness_score(true_clusters, predicted_clusters)
 
+    # The MR is calculated for all clusterings at once
+    if len(set_of_predicted_clusters) > 0:
+        mrs[:] = misclassification_rate_exact_batch(true_clusters, set_of_predicted_clusters)
+
     return mrs, homogeneity_scores, completeness_scores, thresholds
 
 
@@ -0,0 +1,129 @@
+import heapq
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def _xlogx(x):
+    x = np.asarray(x, dtype=np.float64)
+    return np.where(x > 0, x * np.log(np.where(x > 0, x, 1.)), 0.)
+
+
+def sweep_linkage(embeddings_linkage, true_clusters):
+    """
+    Replays the merges of a linkage matrix and calculates the misclassification rate, the homogeneity score and the
+    completeness score after each merge. Instead of recomputing the flat clustering for each step, the contingency table
+    (predicted clusters x true clusters) is updated incrementally: Each merge adds one row to another row.
+
+    The misclassification rate is the exact one (optimal one-to-one assignment, see
+    mr.misclassification_rate_exact). Each true cluster can always use its largest pure cluster, therefore only the
+    clusters that contain elements of more than one true cluster (and only if they contain more elements of a true
+    cluster than its largest pure cluster) are part of the assignment problem; it stays small.
+
+    :param embeddings_linkage: The linkage matrix (n-1 merges)
+    :param true_clusters: The true clusters (n values)
+    :return: misclassification rates, homogeneity scores, completeness scores (arrays with a value for each merge)
+    """
+    Z = np.asarray(embeddings_linkage)
+    _, true_codes = np.unique(np.asarray(true_clusters), return_inverse=True)
+    true_codes = true_codes.ravel()
+    n = true_codes.shape[0]
+    if Z.shape[0] != n - 1:
+        raise ValueError('The linkage matrix does not match the number of true clusters')
+    n_true = int(np.max(true_codes)) + 1
+
+    # Each cluster is stored in a slot (a row of the table). The leaves use their own slot; a merged cluster reuses the
+    # slot of its first child (this is a union-find structure where all elements of a cluster point to the slot).
+    slot = np.empty((2 * n - 1,), dtype=np.int64)
+    slot[:n] = np.arange(n)
+    table = np.zeros((n, n_true), dtype=np.int32)
+    table[np.arange(n), true_codes] = 1
+    sizes = np.ones((n,), dtype=np.int64)
+    classes_per_slot = np.ones((n,), dtype=np.int64)
+    alive = np.ones((n,), dtype=bool)
+
+    # The clusters that contain more than one true cluster
+    mixed_slots = set()
+
+    # For each true cluster a heap with its pure clusters (entries may be outdated and are validated lazily)
+    pure_heaps = [[] for c in range(n_true)]
+    for i in range(n):
+        pure_heaps[true_codes[i]].append((-1, i))
+
+    def best_pure_size(c):
+        heap = pure_heaps[c]
+        while len(heap) > 0:
+            size, s = heap[0]
+            if alive[s] and classes_per_slot[s] == 1 and sizes[s] == -size and table[s, c] > 0:
+                return -size
+            heapq.heappop(heap)
+        return 0
+
+    def matched_elements():
+        best_pure = np.asarray([best_pure_size(c) for c in range(n_true)], dtype=np.int64)
+        matched = np.sum(best_pure)
+        if len(mixed_slots) == 0:
+            return matched
+
+        # Each true cluster may use its largest pure cluster. A mixed cluster is only better if it contains more
+        # elements of the true cluster: Only this gain has to be maximized
+        mixed = table[np.fromiter(mixed_slots, dtype=np.int64, count=len(mixed_slots))].astype(np.int64)
+        gain = np.maximum(mixed - best_pure[np.newaxis, :], 0)
+        gain = gain[np.any(gain > 0, axis=1)][:, np.any(gain > 0, axis=0)]
+        if gain.size == 0:
+            return matched
+
+        # If the best mixed cluster of each true cluster is a different one, then this is the optimal assignment
+        best_rows = np.argmax(gain, axis=0)
+        if len(np.unique(best_rows)) == len(best_rows):
+            return matched + np.sum(gain[best_rows, np.arange(gain.shape[1])])
+
+        # Otherwise solve the assignment problem
+        row_ind, col_ind = linear_sum_assignment(-gain)
+        return matched + np.sum(gain[row_ind, col_ind])
+
+    # The mutual information is calculated out of some sums that can be updated after each merge:
+    # S = sum(n_kc * log(n_kc)), T = sum(n_k * log(n_k)), A = sum(n_c * log(n_c))
+    A = np.sum(_xlogx(np.bincount(true_codes, minlength=n_true)))
+    S = 0.
+    T = 0.
+    log_n = np.log(n)
+    h_true = log_n - A / n
+
+    mrs = np.ones((n - 1,))
+    homogeneity_scores = np.ones((n - 1,))
+    completeness_scores = np.ones((n - 1,))
+    for i in range(n - 1):
+        sa = slot[int(Z[i, 0])]
+        sb = slot[int(Z[i, 1])]
+        x = table[sa]
+        y = table[sb]
+        shared = np.nonzero((x > 0) & (y > 0))[0]
+        S += np.sum(_xlogx(x[shared] + y[shared]) - _xlogx(x[shared]) - _xlogx(y[shared]))
+        T += float(_xlogx(sizes[sa] + sizes[sb]) - _xlogx(sizes[sa]) - _xlogx(sizes[sb]))
+
+        # Merge the table rows
+        table[sa] += y
+        table[sb] = 0
+        sizes[sa] += sizes[sb]
+        sizes[sb] = 0
+        alive[sb] = False
+        slot[n + i] = sa
+        classes_per_slot[sa] = np.count_nonzero(table[sa])
+        classes_per_slot[sb] = 0
+        mixed_slots.discard(sb)
+        if classes_per_slot[sa] > 1:
+            mixed_slots.add(sa)
+        else:
+            c = int(np.argmax(table[sa]))
+            heapq.heappush(pure_heaps[c], (-int(sizes[sa]), int(sa)))
+
+        # Calculate the scores
+        n_pred = n - 1 - i
+        mutual_info = max(0., (S - T - A) / n + log_n)
+        h_pred = log_n - T / n
+        homogeneity_scores[i] = 1. if n_true == 1 else mutual_info / h_true
+        completeness_scores[i] = 1. if n_pred == 1 else mutual_info / h_pred
+        mrs[i] = 1. - matched_elements() / n
+
+    return mrs, homogeneity_scores, completeness_scores
@@ -95,6 +95,10 @@ class AudioDataProvider(ImageDataProvider):
             min_element_count_per_cluster=minimum_snippets_per_cluster if isinstance(minimum_snippets_per_cluster, int) else len(minimum_snippets_per_cluster)
         )
 
+    def reseed(self, seed):
+        super().reseed(seed)
+        self.__rand.seed(seed)
+
     def set_split_mode(self, data_type, mode=None):
         if mode is not None:
             # Currently, there is only one valid mode; maybe in futture there will be more different modes
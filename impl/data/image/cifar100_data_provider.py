@@ -8,7 +8,7 @@ from impl.data.image.image_data_provider import ImageDataProvider
 class Cifar100DataProvider(ImageDataProvider):
     def __init__(self, train_classes=None, validate_classes=None, test_classes=None,
                  min_cluster_count=None, max_cluster_count=None, min_element_count_per_cluster=1,
-                 additional_augmentor=None, old_style_auto_split=True):
+                 additional_augmentor=None, old_style_auto_split=True, image_store_dir=None):
         if old_style_auto_split and (train_classes is None and validate_classes is None and test_classes is None):
             rand = Random()
             rand.seed(1337)
@@ -20,12 +20,16 @@ class Cifar100DataProvider(ImageDataProvider):
             test_classes = classes[train_classes_count:]
         super().__init__(train_classes, validate_classes, test_classes, min_cluster_count, max_cluster_count,
                          center_data=True, random_mirror_images=True, min_element_count_per_cluster=min_element_count_per_cluster,
-                         additional_augmentor=additional_augmentor)
+                         additional_augmentor=additional_augmentor,
+                         image_store_dir=image_store_dir)
 
     def _get_img_data_shape(self):
         return (32, 32, 3)
 
     def _load_data(self):
+        return self._load_class_grouped_data('cifar100', self.__load_records, ['datasets/cifar-100-python.tar.gz'])
+
+    def __load_records(self):
 
         # Load all records
         (x_train, y_train), (x_test, y_test) = cifar100.load_data()
@@ -37,10 +41,5 @@ class Cifar100DataProvider(ImageDataProvider):
         # Reshape x for tensorflow
         x = x.reshape((x.shape[0],) + self.get_data_shape())
 
-        # Normalize x to [-1, 1]
-        x = self._scale_data(x)
-        # x = x.astype(np.float32) / 255
-
-        # Split the records by classes and store it
         y = y.reshape((y.shape[0],))
-        return {i: x[y == i] for i in np.unique(y)}
+        return x, y
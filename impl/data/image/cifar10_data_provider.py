@@ -5,14 +5,18 @@ from impl.data.image.image_data_provider import ImageDataProvider
 
 class Cifar10DataProvider(ImageDataProvider):
     def __init__(self, train_classes=[0, 2, 3, 4, 6, 7], validate_classes=[1, 5, 8, 9], test_classes=[1, 5, 8, 9],
-                 min_cluster_count=None, max_cluster_count=None, min_element_count_per_cluster=1):
+                 min_cluster_count=None, max_cluster_count=None, min_element_count_per_cluster=1, image_store_dir=None):
         super().__init__(train_classes, validate_classes, test_classes, min_cluster_count, max_cluster_count,
-                         center_data=True, random_mirror_images=True, min_element_count_per_cluster=min_element_count_per_cluster)
+                         center_data=True, random_mirror_images=True, min_element_count_per_cluster=min_element_count_per_cluster,
+                         image_store_dir=image_store_dir)
 
     def _get_img_data_shape(self):
         return (32, 32, 3)
 
     def _load_data(self):
+        return self._load_class_grouped_data('cifar10', self.__load_records, ['datasets/cifar-10-batches-py.tar.gz'])
+
+    def __load_records(self):
 
         # Load all records
         (x_train, y_train), (x_test, y_test) = cifar10.load_data()
@@ -24,10 +28,5 @@ class Cifar10DataProvider(ImageDataProvider):
         # Reshape x for tensorflow
         x = x.reshape((x.shape[0],) + self.get_data_shape())
 
-        # Normalize x to [-1, 1]
-        x = self._scale_data(x)
-        # x = x.astype(np.float32) / 255
-
-        # Split the records by classes and store it
         y = y.reshape((y.shape[0],))
-        return {i: x[y == i] for i in np.unique(y)}
+        return x, y
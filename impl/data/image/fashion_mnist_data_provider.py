@@ -5,14 +5,22 @@ from impl.data.image.image_data_provider import ImageDataProvider
 
 class FashionMNISTDataProvider(ImageDataProvider):
     def __init__(self, train_classes=[0, 2, 3, 4, 6, 7], validate_classes=[1, 5, 8, 9], test_classes=[1, 5, 8, 9],
-                 min_cluster_count=None, max_cluster_count=None, min_element_count_per_cluster=1):
+                 min_cluster_count=None, max_cluster_count=None, min_element_count_per_cluster=1, image_store_dir=None):
         super().__init__(train_classes, validate_classes, test_classes, min_cluster_count, max_cluster_count,
-                         center_data=True, random_mirror_images=True, min_element_count_per_cluster=min_element_count_per_cluster)
+                         center_data=True, random_mirror_images=True, min_element_count_per_cluster=min_element_count_per_cluster,
+                         image_store_dir=image_store_dir)
 
     def _get_img_data_shape(self):
         return (28, 28, 1)
 
     def _load_data(self):
+        return self._load_class_grouped_data('fashion_mnist', self.__load_records, [
+            'datasets/fashion-mnist/{}'.format(file) for file in [
+                'train-labels-idx1-ubyte.gz', 'train-images-idx3-ubyte.gz', 't10k-labels-idx1-ubyte.gz', 't10k-images-idx3-ubyte.gz'
+            ]
+        ])
+
+    def __load_records(self):
 
         # Load all records
         (x_train, y_train), (x_test, y_test) = fashion_mnist.load_data()
@@ -24,11 +32,7 @@ class FashionMNISTDataProvider(ImageDataProvider):
         # Reshape x for tensorflow
         x = x.reshape((x.shape[0],) + self.get_data_shape())
 
-        # Normalize x to [0, 1]
-        x = self._scale_data(x)
-
-        # Split the records by classes and store it
-        return {i: x[y == i] for i in np.unique(y)}
+        return x, y
 
 if __name__ == '__main__':
     dp = FashionMNISTDataProvider()
@@ -14,6 +14,8 @@ from yattag import Doc
 import numpy as np
 
 from core.data.data_provider import DataProvider
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore
+from impl.data.misc.image_dataset_builder import get_files_fingerprint, get_cache_key
 
 
 class ImageDataProvider(DataProvider):
@@ -23,8 +25,10 @@ class ImageDataProvider(DataProvider):
                  min_element_count_per_cluster=1, additional_augmentor=None,
                  use_augmentation_for_validation_data=True,
                  use_augmentation_for_test_data=True, use_all_classes_for_train_test_validation=False,
-                 allow_resampling=True):
+                 allow_resampling=True, image_store_dir=None):
         super().__init__()
+        self.__rand = random.Random()
+        self.__np_rand = np.random.RandomState()
         self.__return_1d_images = return_1d_images
         self._center_data = center_data
         self._random_mirror_images = random_mirror_images
@@ -36,6 +40,10 @@ class ImageDataProvider(DataProvider):
         self._already_sampled = None
         self.reset_sampling()
 
+        # If an image store directory is given, then the images are stored as unscaled uint8 images in a memory-mapped
+        # class grouped image store (see _load_class_grouped_data) and only the sampled images are read and scaled
+        self._image_store_dir = image_store_dir
+
         # Load the data
         self.__data = None
         if auto_load_data:
@@ -150,13 +158,69 @@ class ImageDataProvider(DataProvider):
     def _load_data(self):
         pass
 
+    def reseed(self, seed):
+        super().reseed(seed)
+        self.__rand.seed(seed)
+        self.__np_rand.seed(seed % (2 ** 32))
+
+    def _load_class_grouped_data(self, store_name, load_records_f, source_files, source_parameters=()):
+        """
+        Load the records and split them by classes. If no image store directory is defined, then the records are scaled
+        and a dictionary with a float32 array for each class is returned. Otherwise the unscaled records are stored in
+        a class grouped image store (only if it does not exist yet) and the memory-mapped store is returned: The images
+        are scaled when they are sampled.
+
+        The store path contains a key of the source files (names, sizes and modification times) and the source
+        parameters: If the source files change, a new store is created.
+        :param store_name: The name of the store (the image shape and the key are appended)
+        :param load_records_f: A function that returns the (N, ...) records (with values in the range [0, 255]; the
+        shape must be the data shape) and the (N,) class labels. It has to download the source files (if required).
+        :param source_files: The paths of the source files (relative to ~/.keras)
+        :param source_parameters: Other parameters that define the records (e.g. the pre-processing of the loader)
+        :return: A dictionary-like object that contains the records of each class
+        """
+        if self._image_store_dir is None:
+            x, y = load_records_f()
+            x = self._scale_data(x)
+            return {i: x[y == i] for i in np.unique(y)}
+
+        # The source files are required for the key: If they do not exist yet, the loader downloads them
+        keras_dir = path.expanduser(path.join('~', '.keras'))
+        source_files = [path.join(keras_dir, source_file) for source_file in source_files]
+        records = None
+        if not all(map(path.exists, source_files)):
+            records = load_records_f()
+
+        shape = 'x'.join(map(str, self.get_data_shape()))
+        store_path = path.join(self._image_store_dir, '{}_{}_{}'.format(
+            store_name, shape, get_cache_key(get_files_fingerprint(source_files, keras_dir), store_name, shape, *source_parameters)
+        ))
+        if ClassGroupedImageStore.exists(store_path):
+            print("Use the image store: {}".format(store_path))
+        else:
+            print("Create the image store: {}".format(store_path))
+            x, y = load_records_f() if records is None else records
+            ClassGroupedImageStore.create(store_path, x, y)
+        return ClassGroupedImageStore(store_path)
+
+    def _use_image_store(self, store):
+        """
+        Use a class grouped image store that was created by a dataset loader as data: It is neither scaled nor copied
+        (the images are scaled when they are sampled).
+        :param store: The ClassGroupedImageStore
+        :return: The store
+        """
+        if store.image_shape != tuple(self.get_data_shape()):
+            raise Exception("The image store has an invalid image shape (expected {}, but got {})".format(tuple(self.get_data_shape()), store.image_shape))
+        return store
+
     def _get_random_element(self, class_name, data_type, element_index=None):
         # data = self.__data[class_name][:1] # Just for debugging
 
         data = self.__data[class_name]
 
         if self._allow_resampling:
-            random_element_index = random.randint(0, data.shape[0] - 1)
+            random_element_index = self.__rand.randint(0, data.shape[0] - 1)
         else:
 
             if class_name not in self._already_sampled:
@@ -167,13 +231,18 @@ class ImageDataProvider(DataProvider):
             if len(indices) == 0:
                 raise Exception("No indices left")
 
-            random_element_index = random.choice(sorted(indices))
+            random_element_index = self.__rand.choice(sorted(indices))
 
             # Store the used index
             used_indices.add(random_element_index)
 
-        # We need to copy the element, because it may be modified (and we do not want to modify it globally)
-        element = np.copy(np.reshape(data[random_element_index], (1,) + data.shape[1:]))
+        # We need to copy the element, because it may be modified (and we do not want to modify it globally). The
+        # images of an image store are not scaled yet (scaling also creates a copy).
+        element = np.reshape(data[random_element_index], (1,) + data.shape[1:])
+        if np.issubdtype(element.dtype, np.floating):
+            element = np.copy(element)
+        else:
+            element = self._scale_data(element)
 
         # If required, do data augmentation
         if data_type == 'train' or \
@@ -181,7 +250,7 @@ class ImageDataProvider(DataProvider):
             (data_type == 'test' and self._use_augmentation_for_test_data):
 
             # If required: Flip the element
-            if self._random_mirror_images and bool(random.getrandbits(1)):
+            if self._random_mirror_images and bool(self.__rand.getrandbits(1)):
                 element[0] = np.fliplr(element[0])
 
             # Use additional data augmentation, if available
@@ -227,13 +296,13 @@ class ImageDataProvider(DataProvider):
         if cluster_count is not None and cluster_count > self.get_max_cluster_count():
             cluster_count = self.get_max_cluster_count()
         if cluster_count is None:
-            cluster_count = random.randint(self.__min_cluster_count, self._max_cluster_count)
+            cluster_count = self.__rand.randint(self.__min_cluster_count, self._max_cluster_count)
 
         # Choose the correct available classes
         classes = self._data_classes[data_type]
 
         # Choose "cluster_count" classes
-        classes = np.random.choice(classes, cluster_count, replace=False)
+        classes = self.__np_rand.choice(classes, cluster_count, replace=False)
 
         # Create the clusters and already add one element to each cluster (because every cluster must be non-empty)
         if self.__return_1d_images:
@@ -244,7 +313,8 @@ class ImageDataProvider(DataProvider):
         # Initialize an empty "result"
         clusters = {class_name:[] for class_name in classes}
 
-        # Save all hints in a list
+        # Save all hints in a list: Each hint is stored as (class_name, first index in the class, element count) and
+        # converted to element indices at the end
         hints = []
 
         # Create a function to add a new element to a class. It may be possible that more than 1 element is added,
@@ -270,13 +340,11 @@ class ImageDataProvider(DataProvider):
             element = element[:max_element_count]
             additional_obj_info = additional_obj_info[:max_element_count]
 
-            elements_for_hints = []
+            first_index = len(clusters[class_name])
             for i in range(len(element)):
-                obj = post_process(element[i], additional_obj_info[i])
-                elements_for_hints.append(obj)
-                clusters[class_name].append(obj)
-            if len(elements_for_hints) > 0:
-                hints.append(elements_for_hints)
+                clusters[class_name].append(post_process(element[i], additional_obj_info[i]))
+            if len(element) > 0:
+                hints.append((class_name, first_index, len(element)))
             return len(element)
 
         for i in range(self._min_element_count_per_cluster):
@@ -289,7 +357,7 @@ class ImageDataProvider(DataProvider):
 
         # Fill now all elements to the data structure
         while element_count > 0:
-            class_name = random.choice(classes)
+            class_name = self.__rand.choice(classes)
             element_count -= add_element(class_name, element_count)
         # for i in range(element_count):
         #     class_name = random.choice(classes)
@@ -298,9 +366,19 @@ class ImageDataProvider(DataProvider):
         # Create the resulting clusters and the additional_obj_info
         res_clusters = []
         res_additional_obj_info = []
+        class_offsets = {}
+        offset = 0
         for k in sorted(clusters.keys()):
             res_clusters.append(list(map(lambda x: x[0], clusters[k])))
             res_additional_obj_info.append(list(map(lambda x: x[1], clusters[k])))
+            class_offsets[k] = offset
+            offset += len(clusters[k])
+
+        # The hints contain the indices of the elements (in the order of the flattened clusters)
+        hints = [
+            list(range(class_offsets[class_name] + first_index, class_offsets[class_name] + first_index + count))
+            for class_name, first_index, count in hints
+        ]
 
         # # We need an array of arrays. Return it in the order of the classes.
         # res_clusters = [clusters[k] for k in sorted(clusters.keys())]
@@ -1,53 +1,69 @@
-import gzip
 import os
-import tarfile
-import glob
-import pickle
 
-import shutil
+import numpy as np
 
-from scipy.io import loadmat
-from scipy.misc import imread, imresize, imsave
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore
+from impl.data.misc.image_dataset_builder import IMAGE_PREPROCESSING, get_files_fingerprint, get_cache_key, \
+    get_dataset_file, iterate_tar_members, build_split_image_stores
 
-from keras.utils.data_utils import get_file
-import numpy as np
+def load_data(target_img_size=(48, 48), workers=None):
+    """Loads the Birds200 (CUB-200-2011) dataset. The images are cropped to their bounding boxes.
 
-def load_data(target_img_size=(48, 48)):
-    """Loads the Flowers102 dataset
+    The images are read directly from the downloaded archive (nothing is extracted) and decoded and resized in
+    parallel (see impl.data.misc.image_dataset_builder). The result is cached in class grouped image stores (see
+    load_data_stores).
     # Returns
-        Tuple of Numpy arrays: `(x_train, y_train), (x_valid, y_valid), (x_test, y_test)`.
+        Tuple of Numpy arrays: `(x_train, y_train), (x_test, y_test)`.
+    """
+    (x_train, y_train), (x_test, y_test) = [store.get_records() for store in load_data_stores(target_img_size, workers)]
+
+    return (x_train, y_train), (x_test, y_test)
+
+
+def load_data_stores(target_img_size=(48, 48), workers=None, cache_dir=None):
+    """Like load_data, but the class grouped image stores that cache the splits are returned (they are created if they
+    do not exist yet). The classes of the stores are the class indices.
+
+    # Arguments
+        cache_dir: The directory that contains the caches of all datasets (default: ~/.keras/datasets)
+
+    # Returns
+        The train and the test ClassGroupedImageStore with the uint8 images.
     """
     dirname = os.path.join('datasets', 'birds200')
-    # http://www.robots.ox.ac.uk/~vgg/data/flowers/102/102flowers.tgz
-    # http://www.robots.ox.ac.uk/~vgg/data/flowers/102/imagelabels.mat
+    if cache_dir is None:
+        cache_dir = os.path.join('~', '.keras', 'datasets')
     base = 'http://www.vision.caltech.edu/visipedia-data/CUB-200-2011/'
     files = ['CUB_200_2011.tgz']
 
-    # Download all files
+    # Download all files (if they do not exist yet)
     paths = []
     for file in files:
-        paths.append(get_file(file, origin=base + file, cache_subdir=dirname))
+        paths.append(get_dataset_file(dirname, base, file))
 
     # Load all files
     assert len(target_img_size) == 2
-    cached_file = os.path.expanduser(os.path.join('~', '.keras', dirname, 'img_{}x{}.cache.pkl'.format(*target_img_size)))
+    target_img_size = tuple(target_img_size)
+    cache_key = get_cache_key(get_files_fingerprint(paths), target_img_size, IMAGE_PREPROCESSING, 'bounding_box_crop')
+    cached_files = [
+        os.path.expanduser(os.path.join(cache_dir, 'birds200', 'img_{}x{}_{}_{}'.format(target_img_size[0], target_img_size[1], cache_key, split)))
+        for split in ['train', 'test']
+    ]
 
     # If required: Pre-process all files
-    if not os.path.exists(cached_file):
-        # The following code is partially based on:
-        # https://github.com/Arsey/keras-transfer-learning-for-oxford102/blob/master/bootstrap.py
-
-        tmp_dir = os.path.expanduser(os.path.join('~', '.keras', dirname, 'tmp'))
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-        tmp_data_dir = os.path.join(tmp_dir, 'CUB_200_2011')
-
-        print("Extract all bird images...")
-        tarfile.open(paths[0]).extractall(tmp_dir)
-
-        def read_definition_file(file):
-            with open(file, "r") as fh:
-                return [line.strip().split(' ') for line in fh]
+    if not all(map(ClassGroupedImageStore.exists, cached_files)):
+        data_dir = 'CUB_200_2011/'
+        definition_files = ['images.txt', 'image_class_labels.txt', 'bounding_boxes.txt', 'train_test_split.txt']
+
+        # The position of the definition files in the archive is not known: Read the archive until all are found
+        print("Load the definition files...")
+        definitions = {}
+        for name, content in iterate_tar_members(paths[0], lambda name: name[len(data_dir):] in definition_files):
+            definitions[name[len(data_dir):]] = [line.strip().split(' ') for line in content.decode('utf-8').splitlines() if line.strip() != '']
+            if len(definitions) == len(definition_files):
+                break
+        if len(definitions) != len(definition_files):
+            raise Exception("The archive {} does not contain all definition files".format(paths[0]))
 
         # A hash that contains all images and all properties
         imgs = {}
@@ -56,69 +72,30 @@ def load_data(target_img_size=(48, 48)):
                 imgs[img_id] = {}
             return imgs[img_id]
 
-        print("Load the list of images...")
-        for img_id, path in read_definition_file(os.path.join(tmp_data_dir, 'images.txt')):
+        for img_id, path in definitions['images.txt']:
             get_img_dict(img_id)['path'] = path
-
-        print("Load the classes...")
-        for img_id, class_id in read_definition_file(os.path.join(tmp_data_dir, 'image_class_labels.txt')):
+        for img_id, class_id in definitions['image_class_labels.txt']:
             get_img_dict(img_id)['class_id'] = int(class_id) - 1
-
-        print("Load the bounding boxes...")
-        for img_id, x, y, width, height in read_definition_file(os.path.join(tmp_data_dir, 'bounding_boxes.txt')):
-            img_dict = get_img_dict(img_id)
-            img_dict['bb_x'] = int(float(x))
-            img_dict['bb_y'] = int(float(y))
-            img_dict['bb_width'] = int(float(width))
-            img_dict['bb_height'] = int(float(height))
-
-        print("Load the train / test split...")
-        for img_id, is_training_image in read_definition_file(os.path.join(tmp_data_dir, 'train_test_split.txt')):
+        for img_id, x, y, width, height in definitions['bounding_boxes.txt']:
+            get_img_dict(img_id)['bounding_box'] = (int(float(x)), int(float(y)), int(float(width)), int(float(height)))
+        for img_id, is_training_image in definitions['train_test_split.txt']:
             get_img_dict(img_id)['is_training_image'] = bool(int(is_training_image))
 
-        print("Load and pre-process image files...")
-        x = np.zeros((len(imgs),) + target_img_size + (3,), dtype=np.uint8)
-        y = np.zeros((len(imgs)))
-        idx_train = []
-        idx_test = []
         img_ids = sorted(imgs.keys())
-        for i in range(len(img_ids)):
-            img_dict = imgs[img_ids[i]]
-            print("Read and pre-process image file ({}/{}): {}".format(i + 1, len(img_ids), img_dict['path']))
-            img = imread(os.path.join(tmp_data_dir, 'images', img_dict['path']), mode='RGB')
-            img = img[
-                img_dict['bb_y']:(img_dict['bb_y'] + img_dict['bb_height']),
-                img_dict['bb_x']:(img_dict['bb_x'] + img_dict['bb_width']),
-            ]
-            img = imresize(img, target_img_size + (3,))
-            # imsave(os.path.join(tmp_data_dir, 'images', img_dict['path'] + '_resized.png'), img)
-            x[i] = img
-            y[i] = img_dict['class_id']
-            if img_dict['is_training_image']:
-                idx_train.append(i)
-            else:
-                idx_test.append(i)
-
-        print("Split the data...")
-        x_train = x[idx_train]
-        y_train = y[idx_train]
-        x_test = x[idx_test]
-        y_test = y[idx_test]
-
-        print("Delete temporary files")
-        shutil.rmtree(tmp_dir)
-
-        print("Save the data")
-        data = ((x_train, y_train), (x_test, y_test))
-        with open(cached_file, "wb") as fh:
-            pickle.dump(data, fh, protocol=4)
-
-    with open(cached_file, "rb") as fh:
-        (x_train, y_train), (x_test, y_test) = pickle.load(fh)
+        img_positions = {data_dir + 'images/' + imgs[img_ids[i]]['path']: i for i in range(len(img_ids))}
+        y = np.asarray([imgs[img_id]['class_id'] for img_id in img_ids], dtype=np.int32)
+        idx_train = [i for i in range(len(img_ids)) if imgs[img_ids[i]]['is_training_image']]
+        idx_test = [i for i in range(len(img_ids)) if not imgs[img_ids[i]]['is_training_image']]
 
-    return (x_train, y_train), (x_test, y_test)
+        print("Load and pre-process image files...")
+        sources = (
+            (img_positions[name], (content, imgs[img_ids[img_positions[name]]]['bounding_box']))
+            for name, content in iterate_tar_members(paths[0], lambda name: name in img_positions)
+        )
+        build_split_image_stores(cached_files, sources, y, [idx_train, idx_test], target_img_size, workers=workers)
+
+    return [ClassGroupedImageStore(cached_file) for cached_file in cached_files]
 
 
 if __name__ == '__main__':
     load_data()
-
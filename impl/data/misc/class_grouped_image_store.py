@@ -0,0 +1,232 @@
+import os
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+
+# The file format of the image store:
+# - <path>.data: All uint8 pixels (C-order), the images of each class are stored contiguously
+# - <path>.index.pkl: The image shape, the class names (in the same order as in the data file) and for each class the
+#   offset (the index of its first image) in the data file
+_DATA_SUFFIX = '.data'
+_INDEX_SUFFIX = '.index.pkl'
+_TMP_SUFFIX = '.tmp'
+_FORMAT_VERSION = 1
+
+
+class ClassGroupedImageStore(Mapping):
+    """
+    An on-disk store for uint8 images that are grouped by class. The data file is opened with np.memmap: The images are
+    only read if they are accessed and several processes that use the same store share the page cache.
+
+    The store behaves like a read-only dictionary: store[class_name] returns a (N_class, ...) uint8 view of the images of
+    the class (no data is read until the view is accessed).
+    """
+    def __init__(self, store_path):
+        with open(store_path + _INDEX_SUFFIX, 'rb') as fh:
+            index = pickle.load(fh)
+        if index['version'] != _FORMAT_VERSION:
+            raise Exception("Unsupported image store version: {}".format(index['version']))
+        self.__image_shape = tuple(index['image_shape'])
+        self.__classes = index['classes']
+        self.__offsets = index['offsets']
+        self.__class_indices = {class_name: i for i, class_name in enumerate(self.__classes)}
+
+        # np.memmap cannot map empty files
+        count = self.__offsets[-1]
+        if count > 0:
+            self.__data = np.memmap(store_path + _DATA_SUFFIX, dtype=np.uint8, mode='r', shape=(count,) + self.__image_shape)
+        else:
+            self.__data = np.zeros((0,) + self.__image_shape, dtype=np.uint8)
+
+    @property
+    def image_shape(self):
+        return self.__image_shape
+
+    @property
+    def image_count(self):
+        return self.__offsets[-1]
+
+    def __getitem__(self, class_name):
+        i = self.__class_indices[class_name]
+        return self.__data[self.__offsets[i]:self.__offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.__classes)
+
+    def __len__(self):
+        return len(self.__classes)
+
+    def get_records(self):
+        """
+        Get all images and their class names.
+        :return: The (N, ...) uint8 images (memory-mapped, sorted by class) and the (N,) class names
+        """
+        return self.__data, np.repeat(np.asarray(self.__classes), np.diff(self.__offsets))
+
+    @staticmethod
+    def exists(store_path):
+        return os.path.exists(store_path + _INDEX_SUFFIX) and os.path.exists(store_path + _DATA_SUFFIX)
+
+    @staticmethod
+    def create(store_path, x, y, chunk_size=1024):
+        """
+        Create a store from a (N, ...) image array and the (N,) class labels. The images are sorted by class (stable, so
+        the order within a class is preserved) and written chunk by chunk: Only one chunk is converted to uint8 at once.
+        The class names are the values of np.unique(y).
+        :param store_path: The path of the store (without file extension)
+        :param x: The images (uint8 or values in the range [0, 255])
+        :param y: The class labels
+        :param chunk_size: The amount of images that are written at once
+        :return: The opened store
+        """
+        y = np.asarray(y).reshape((-1,))
+        order = np.argsort(y, kind='mergesort')
+        classes = np.unique(y)
+        offsets = np.searchsorted(y[order], classes, side='left').tolist() + [y.shape[0]]
+
+        with ClassGroupedImageStoreWriter(store_path, x.shape[1:]) as writer:
+            for i, class_name in enumerate(classes.tolist()):
+                for start in range(offsets[i], offsets[i + 1], chunk_size):
+                    writer.add(class_name, x[order[start:min(start + chunk_size, offsets[i + 1])]])
+        return ClassGroupedImageStore(store_path)
+
+
+class MergedClassGroupedImageStore(Mapping):
+    """
+    A read-only view on several class grouped image stores (e.g. the splits of a dataset) that behaves like one store.
+    Nothing is copied: If a class is contained in several stores, then store[class_name] is a ConcatenatedImages view
+    on its images.
+    """
+    def __init__(self, stores):
+        stores = list(stores)
+        if len(stores) == 0:
+            raise Exception("At least one image store is required")
+        self.__image_shape = stores[0].image_shape
+        for store in stores[1:]:
+            if store.image_shape != self.__image_shape:
+                raise Exception("All image stores must have the same image shape (expected {}, but got {})".format(self.__image_shape, store.image_shape))
+        self.__image_count = sum(store.image_count for store in stores)
+        self.__classes = sorted(set().union(*stores))
+        self.__images = {}
+        for class_name in self.__classes:
+            parts = [store[class_name] for store in stores if class_name in store]
+            self.__images[class_name] = parts[0] if len(parts) == 1 else ConcatenatedImages(parts)
+
+    @property
+    def image_shape(self):
+        return self.__image_shape
+
+    @property
+    def image_count(self):
+        return self.__image_count
+
+    def __getitem__(self, class_name):
+        return self.__images[class_name]
+
+    def __iter__(self):
+        return iter(self.__classes)
+
+    def __len__(self):
+        return len(self.__classes)
+
+
+class ConcatenatedImages:
+    """
+    A read-only view on several (N_i, ...) image arrays that behaves like their concatenation for the operations of the
+    image providers (shape, len and indexing with an int). Nothing is copied; other indices (e.g. slices) return a
+    concatenated copy.
+    """
+    def __init__(self, parts):
+        self.__parts = list(parts)
+        self.__offsets = np.cumsum([0] + [part.shape[0] for part in self.__parts])
+        self.__shape = (int(self.__offsets[-1]),) + tuple(self.__parts[0].shape[1:])
+
+    @property
+    def shape(self):
+        return self.__shape
+
+    @property
+    def dtype(self):
+        return self.__parts[0].dtype
+
+    def __len__(self):
+        return self.__shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += self.__shape[0]
+            if index < 0 or index >= self.__shape[0]:
+                raise IndexError("Index {} is out of bounds for {} images".format(index, self.__shape[0]))
+            part = int(np.searchsorted(self.__offsets, index, side='right')) - 1
+            return self.__parts[part][index - self.__offsets[part]]
+        return np.concatenate(self.__parts)[index]
+
+
+class ClassGroupedImageStoreWriter:
+    """
+    Write a ClassGroupedImageStore incrementally: The images have to be added class by class (all images of a class
+    have to be added before the next class is started). The store is only visible after close was called (the files
+    are written to temporary files and then renamed). If the writer is used with "with", it is closed automatically
+    (or, if an exception occurs, the temporary files are removed).
+    """
+    def __init__(self, store_path, image_shape):
+        self.__store_path = store_path
+        self.__image_shape = tuple(image_shape)
+        self.__classes = []
+        self.__offsets = [0]
+        dirname = os.path.dirname(store_path)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.__fh = open(store_path + _DATA_SUFFIX + _TMP_SUFFIX, 'wb')
+
+    @property
+    def image_count(self):
+        return self.__offsets[-1]
+
+    def add(self, class_name, images):
+        """
+        Add some images of a class.
+        :param class_name: The class name
+        :param images: A (N, ...) array with uint8 images (or values in the range [0, 255])
+        """
+        images = np.asarray(images)
+        if images.shape[1:] != self.__image_shape:
+            raise Exception("Invalid image shape (expected {}, but got {})".format(self.__image_shape, images.shape[1:]))
+        if len(self.__classes) == 0 or self.__classes[-1] != class_name:
+            if class_name in self.__classes:
+                raise Exception("The images of the class {} have to be added at once".format(class_name))
+            self.__classes.append(class_name)
+            self.__offsets.append(self.__offsets[-1])
+        self.__fh.write(np.ascontiguousarray(images, dtype=np.uint8).tobytes())
+        self.__offsets[-1] += images.shape[0]
+
+    def close(self):
+        self.__fh.close()
+        with open(self.__store_path + _INDEX_SUFFIX + _TMP_SUFFIX, 'wb') as fh:
+            pickle.dump({
+                'version': _FORMAT_VERSION,
+                'image_shape': self.__image_shape,
+                'classes': self.__classes,
+                'offsets': self.__offsets
+            }, fh, protocol=4)
+
+        # The index file is renamed last: The store only exists if both files exist
+        os.replace(self.__store_path + _DATA_SUFFIX + _TMP_SUFFIX, self.__store_path + _DATA_SUFFIX)
+        os.replace(self.__store_path + _INDEX_SUFFIX + _TMP_SUFFIX, self.__store_path + _INDEX_SUFFIX)
+
+    def abort(self):
+        self.__fh.close()
+        for suffix in [_DATA_SUFFIX, _INDEX_SUFFIX]:
+            if os.path.exists(self.__store_path + suffix + _TMP_SUFFIX):
+                os.remove(self.__store_path + suffix + _TMP_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
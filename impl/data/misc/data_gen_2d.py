@@ -12,8 +12,13 @@ class DataGen2dv02:
         self.add_noise = True
         self.add_noise_to_data_dimensions = False
         self.__rand = rand
+        self.__np_rand = np.random.RandomState()
         self.__default_sigma = default_sigma
 
+    def reseed(self, seed):
+        self.__rand.seed(seed)
+        self.__np_rand.seed(seed % (2 ** 32))
+
     def generate(self, cluster_count=None, records=50, sigma=None, cluster_count_min=1, cluster_count_max=10, allow_less_clusters=False):
         if sigma is None:
             sigma = self.__default_sigma
@@ -31,7 +36,7 @@ class DataGen2dv02:
 
         # Generate some candidates
         def generate_centers(count):
-            return np.dot(np.random.rand(count, 2), limits_scale) + limits_offset
+            return np.dot(self.__np_rand.rand(count, 2), limits_scale) + limits_offset
         additional_cluster_center_count = cluster_count * 10
         possible_cluster_centers = generate_centers(cluster_count + additional_cluster_center_count)
 
@@ -79,11 +84,11 @@ class DataGen2dv02:
 
         # Each cluster contains at least one elements, therefore we create a distribution for records - cluster_count
         # entries and then we add to every cluster one element
-        data_points_per_cluster = np.random.multinomial(records - cluster_count, [1./cluster_count]*cluster_count)
+        data_points_per_cluster = self.__np_rand.multinomial(records - cluster_count, [1./cluster_count]*cluster_count)
         data_points_per_cluster += 1
 
         data = np.zeros((records, 3), dtype=np.float32)
-        data[:, 1:] = np.random.normal(size=(records, 2), scale=sigma)
+        data[:, 1:] = self.__np_rand.normal(size=(records, 2), scale=sigma)
         i = 0
         c = 0
         empty_c = 0
@@ -119,8 +124,8 @@ class DataGen2dv02:
             return np.minimum(limit[1], np.maximum(limit[0], points))
 
         def generate_cluster(center, n_points):
-            px = points_in_range(limits[0], np.random.normal(center[0], sigma, n_points))
-            py = points_in_range(limits[1], np.random.normal(center[1], sigma, n_points))
+            px = points_in_range(limits[0], self.__np_rand.normal(center[0], sigma, n_points))
+            py = points_in_range(limits[1], self.__np_rand.normal(center[1], sigma, n_points))
             p = np.dstack([px, py])[0]
             # return list(map(lambda i: p[i], range(n_points)))
             return [p[i] for i in range(n_points)]
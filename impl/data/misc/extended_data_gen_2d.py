@@ -13,11 +13,16 @@ class ExtendedDataGen2d:
         self.limit_y = (0, 1)
         self.__rescale_border_percentage = 0.25
         self.__rand = rand
+        self.__np_rand = np.random.RandomState()
         self.__sigma = sigma
         self.__data_gen_2d = data_gen_2d if data_gen_2d is not None else DataGen2dv02(self.__rand)
         self.__cluster_generators = []
         self.__register_default_cluster_generators()
 
+    def reseed(self, seed):
+        self.__rand.seed(seed)
+        self.__np_rand.seed(seed % (2 ** 32))
+
     def __register_cluster_generator(self, cluster_count, min_samples_per_cluster, generator_f, require_even_sample_count=False):
         self.__cluster_generators.append({
             'generator_f': generator_f,
@@ -80,27 +85,29 @@ class ExtendedDataGen2d:
         # Register the circle generator for 1 circle
         self.__register_cluster_generator(1, 10,
             lambda n_samples: self.__sklearn_cluster_postprocessing(
-                make_circles(n_samples=n_samples * 2, noise=self.__rand.uniform(0, 0.02), factor=self.__rand.uniform(0.1, 0.4)),
+                make_circles(n_samples=n_samples * 2, noise=self.__rand.uniform(0, 0.02), factor=self.__rand.uniform(0.1, 0.4),
+                             random_state=self.__np_rand),
                 return_clusters=[1]
         ))
 
         # Register the circle generator for both circles
         self.__register_cluster_generator(2, 5,
             lambda n_samples: self.__sklearn_cluster_postprocessing(
-                make_circles(n_samples=n_samples, noise=self.__rand.uniform(0, 0.02), factor=self.__rand.uniform(0.1, 0.4))
+                make_circles(n_samples=n_samples, noise=self.__rand.uniform(0, 0.02), factor=self.__rand.uniform(0.1, 0.4),
+                             random_state=self.__np_rand)
         ), require_even_sample_count=True)
 
         # Register the moon generator for 1 moon
         self.__register_cluster_generator(1, 10,
             lambda n_samples: self.__sklearn_cluster_postprocessing(
-                make_moons(n_samples=n_samples * 2, noise=self.__rand.uniform(0, 0.03)),
+                make_moons(n_samples=n_samples * 2, noise=self.__rand.uniform(0, 0.03), random_state=self.__np_rand),
                 return_clusters=[bool(self.__rand.getrandbits(1))]
         ))
 
         # Register the moon generator for both moon
         self.__register_cluster_generator(2, 5,
             lambda n_samples: self.__sklearn_cluster_postprocessing(
-                make_moons(n_samples=n_samples, noise=self.__rand.uniform(0, 0.03))
+                make_moons(n_samples=n_samples, noise=self.__rand.uniform(0, 0.03), random_state=self.__np_rand)
         ))
 
         # Register the good old data gen v2. Register it for 1, 2 and 5 clusters
@@ -178,7 +185,7 @@ class ExtendedDataGen2d:
         height = n + self.__rand.randint(0, n // 2)
 
         # Grid indices for the cluster groups
-        grid_indices = list(np.random.choice(list(range(width * height)), len(cluster_groups), replace=False))
+        grid_indices = list(self.__np_rand.choice(list(range(width * height)), len(cluster_groups), replace=False))
 
         # Create now the final cluster list
         clusters = []
@@ -1,48 +1,64 @@
-import gzip
 import os
-import tarfile
-import glob
-import pickle
-
-import shutil
+import re
 
 from scipy.io import loadmat
-from scipy.misc import imread, imresize
 
-from keras.utils.data_utils import get_file
 import numpy as np
 
-def load_data(target_img_size=(48, 48)):
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore
+from impl.data.misc.image_dataset_builder import IMAGE_PREPROCESSING, get_files_fingerprint, get_cache_key, \
+    get_dataset_file, iterate_tar_members, build_split_image_stores
+
+def load_data(target_img_size=(48, 48), workers=None):
     """Loads the Flowers102 dataset
+
+    The images are read directly from the downloaded archive (nothing is extracted) and decoded and resized in
+    parallel (see impl.data.misc.image_dataset_builder). The result is cached in class grouped image stores (see
+    load_data_stores).
     # Returns
         Tuple of Numpy arrays: `(x_train, y_train), (x_valid, y_valid), (x_test, y_test)`.
     """
+    (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = [
+        store.get_records() for store in load_data_stores(target_img_size, workers)
+    ]
+
+    return (x_train, y_train), (x_valid, y_valid), (x_test, y_test)
+
+
+def load_data_stores(target_img_size=(48, 48), workers=None, cache_dir=None):
+    """Like load_data, but the class grouped image stores that cache the splits are returned (they are created if they
+    do not exist yet). The classes of the stores are the class indices.
+
+    # Arguments
+        cache_dir: The directory that contains the caches of all datasets (default: ~/.keras/datasets)
+
+    # Returns
+        The train, the validation and the test ClassGroupedImageStore with the uint8 images.
+    """
     dirname = os.path.join('datasets', 'flowers102')
+    if cache_dir is None:
+        cache_dir = os.path.join('~', '.keras', 'datasets')
     # http://www.robots.ox.ac.uk/~vgg/data/flowers/102/102flowers.tgz
     # http://www.robots.ox.ac.uk/~vgg/data/flowers/102/imagelabels.mat
     base = 'http://www.robots.ox.ac.uk/~vgg/data/flowers/102/'
     files = ['102flowers.tgz', 'imagelabels.mat', 'setid.mat']
 
-    # Download all files
+    # Download all files (if they do not exist yet)
     paths = []
     for file in files:
-        paths.append(get_file(file, origin=base + file, cache_subdir=dirname))
+        paths.append(get_dataset_file(dirname, base, file))
 
     # Load all files
     assert len(target_img_size) == 2
-    cached_file = os.path.expanduser(os.path.join('~', '.keras', dirname, 'img_{}x{}.cache.pkl'.format(*target_img_size)))
+    target_img_size = tuple(target_img_size)
+    cache_key = get_cache_key(get_files_fingerprint(paths), target_img_size, IMAGE_PREPROCESSING)
+    cached_files = [
+        os.path.expanduser(os.path.join(cache_dir, 'flowers102', 'img_{}x{}_{}_{}'.format(target_img_size[0], target_img_size[1], cache_key, split)))
+        for split in ['train', 'valid', 'test']
+    ]
 
     # If required: Pre-process all files
-    if not os.path.exists(cached_file):
-        # The following code is partially based on:
-        # https://github.com/Arsey/keras-transfer-learning-for-oxford102/blob/master/bootstrap.py
-
-        tmp_dir = os.path.expanduser(os.path.join('~', '.keras', dirname, 'tmp'))
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir)
-
-        print("Extract all flower images...")
-        tarfile.open(paths[0]).extractall(tmp_dir)
+    if not all(map(ClassGroupedImageStore.exists, cached_files)):
 
         print("Load index definitions...")
         idx = loadmat(paths[2])
@@ -51,42 +67,20 @@ def load_data(target_img_size=(48, 48)):
         idx_valid = idx['valid'][0] - 1
 
         print("Load labels...")
-        img_labels = loadmat(paths[1])['labels'][0] - 1
+        img_labels = (loadmat(paths[1])['labels'][0] - 1).astype(np.int32)
+
+        # The images are named jpg/image_00001.jpg, ... (the number is the index in the labels)
+        img_name_regex = re.compile(r'^(?:\./)?jpg/image_(\d+)\.jpg$')
 
         print("Load and pre-process image files...")
-        img_files = sorted(glob.glob(os.path.join(tmp_dir, 'jpg', '*.jpg')))
-        x = np.zeros((len(img_files),) + target_img_size + (3,), dtype=np.uint8)
-        y = np.zeros((len(img_files)))
-        for i in range(len(img_files)):
-            img_file = img_files[i]
-            print("Read and pre-process image file: {}".format(img_file))
-            img = imread(img_file)
-            img = imresize(img, target_img_size + (3,))
-            x[i] = img
-            y[i] = img_labels[i]
-
-        print("Split the data...")
-        x_train = x[idx_train]
-        y_train = y[idx_train]
-        x_valid = x[idx_valid]
-        y_valid = y[idx_valid]
-        x_test = x[idx_test]
-        y_test = y[idx_test]
-
-        print("Delete temporary files")
-        shutil.rmtree(tmp_dir)
-
-        print("Save the data")
-        data = ((x_train, y_train), (x_valid, y_valid), (x_test, y_test))
-        with open(cached_file, "wb") as fh:
-            pickle.dump(data, fh, protocol=4)
-
-    with open(cached_file, "rb") as fh:
-        (x_train, y_train), (x_valid, y_valid), (x_test, y_test) = pickle.load(fh)
+        sources = (
+            (int(img_name_regex.match(name).group(1)) - 1, content)
+            for name, content in iterate_tar_members(paths[0], lambda name: img_name_regex.match(name) is not None)
+        )
+        build_split_image_stores(cached_files, sources, img_labels, [idx_train, idx_valid, idx_test], target_img_size, workers=workers)
 
-    return (x_train, y_train), (x_valid, y_valid), (x_test, y_test)
+    return [ClassGroupedImageStore(cached_file) for cached_file in cached_files]
 
 
 if __name__ == '__main__':
     load_data()
-
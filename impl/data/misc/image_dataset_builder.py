@@ -0,0 +1,292 @@
+import hashlib
+import multiprocessing
+import os
+import pickle
+import tarfile
+from collections import deque
+from io import BytesIO
+from time import time
+
+import numpy as np
+from scipy.misc import imread, imresize
+
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore
+
+# Identifies the decoding and resizing of the images. It is part of all cache keys: If the pre-processing is changed,
+# this value has to be changed too (otherwise old caches are used)
+IMAGE_PREPROCESSING = 'rgb_imresize_v1'
+
+# The file format of the decoded originals (they have different shapes, so a ClassGroupedImageStore cannot be used):
+# - <path>.data: The uint8 pixels of all images (C-order)
+# - <path>.index.pkl: For each image the offset in the data file and the shape
+_ORIGINALS_DATA_SUFFIX = '.data'
+_ORIGINALS_INDEX_SUFFIX = '.index.pkl'
+_TMP_SUFFIX = '.tmp'
+
+# The decoded originals that are used by a worker process (see _init_worker)
+_worker_originals = None
+
+
+def get_files_fingerprint(files, top_dir=None):
+    """
+    Calculate a fingerprint of some source files. Only the names, the sizes and the modification times are used (the
+    content is not read), so the fingerprint is cheap to calculate even for large datasets.
+    :param files: The file paths (the order is relevant)
+    :param top_dir: If given, the file names are relative to this directory (the dataset may be moved)
+    :return: The fingerprint (a hex string)
+    """
+    h = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        name = file if top_dir is None else os.path.relpath(file, top_dir)
+        h.update('{}\0{}\0{}\n'.format(name.replace(os.sep, '/'), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_cache_key(fingerprint, *parameters):
+    """
+    Get a short cache key for a source fingerprint and the parameters that define the cached data (e.g. the target
+    size and the pre-processing).
+    """
+    key = '\0'.join([fingerprint] + [repr(tuple(p)) if isinstance(p, list) else repr(p) for p in parameters])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def get_dataset_file(cache_subdir, origin_base, file):
+    """
+    Get the local path of a dataset file (relative to ~/.keras). The file is only downloaded if it does not exist yet,
+    so no network access is required for already downloaded datasets.
+    """
+    local_path = os.path.expanduser(os.path.join('~', '.keras', cache_subdir, file))
+    if os.path.exists(local_path):
+        return local_path
+    from keras.utils.data_utils import get_file
+    return get_file(file, origin=origin_base + file, cache_subdir=cache_subdir)
+
+
+def iterate_tar_members(tar_path, name_filter_f=None):
+    """
+    Read the files of a (compressed) tar archive sequentially: Nothing is extracted to the disk and the archive is only
+    read once (the generator may be closed early).
+    :param tar_path: The path of the archive
+    :param name_filter_f: If given, only the files for which this function returns True are read
+    :return: A generator for (name, content) tuples (in the order of the archive)
+    """
+    with tarfile.open(tar_path, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and (name_filter_f is None or name_filter_f(member.name)):
+                yield member.name, tar.extractfile(member).read()
+
+
+def decoded_originals_exist(originals_path):
+    return os.path.exists(originals_path + _ORIGINALS_INDEX_SUFFIX) and os.path.exists(originals_path + _ORIGINALS_DATA_SUFFIX)
+
+
+def _open_decoded_originals(originals_path):
+    with open(originals_path + _ORIGINALS_INDEX_SUFFIX, 'rb') as fh:
+        entries = pickle.load(fh)
+    if len(entries) == 0:
+        return np.zeros((0,), dtype=np.uint8), entries
+    return np.memmap(originals_path + _ORIGINALS_DATA_SUFFIX, dtype=np.uint8, mode='r'), entries
+
+
+def _init_worker(originals_path):
+    global _worker_originals
+    _worker_originals = None if originals_path is None else _open_decoded_originals(originals_path)
+
+
+def _decode_image(source):
+    if isinstance(source, tuple):
+
+        # A source and a crop box (x, y, width, height)
+        source, (x, y, width, height) = source
+        return _decode_image(source)[y:(y + height), x:(x + width)]
+
+    if isinstance(source, (int, np.integer)):
+
+        # An index of the decoded originals
+        data, entries = _worker_originals
+        offset, shape = entries[source]
+        return np.array(data[offset:(offset + int(np.prod(shape)))].reshape(shape))
+
+    # A file path or the content of an image file
+    return imread(source if isinstance(source, str) else BytesIO(source), mode='RGB')
+
+
+def _load_images(sources, target_img_size, return_originals):
+    results = []
+    for source in sources:
+        original = _decode_image(source)
+        img = imresize(original, target_img_size + (3,))
+        results.append((original, img) if return_originals else img)
+    return results
+
+
+def load_images(sources, target_img_size, count=None, workers=None, originals_path=None, chunk_size=16, progress_interval=10.):
+    """
+    Decode and resize images with a process pool. The sources are read lazily and only a limited amount of images is
+    processed at once, so the sources may be a stream (e.g. the members of an archive).
+
+    If an originals path is given, then the decoded (and cropped) original images are stored there (if they do not
+    exist yet) and later calls only have to resize them (e.g. for another target size). The caller has to make sure the
+    path identifies the sources (e.g. by using get_cache_key): If the originals exist, the sources are not read at all.
+    :param sources: An iterable of file paths or of the content (bytes) of image files; a source may also be a tuple
+    (source, (x, y, width, height)) to crop the decoded image before it is resized
+    :param target_img_size: The target size (height, width); all images are converted to RGB
+    :param count: The amount of sources (only used for the progress output; if None, len(sources) is used if possible)
+    :param workers: The amount of worker processes (None: The amount of CPUs, 1: Decode in the calling process)
+    :param originals_path: The path (without file extension) of the decoded originals or None
+    :param chunk_size: The amount of images that is processed at once by a worker
+    :param progress_interval: The amount of seconds between two progress outputs
+    :return: A generator for the (height, width, 3) uint8 images (in the same order as the sources)
+    """
+    target_img_size = tuple(target_img_size)
+    use_originals = originals_path is not None and decoded_originals_exist(originals_path)
+    write_originals = originals_path is not None and not use_originals
+    if use_originals:
+        print("Use the decoded originals: {}".format(originals_path))
+        with open(originals_path + _ORIGINALS_INDEX_SUFFIX, 'rb') as fh:
+            count = len(pickle.load(fh))
+        sources = range(count)
+    elif count is None and hasattr(sources, '__len__'):
+        count = len(sources)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def chunks():
+        chunk = []
+        for source in sources:
+            chunk.append(source)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    originals_writer = _DecodedOriginalsWriter(originals_path) if write_originals else None
+    pool = None
+    t_start = time()
+    try:
+        if workers > 1:
+
+            # Keep only a few chunks per worker in flight (this limits the memory usage if the sources are a stream)
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(originals_path if use_originals else None,))
+            pending = deque()
+            chunk_iterator = chunks()
+
+            def submit_chunk():
+                chunk = next(chunk_iterator, None)
+                if chunk is not None:
+                    pending.append(pool.apply_async(_load_images, (chunk, target_img_size, write_originals)))
+
+            for i in range(4 * workers):
+                submit_chunk()
+
+            def results():
+                while len(pending) > 0:
+                    chunk_results = pending.popleft().get()
+                    submit_chunk()
+                    yield from chunk_results
+        else:
+            _init_worker(originals_path if use_originals else None)
+
+            def results():
+                for chunk in chunks():
+                    yield from _load_images(chunk, target_img_size, write_originals)
+
+        t_last_output = t_start
+        loaded = 0
+        for result in results():
+            if write_originals:
+                original, img = result
+                originals_writer.add(original)
+            else:
+                img = result
+            yield img
+            loaded += 1
+
+            t_now = time()
+            if t_now - t_last_output >= progress_interval:
+                t_last_output = t_now
+                print("Loaded {}{} images ({:.1f} images/s)".format(
+                    loaded, '' if count is None else ' of {}'.format(count), loaded / (t_now - t_start)
+                ))
+        print("Loaded {} images in {:.1f}s".format(loaded, time() - t_start))
+
+        if originals_writer is not None:
+            originals_writer.close()
+            originals_writer = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if originals_writer is not None:
+            originals_writer.abort()
+
+
+class _DecodedOriginalsWriter:
+    """
+    Write the decoded originals (see load_images). Like the ClassGroupedImageStoreWriter, temporary files are written
+    and renamed by close (the index is renamed last).
+    """
+    def __init__(self, originals_path):
+        self.__originals_path = originals_path
+        self.__entries = []
+        self.__offset = 0
+        dirname = os.path.dirname(originals_path)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.__fh = open(originals_path + _ORIGINALS_DATA_SUFFIX + _TMP_SUFFIX, 'wb')
+
+    def add(self, img):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        self.__entries.append((self.__offset, img.shape))
+        self.__fh.write(img.tobytes())
+        self.__offset += img.size
+
+    def close(self):
+        self.__fh.close()
+        with open(self.__originals_path + _ORIGINALS_INDEX_SUFFIX + _TMP_SUFFIX, 'wb') as fh:
+            pickle.dump(self.__entries, fh, protocol=4)
+        os.replace(self.__originals_path + _ORIGINALS_DATA_SUFFIX + _TMP_SUFFIX, self.__originals_path + _ORIGINALS_DATA_SUFFIX)
+        os.replace(self.__originals_path + _ORIGINALS_INDEX_SUFFIX + _TMP_SUFFIX, self.__originals_path + _ORIGINALS_INDEX_SUFFIX)
+
+    def abort(self):
+        self.__fh.close()
+        for suffix in [_ORIGINALS_DATA_SUFFIX, _ORIGINALS_INDEX_SUFFIX]:
+            if os.path.exists(self.__originals_path + suffix + _TMP_SUFFIX):
+                os.remove(self.__originals_path + suffix + _TMP_SUFFIX)
+
+
+def build_split_image_stores(store_paths, sources, labels, split_indices, target_img_size, workers=None):
+    """
+    Decode and resize the images of a dataset that is split into several parts (e.g. train and test) and store each
+    part in a class grouped image store. The sources may come in any order (e.g. the order of an archive): Each
+    source has a position (the index in the labels). The resized images are collected in memory before the stores are
+    written.
+    :param store_paths: The store path of each part
+    :param sources: An iterable of (position, source) tuples (see load_images for the sources)
+    :param labels: The (N,) class labels
+    :param split_indices: The positions of each part
+    :param target_img_size: The target size (height, width)
+    :param workers: The amount of worker processes (see load_images)
+    """
+    target_img_size = tuple(target_img_size)
+    labels = np.asarray(labels)
+    x = np.zeros((labels.shape[0],) + target_img_size + (3,), dtype=np.uint8)
+    loaded = np.zeros((labels.shape[0],), dtype=np.bool_)
+
+    # The images are returned in the order of the sources
+    positions = []
+    def image_sources():
+        for position, source in sources:
+            positions.append(position)
+            yield source
+
+    for i, img in enumerate(load_images(image_sources(), target_img_size, count=labels.shape[0], workers=workers)):
+        x[positions[i]] = img
+        loaded[positions[i]] = True
+    if not np.all(loaded):
+        raise Exception("{} of {} images were not found".format(np.sum(~loaded), labels.shape[0]))
+
+    for store_path, indices in zip(store_paths, split_indices):
+        ClassGroupedImageStore.create(store_path, x[indices], labels[indices])
@@ -1,43 +1,93 @@
-import gzip
 import os
-import tarfile
 import itertools
 import glob
-import pickle
-import gzip
-import gc
 
-import shutil
+import numpy as np
 
-from scipy.io import loadmat
-from scipy.misc import imread, imresize
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore, ClassGroupedImageStoreWriter
+from impl.data.misc.image_dataset_builder import IMAGE_PREPROCESSING, get_files_fingerprint, get_cache_key, load_images
 
-from keras.utils.data_utils import get_file
-import numpy as np
+DEFAULT_EXTENSIONS = ['.jpg', '.png', '.JPEG', '.jpeg']
 
-def load_data(top_dir, dataset_name=None, target_img_size=(48, 48), extensions=['.jpg', '.png', '.JPEG', '.jpeg'], disable_cache_file=False):
+def load_data(top_dir, dataset_name=None, target_img_size=(48, 48), extensions=DEFAULT_EXTENSIONS, disable_cache_file=False,
+              workers=None, keep_decoded_originals=False):
     """Loads a simple class based dataset from a directory structure like:
     top_dir/class_name/img.(jpg|png|JPEG)
 
-    If a dataset-name is provided, the loaded images will be cached.
+    The images are decoded and resized by a process pool (see impl.data.misc.image_dataset_builder).
+
+    If a dataset-name is provided, the loaded images will be cached in a class grouped image store (see
+    load_data_store).
 
     # Returns
-        Tuple of Numpy arrays: `(x_train, y_train)`.
+        Tuple of Numpy arrays: `(x_train, y_train)`. x_train contains uint8 images (memory-mapped if the cache is
+        used) and y_train the class indices.
     """
+    if dataset_name is not None and not disable_cache_file:
+        return load_data_store(
+            top_dir, dataset_name, target_img_size, extensions, workers=workers, keep_decoded_originals=keep_decoded_originals
+        ).get_records()
+
     print("Use the simple class based dataset loader to load the dataset '{}' from the source directory '{}'...".format(dataset_name, top_dir))
-    if dataset_name is not None:
-        dirname = os.path.expanduser(os.path.join('~', '.keras', 'datasets', 'simple_ds', dataset_name))
+    target_img_size = tuple(target_img_size)
+    img_files, y_train = __find_image_files(top_dir, extensions)
+
+    # Load the images without a cache
+    x_train = np.zeros((len(img_files),) + target_img_size + (3,), dtype=np.uint8)
+    for i, img in enumerate(load_images(img_files, target_img_size, workers=workers)):
+        x_train[i] = img
+    return (x_train, y_train)
 
-        cached_file = os.path.join(dirname, 'img_{}x{}.cache.pkl.gz'.format(*target_img_size))
-        if os.path.exists(cached_file) and not disable_cache_file:
 
-            # The cache-file exists. Read it and return its content.
-            print("Found cache file: {}".format(cached_file))
-            with gzip.open(cached_file, "rb") as fh:
-                (x_train, y_train) = pickle.load(fh)
-                return (x_train, y_train)
+def load_data_store(top_dir, dataset_name, target_img_size=(48, 48), extensions=DEFAULT_EXTENSIONS, workers=None,
+                    keep_decoded_originals=False, cache_dir=None):
+    """Like load_data, but the class grouped image store that caches the dataset is returned (it is created if it does
+    not exist yet). The classes of the store are the class indices.
 
-    # Loading from the cache did not work: Load the dataset (and cache it if a name was defined)
+    The cache key contains a fingerprint of the source files (names, sizes and modification times), the target size and
+    the pre-processing: If the source directory changes, a new cache is created. If keep_decoded_originals is set, then
+    also the decoded original images are cached and other target sizes only have to resize them.
+
+    # Arguments
+        cache_dir: The directory that contains the caches of all datasets (default: ~/.keras/datasets/simple_ds)
+
+    # Returns
+        The ClassGroupedImageStore with the uint8 images.
+    """
+    print("Use the simple class based dataset loader to load the dataset '{}' from the source directory '{}'...".format(dataset_name, top_dir))
+    target_img_size = tuple(target_img_size)
+    img_files, y_train = __find_image_files(top_dir, extensions)
+
+    if cache_dir is None:
+        cache_dir = os.path.join('~', '.keras', 'datasets', 'simple_ds')
+    dirname = os.path.expanduser(os.path.join(cache_dir, dataset_name))
+    fingerprint = get_files_fingerprint(img_files, top_dir)
+    cache_path = os.path.join(dirname, 'img_{}x{}_{}'.format(
+        target_img_size[0], target_img_size[1], get_cache_key(fingerprint, target_img_size, IMAGE_PREPROCESSING)
+    ))
+    if not ClassGroupedImageStore.exists(cache_path):
+
+        # The originals do not depend on the target size: They can be shared
+        originals_path = None
+        if keep_decoded_originals:
+            originals_path = os.path.join(dirname, 'originals_{}'.format(get_cache_key(fingerprint, IMAGE_PREPROCESSING)))
+
+        print("Create the cache: {}".format(cache_path))
+        with ClassGroupedImageStoreWriter(cache_path, target_img_size + (3,)) as writer:
+            for i, img in enumerate(load_images(img_files, target_img_size, workers=workers, originals_path=originals_path)):
+                writer.add(int(y_train[i]), img[np.newaxis])
+    else:
+        print("Found cache: {}".format(cache_path))
+
+    print("Successfully loaded the dataset '{}' from the directory '{}'".format(dataset_name, top_dir))
+    return ClassGroupedImageStore(cache_path)
+
+
+def __find_image_files(top_dir, extensions):
+    """
+    Find all image files (classes without files are ignored).
+    :return: The image files (class by class) and the class index of each file
+    """
 
     # Find all class names (=subdirectories)
     def get_immediate_subdirectories(a_dir):
@@ -46,63 +96,18 @@ def load_data(top_dir, dataset_name=None, target_img_size=(48, 48), extensions=[
                 if os.path.isdir(os.path.join(a_dir, name))]
     classes = get_immediate_subdirectories(top_dir)
 
-    # Load all objects
-    dataset = {}
-    tot_files_loaded = 0
+    class_files = []
     for class_name in sorted(classes):
-        objects = []
-
-        # Find all files
         img_files = sorted(itertools.chain(*[
             glob.glob(os.path.join(top_dir, class_name, '*{}'.format(extension))) for extension in extensions
         ]))
-
-        # Load and resize the files
-        for img_file in img_files:
-            print("Read and pre-process image file (already loaded {} files): {}".format(tot_files_loaded, img_file))
-            img = imread(img_file, mode='RGB')
-            img = imresize(img, target_img_size + (3,))
-            objects.append(img)
-            tot_files_loaded += 1
-
-        if len(objects) > 0:
-            dataset[class_name] = objects
-
-    # Force the GC to do a cleanup
-    print("Memory cleanup...")
-    gc.collect()
-
-    # Create now the resulting arrays
-    print("Create the resulting numpy arrays with all data records...")
-    records = sum(map(lambda l: len(l), dataset.values()))
-    x_train = np.zeros((records,) + target_img_size + (3,), dtype=np.float32)
-    y_train = np.zeros((records,), dtype=np.float32)
-    class_names = sorted(dataset.keys())
-    i = 0
-    for c_i in range(len(class_names)):
-        objects = dataset[class_names[c_i]]
-        for object in objects:
-            x_train[i] = object
-            y_train[i] = c_i
-            i += 1
-
-    # Cleanup the memory again
-    print("Memory cleanup...")
-    del dataset
-    gc.collect()
-
-    # Cache these records (if possible)
-    if dataset_name != None and not disable_cache_file:
-        print("Save the created dataset to a cache file: {}".format(cached_file))
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with gzip.open(cached_file, "wb", compresslevel=6) as fh:
-            pickle.dump((x_train, y_train), fh, protocol=4)
-
-    print("Successfully loaded the dataset '{}' from the directory '{}'".format(dataset_name, top_dir))
-    return (x_train, y_train)
+        if len(img_files) > 0:
+            class_files.append(img_files)
+    img_files = list(itertools.chain(*class_files))
+    y_train = np.repeat(np.arange(len(class_files), dtype=np.int32), [len(files) for files in class_files])
+    print("Found {} image files of {} classes".format(len(img_files), len(class_files)))
+    return img_files, y_train
 
 
 if __name__ == '__main__':
     load_data()
-
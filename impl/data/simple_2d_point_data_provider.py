@@ -1,5 +1,5 @@
 from os import path
-import random
+from random import Random
 
 import matplotlib.pyplot as plt
 
@@ -14,6 +14,7 @@ from impl.data.misc.extended_data_gen_2d import ExtendedDataGen2d
 class Simple2DPointDataProvider(DataProvider):
     def __init__(self, min_cluster_count=2, max_cluster_count=10, allow_less_clusters=False, use_extended_data_gen=False, sigma=None):
         super().__init__()
+        self.__rand = Random()
         self.normalize_values = False
         self._dg = DataGen2dv02() if sigma is None else DataGen2dv02(default_sigma=sigma)
         self._edg = ExtendedDataGen2d(self._dg)
@@ -22,6 +23,12 @@ class Simple2DPointDataProvider(DataProvider):
         self._allow_less_clusters = allow_less_clusters
         self._use_extended_data_gen = use_extended_data_gen
 
+    def reseed(self, seed):
+        super().reseed(seed)
+        self.__rand.seed(seed)
+        self._dg.reseed(seed)
+        self._edg.reseed(seed)
+
     def get_min_cluster_count(self):
         return self._min_cluster_count
 
@@ -38,7 +45,7 @@ class Simple2DPointDataProvider(DataProvider):
 
             # Use the extended data generator
             if cluster_count is None:
-                cluster_count = random.randint(self._min_cluster_count, self._max_cluster_count)
+                cluster_count = self.__rand.randint(self._min_cluster_count, self._max_cluster_count)
             clusters = self._edg.generate(cluster_count, element_count)
 
         else:
@@ -4,10 +4,11 @@ from keras.layers import Input, Concatenate, Reshape, Lambda
 from keras.models import Model
 import keras.backend as K
 
-from core.nn.helper import concat
+from core.nn.helper import concat, pairwise_squared_euclidean_distances
 
 
-def get_ddbc_loss_function(x_inputs, classification_inputs, alpha=1., beta=1., gamma=1., force_to_keras_tensors=True):
+def get_ddbc_loss_function(x_inputs, classification_inputs, alpha=1., beta=1., gamma=1., force_to_keras_tensors=True,
+                           vectorized=False):
     """
     A keras implementation of the loss function of the paper Deep Divergence-Based Clustering.
 
@@ -16,8 +17,12 @@ def get_ddbc_loss_function(x_inputs, classification_inputs, alpha=1., beta=1., g
     :param alpha: How much to weight d_{\mathrm{hid},\alpha}, default value is 1.0
     :param beta: How much to weight triu(AA^T)
     :param gamma: How much to weight d_{\mathrm{hid},m}, default value is 1.0
+    :param vectorized: Use get_ddbc_loss_function_vectorized (the graph size does not depend on the input count)
     :return: loss, d_{\mathrm{hid},\alpha}, triu(AA^T), d_{\mathrm{hid},m}
     """
+    if vectorized:
+        return get_ddbc_loss_function_vectorized(x_inputs, classification_inputs, alpha, beta, gamma)
+
     # x_inputs = [Input(x.shape[1:]) for i in range(x.shape[0])]
     s_inputs = classification_inputs #[Input(s.shape[1:]) for i in range(s.shape[0])]
 
@@ -165,3 +170,63 @@ def get_ddbc_loss_function(x_inputs, classification_inputs, alpha=1., beta=1., g
         d_m = to_keras_tensor(0. * loss + d_m)
 
     return loss, d_a, triuAAt, d_m
+
+
+def get_ddbc_loss_function_vectorized(x_inputs, classification_inputs, alpha=1., beta=1., gamma=1.):
+    """
+    The same as get_ddbc_loss_function, but all terms are calculated with batched tensor operations on the stacked
+    inputs instead of python lists of lists:
+    - The kernel matrix Km is calculated with one batched matrix product (see pairwise_squared_euclidean_distances)
+    - d_{\mathrm{hid},\alpha} and d_{\mathrm{hid},m} use the Gram matrix G = A^T Km A: The term of the clusters i and
+      j is G_ij / sqrt(G_ii G_jj) and the pairs i < j are selected with a mask
+    - triu(AA^T) is calculated as (|sum_q a_q|^2 - sum_q |a_q|^2) / 2, therefore no (N, N) matrix is required
+
+    :param x_inputs: A (B, N, D) tensor or all x inputs (a python array of (B, D) tensors)
+    :param classification_inputs: A (B, N, k) tensor or all classification inputs (a python array of (B, k) tensors)
+    :param alpha: How much to weight d_{\mathrm{hid},\alpha}, default value is 1.0
+    :param beta: How much to weight triu(AA^T)
+    :param gamma: How much to weight d_{\mathrm{hid},m}, default value is 1.0
+    :return: loss, d_{\mathrm{hid},\alpha}, triu(AA^T), d_{\mathrm{hid},m} (each of them is a (B, 1) keras tensor)
+    """
+    def stack(inputs):
+        if isinstance(inputs, list):
+            return Lambda(lambda x: K.stack(x, axis=1))(inputs)
+        return inputs
+    x = stack(x_inputs)
+    A = stack(classification_inputs)
+
+    # Store the number of clusters
+    k = K.int_shape(A)[2]
+
+    epsilon = 1e-5
+    d_sigma = 1.
+
+    def divergence(x):
+        A, Km = x
+
+        # G = A^T Km A: (B, k, k)
+        G = K.batch_dot(A, K.batch_dot(Km, A, axes=(2, 1)), axes=(1, 1))
+        G_diag = K.sum(G * np.eye(k, dtype=np.float32), axis=2)
+        denominator = K.sqrt(K.expand_dims(G_diag, 2) * K.expand_dims(G_diag, 1)) + epsilon
+        return K.expand_dims(K.sum(G / denominator * np.triu(np.ones((k, k), dtype=np.float32), 1), axis=(1, 2)) / k, 1)
+
+    # Build the K matrix (here we have to call it "Km", because K is already used for the keras backend
+    Km = Lambda(lambda x: K.exp(-pairwise_squared_euclidean_distances(x, x) / d_sigma ** 2))(x)
+
+    # Calculate d_{\mathram{hid},\alpha}
+    d_a = Lambda(divergence)([A, Km])
+
+    # Calculate triu(AA^T)
+    triuAAt = Lambda(lambda A: K.sum(
+        K.square(K.sum(A, axis=1)) - K.sum(K.square(A), axis=1), axis=1, keepdims=True
+    ) / 2)(A)
+
+    # Calculate all m_{q,i} values: exp(-|a_q - e_i|^2) = exp(-(|a_q|^2 - 2 a_qi + 1))
+    m_qi = Lambda(lambda A: K.exp(-(K.sum(K.square(A), axis=2, keepdims=True) - 2 * A + 1)))(A)
+
+    # Calculate d_{\mathram{hid},m}
+    d_m = Lambda(divergence)([m_qi, Km])
+
+    loss = Lambda(lambda x: alpha * x[0] + beta * x[1] + gamma * x[2])([d_a, triuAAt, d_m])
+
+    return loss, d_a, triuAAt, d_m
@@ -8,7 +8,9 @@ from keras.losses import binary_crossentropy
 import keras.backend as K
 
 from core.nn.cluster_nn import ClusterNN
-from core.nn.helper import filter_None, concat, concat_layer, create_weighted_binary_crossentropy, mean_confidence_interval
+from core.nn.helper import filter_None, concat, concat_layer, create_weighted_binary_crossentropy, mean_confidence_interval, \
+    cluster_indices_to_similarities, cluster_indices_to_similarities_tensor, slice_layer, pairwise_cluster_similarities_tensor, \
+    pairwise_comparisons_tensor, sample_pairs, sampled_pair_similarities_tensor, batch_gather_tensor
 
 
 class SimpleLossClusterNN_V02(ClusterNN):
@@ -40,6 +42,33 @@ class SimpleLossClusterNN_V02(ClusterNN):
         # Important: If such a loss function is defined then the class weights are ignored.
         self._similarities_loss_f = similarities_loss_f
 
+        # If label targets are used, then only the (B, N) cluster indices are fed as target for the similarities output
+        # (and all other outputs that require the similarities). The pair targets are then built inside the loss
+        # functions. This reduces the amount of target data from O(N^2) to O(N) per collection.
+        self._use_label_targets = False
+
+        # If the similarities are vectorized, then they are calculated with a few batched matrix products instead of
+        # O(N^2 * K) Dot layers (the result is the same)
+        self._vectorized_similarities = True
+
+        # If the auxiliary losses are vectorized, then the embedding comparison regularisations (and the losses of
+        # subclasses that support it, e.g. the center loss) are calculated on stacked (B, N, ...) tensors instead of
+        # building layers for each element / pair (the result is the same)
+        self._vectorized_auxiliary_losses = True
+
+        # If sampled pairs are used, then the similarities loss is only calculated for sampled_pairs pairs of each
+        # collection (instead of all N(N+1)/2 pairs). The sampling is stratified: About
+        # sampled_pairs_positive_fraction of the sampled pairs are in the same cluster. The pairs are reweighted, so
+        # the loss is an unbiased estimate of the loss over all pairs. The similarities target then contains the
+        # cluster indices, the sampled pairs and their weights. The auxiliary losses still use all pairs: If there are
+        # additional grouping similarity losses, then the similarities of all pairs are calculated for them.
+        self._sampled_pairs = None
+        self._sampled_pairs_positive_fraction = 0.5
+
+        # The random number generator for the sampled pairs: It is seeded from the network random number generator and
+        # reseeded with it (see _reseed), therefore the sampled pairs are reproducible
+        self.__pairs_rand = np.random.RandomState(self._rand.getrandbits(32))
+
     @property
     def use_cluster_count_loss(self):
         return self._use_cluster_count_loss
@@ -64,6 +93,48 @@ class SimpleLossClusterNN_V02(ClusterNN):
     def include_self_comparison(self, include_self_comparison):
         self._include_self_comparison = include_self_comparison
 
+    @property
+    def vectorized_similarities(self):
+        return self._vectorized_similarities
+
+    @vectorized_similarities.setter
+    def vectorized_similarities(self, vectorized_similarities):
+        self._vectorized_similarities = vectorized_similarities
+
+    @property
+    def vectorized_auxiliary_losses(self):
+        return self._vectorized_auxiliary_losses
+
+    @vectorized_auxiliary_losses.setter
+    def vectorized_auxiliary_losses(self, vectorized_auxiliary_losses):
+        self._vectorized_auxiliary_losses = vectorized_auxiliary_losses
+
+    @property
+    def use_label_targets(self):
+        return self._use_label_targets
+
+    @use_label_targets.setter
+    def use_label_targets(self, use_label_targets):
+        self._use_label_targets = use_label_targets
+
+    @property
+    def sampled_pairs(self):
+        return self._sampled_pairs
+
+    @sampled_pairs.setter
+    def sampled_pairs(self, sampled_pairs):
+        if sampled_pairs is not None and sampled_pairs <= 0:
+            raise ValueError("The amount of sampled pairs must be positive (or None to use all pairs)")
+        self._sampled_pairs = sampled_pairs
+
+    @property
+    def sampled_pairs_positive_fraction(self):
+        return self._sampled_pairs_positive_fraction
+
+    @sampled_pairs_positive_fraction.setter
+    def sampled_pairs_positive_fraction(self, sampled_pairs_positive_fraction):
+        self._sampled_pairs_positive_fraction = sampled_pairs_positive_fraction
+
     @property
     def weighted_classes(self):
         return self._weighted_classes
@@ -143,11 +214,26 @@ class SimpleLossClusterNN_V02(ClusterNN):
         self._additional_embedding_comparison_regularisations.append({
             'comparator_f': comparator_f, # comparator_f(e_i, e_j, cluster_i == cluster_j)
             'name': name,
-            'embeddings': embeddings, # The ymust be ordered!
+            'embeddings': embeddings, # The ymust be ordered! (a list or a stacked (B, N, D) tensor)
             'weight': weight,
         })
 
+    def __build_vectorized_comparisons_arrays(self, embeddings, comparator_f, weight):
+        n = self.input_count
+        if isinstance(embeddings, list):
+            assert n == len(embeddings)
+            embeddings = concat(embeddings, axis=1)
+        pair_count = n * (n + 1) // 2 if self._include_self_comparison else n * (n - 1) // 2
+
+        # The result has the same layout as the output of __build_comparisons_arrays: [cmp_eq, cmp_ne]
+        return Lambda(
+            lambda x: pairwise_comparisons_tensor(x, comparator_f, n, self._include_self_comparison) * weight,
+            output_shape=(2 * pair_count,)
+        )(embeddings)
+
     def __build_comparisons_arrays(self, embeddings, comparator_f, weight):
+        if not isinstance(embeddings, list):
+            embeddings = [slice_layer(embeddings, i) for i in range(self.input_count)]
         assert self.input_count == len(embeddings)
 
         cmp_eq = [] # All comparisons assuming the elements do equal
@@ -256,46 +342,99 @@ class SimpleLossClusterNN_V02(ClusterNN):
         self._register_plot(model_name, grouping_accuracy_plot, 'loss')
 
     def _build_y_data(self, inputs):
-        cluster_counts = self.data_provider.get_cluster_counts()
+        cluster_indices = np.asarray([
+            [ci for _, ci in inputs[c]['data']] for c in range(len(inputs))
+        ], dtype=np.int32).reshape((len(inputs), self.input_count))
+        cluster_counts = np.asarray([inputs[c]['cluster_count'] for c in range(len(inputs))], dtype=np.int32)
+        return self._build_y_data_from_cluster_indices(cluster_indices, cluster_counts)
 
-        # Create output arrays
-        if self.include_self_comparison:
-            similarities_output_length = self.input_count * (self.input_count + 1) // 2
-        else:
-            similarities_output_length = self.input_count * (self.input_count - 1) // 2
-        similarities_output = np.zeros((len(inputs), similarities_output_length), dtype=np.float32)
-        cluster_count = np.zeros((len(inputs), len(cluster_counts)))
-
-        for c in range(len(inputs)):
-            current_inputs = inputs[c]['data']
-            i = 0
-            for i_source in range(self.input_count):
-                ci_source = current_inputs[i_source][1]
-
-                # Should i_source be compared with itself?
-                if self._include_self_comparison:
-                    target_range = range(i_source, self.input_count)
-                else:
-                    target_range = range(i_source + 1, self.input_count)
+    def _reseed(self, seed):
+        super()._reseed(seed)
+        self.__pairs_rand.seed(seed % (2 ** 32))
 
-                for i_target in target_range:
-                    ci_target = current_inputs[i_target][1]
+    def _get_similarities_targets(self, cluster_indices):
+        """
+        Get the targets for the similarities output (and all other outputs that require the similarities).
+        :param cluster_indices: A (B, N) array with the cluster index of each element
+        :return: The cluster indices (if label targets are used), the (B, N + 3S) cluster indices, sampled pairs and
+        pair weights (if sampled pairs are used) or the (B, P) similarities
+        """
+        if self._sampled_pairs is not None:
+            i_source, i_target, weights = sample_pairs(
+                cluster_indices, self._sampled_pairs, self._include_self_comparison, self._sampled_pairs_positive_fraction,
+                rand=self.__pairs_rand
+            )
+            return np.concatenate([np.asarray(cluster_indices), i_source, i_target, weights], axis=1).astype(np.float32)
+        if self._use_label_targets:
+            return np.asarray(cluster_indices, dtype=np.float32)
+        return cluster_indices_to_similarities(cluster_indices, self._include_self_comparison)
 
-                    similarities_output[c][i] = ci_source == ci_target
-                    i += 1
+    def _similarities_targets_to_similarities(self, similarities_targets):
+        """
+        The inverse of _get_similarities_targets: Get the (B, P) similarities of all pairs.
+        """
+        if self._sampled_pairs is not None:
+            return cluster_indices_to_similarities(similarities_targets[:, :self.input_count], self._include_self_comparison)
+        if self._use_label_targets:
+            return cluster_indices_to_similarities(similarities_targets, self._include_self_comparison)
+        return similarities_targets
 
-            # # DEBUG:
-            # if inputs[c]['cluster_count'] != 10:
-            #     print(inputs[c])
+    def _split_sampled_pairs_targets(self, y_true):
+        """
+        Split the target tensor of the similarities output if sampled pairs are used.
+        :return: (cluster_indices, i_source, i_target, weights)
+        """
+        n = self.input_count
+        s = self._sampled_pairs
+        return y_true[:, :n], y_true[:, n:(n + s)], y_true[:, (n + s):(n + 2 * s)], y_true[:, (n + 2 * s):(n + 3 * s)]
 
-            cluster_count[c][inputs[c]['cluster_count'] - cluster_counts[0]] = 1.
+    def _sampled_pairs_targets_to_predictions(self, y_true, y_pred):
+        """
+        Calculate the predicted and the true similarities of the sampled pairs.
+        :param y_true: The (B, N + 3S) target of the similarities output
+        :param y_pred: The similarities output (see __build_sampled_similarities)
+        :return: The (B, S) true similarities, the (B, S) predicted similarities and the (B, S) pair weights
+        """
+        cluster_counts = self._get_cluster_counts()
+        n = self.input_count
+        k_max = max(cluster_counts)
+        cluster_indices, i_source, i_target, weights = self._split_sampled_pairs_targets(y_true)
+
+        softmax_dists = K.reshape(y_pred[:, :(n * len(cluster_counts) * k_max)], (-1, n, len(cluster_counts), k_max))
+        cluster_count_dist = y_pred[:, (n * len(cluster_counts) * k_max):]
+        similarities = sampled_pair_similarities_tensor(softmax_dists, cluster_count_dist, i_source, i_target)
+
+        cluster_indices = K.expand_dims(cluster_indices, 2)
+        targets = K.cast(K.equal(
+            batch_gather_tensor(cluster_indices, i_source), batch_gather_tensor(cluster_indices, i_target)
+        ), K.floatx())[:, :, 0]
+        return targets, similarities, weights
+
+    def _label_targets_to_similarities(self, y_true):
+        """
+        Convert the target tensor of the similarities output (or another output that requires the similarities) to the
+        similarities. This is only required if label targets are used.
+        """
+        if self._sampled_pairs is not None:
+            y_true = self._split_sampled_pairs_targets(y_true)[0]
+            return cluster_indices_to_similarities_tensor(y_true, self.input_count, self._include_self_comparison)
+        if self._use_label_targets:
+            return cluster_indices_to_similarities_tensor(y_true, self.input_count, self._include_self_comparison)
+        return y_true
+
+    def _build_y_data_from_cluster_indices(self, cluster_indices, cluster_counts, X=None):
+        cluster_count_values = self.data_provider.get_cluster_counts()
+        cluster_counts = np.asarray(cluster_counts)
+        similarities_output = self._get_similarities_targets(cluster_indices)
 
         y = {
             'similarities_output': similarities_output
         }
 
         # If there is more than one possible cluster count: Add the output for the cluster count
-        if len(cluster_counts) > 1:
+        if len(cluster_count_values) > 1:
+            cluster_count = np.zeros((len(cluster_counts), len(cluster_count_values)))
+            cluster_count[np.arange(len(cluster_counts)), cluster_counts - cluster_count_values[0]] = 1.
             y['cluster_count_output'] = cluster_count
 
         # If required: Add the additional similarity losses
@@ -304,21 +443,15 @@ class SimpleLossClusterNN_V02(ClusterNN):
 
         # If required: Add regularisations. They are also losses, but they do not use a "true" value; it is ignored
         for additional_regularisation in self._additional_regularisations:
-            y[additional_regularisation['name']] = np.zeros((len(inputs), 1), dtype=np.float32)
+            y[additional_regularisation['name']] = np.zeros((len(cluster_counts), 1), dtype=np.float32)
 
         # If required add additional embedding comparison regularisations. They require the similarities output
         for additional_embedding_comparison_regularisation in self._additional_embedding_comparison_regularisations:
             y[additional_embedding_comparison_regularisation['name']] = similarities_output
 
-        # # DEBUG output
-        # c0 = np.    sum(similarities_output == 0)
-        # c1 = np.sum(similarities_output == 1)
-        # print("\nPrepared y data. Percentage of 0: {}; Percentage of 1: {}; Total values: {}".format(c0 / (c0 + c1), c1 / (c0 + c1), c0 + c1))
-
         return y
 
     def _build_loss_network(self, network_output, loss_output, additional_network_outputs):
-        cluster_counts = self._get_cluster_counts()
 
         # Network output is a list of softmax distributions:
         # First in this list are all softmax distributions for the input i with first the softmax for k_min clusters,
@@ -331,8 +464,98 @@ class SimpleLossClusterNN_V02(ClusterNN):
             :param k: The assumed cluster count.
             :return: The softmax distribution.
             """
+            if 'clusters' not in additional_network_outputs:
+
+                # Packed networks only have stacked (B, N, k) outputs
+                return self._s_layer(
+                    'softmax_slice_{}_{}'.format(k, i_object),
+                    lambda name: slice_layer(additional_network_outputs['clusters_stacked']['cluster{}'.format(k)], i_object, name)
+                )
             return additional_network_outputs['clusters']['input{}'.format(i_object)]['cluster{}'.format(k)]
 
+        n_cluster_output = additional_network_outputs['cluster_count_output']
+        if self._sampled_pairs is not None:
+            similarities_output = self.__build_sampled_similarities(get_softmax_dist, n_cluster_output, additional_network_outputs)
+        elif self._vectorized_similarities:
+            similarities_output = self.__build_vectorized_similarities(get_softmax_dist, n_cluster_output, additional_network_outputs)
+        else:
+            similarities_output = self.__build_similarities(get_softmax_dist, n_cluster_output)
+        loss_output.append(similarities_output)
+
+        # The output of the sampled pairs only contains the softmax distributions: The additional grouping similarity
+        # losses get the similarities of all pairs
+        grouping_similarities = similarities_output
+        if self._sampled_pairs is not None and len(self._additional_grouping_similarity_losses) > 0:
+            grouping_similarities = self.__build_vectorized_similarities(
+                get_softmax_dist, n_cluster_output, additional_network_outputs, name='all_pairs_similarities'
+            )
+        self.__build_additional_loss_outputs(grouping_similarities, n_cluster_output, loss_output)
+
+        return True
+
+    def __build_vectorized_similarities(self, get_softmax_dist, n_cluster_output, additional_network_outputs, name='similarities_output'):
+        cluster_counts = self._get_cluster_counts()
+        n = self.input_count
+
+        pair_count = n * (n + 1) // 2 if self._include_self_comparison else n * (n - 1) // 2
+
+        # A shared assignment head has one (B, N, K, k_max) output: The masked values are 0, therefore the dot
+        # products can be calculated over all k_max values
+        if 'clusters_shared' in additional_network_outputs:
+            return self._s_layer(name, lambda name: Lambda(
+                lambda x: pairwise_cluster_similarities_tensor(
+                    [x[0][:, :, j] for j in range(len(cluster_counts))], x[1], n, self._include_self_comparison
+                ),
+                output_shape=(pair_count,),
+                name=name
+            ), format_name=False)([additional_network_outputs['clusters_shared'], n_cluster_output])
+
+        # Calculate all similarities at once (see pairwise_cluster_similarities_tensor)
+        softmax_dists = self.__get_stacked_softmax_dists(get_softmax_dist, additional_network_outputs)
+        return self._s_layer(name, lambda name: Lambda(
+            lambda x: pairwise_cluster_similarities_tensor(x[:-1], x[-1], n, self._include_self_comparison),
+            output_shape=(pair_count,),
+            name=name
+        ), format_name=False)(softmax_dists + [n_cluster_output])
+
+    def __get_stacked_softmax_dists(self, get_softmax_dist, additional_network_outputs):
+        """
+        Get a (B, N, k) tensor for each cluster count k.
+        """
+        cluster_counts = self._get_cluster_counts()
+        if 'clusters_stacked' in additional_network_outputs:
+            return [additional_network_outputs['clusters_stacked']['cluster{}'.format(k)] for k in cluster_counts]
+        return [
+            self._s_layer(
+                'softmax_stack_{}'.format(k), lambda name: concat_layer(axis=1, name=name, input_count=self.input_count)
+            )([get_softmax_dist(i, k) for i in range(self.input_count)]) for k in cluster_counts
+        ]
+
+    def __build_sampled_similarities(self, get_softmax_dist, n_cluster_output, additional_network_outputs):
+        cluster_counts = self._get_cluster_counts()
+        n = self.input_count
+        k_max = max(cluster_counts)
+
+        # The similarities of the sampled pairs can only be calculated in the loss function (the pairs are part of the
+        # target). Therefore this output contains the flattened (B, N, K, k_max) softmax distributions (padded with
+        # zeros) and the (B, K) cluster count distribution: O(N) values instead of O(N^2) similarities.
+        if 'clusters_shared' in additional_network_outputs:
+            softmax_dists = additional_network_outputs['clusters_shared']
+        else:
+            softmax_dists = Lambda(lambda x: K.stack([
+                K.concatenate([s] + [K.zeros_like(s[:, :, :1])] * (k_max - k), axis=2) for s, k in zip(x, cluster_counts)
+            ], axis=2), output_shape=(n, len(cluster_counts), k_max))(
+                self.__get_stacked_softmax_dists(get_softmax_dist, additional_network_outputs)
+            )
+        return self._s_layer('similarities_output', lambda name: Lambda(
+            lambda x: K.concatenate([K.batch_flatten(x[0]), x[1]], axis=1),
+            output_shape=(n * len(cluster_counts) * k_max + len(cluster_counts),),
+            name=name
+        ), format_name=False)([softmax_dists, n_cluster_output])
+
+    def __build_similarities(self, get_softmax_dist, n_cluster_output):
+        cluster_counts = self._get_cluster_counts()
+
         # Predefine some dot products which are required to compare softmax distributions
         k_dot_prod = {
             k: self._s_layer('softmax_dot_{}'.format(k), lambda name: Dot(axes=2, name=name)) for k in cluster_counts
@@ -343,7 +566,6 @@ class SimpleLossClusterNN_V02(ClusterNN):
         softmax_dot_concat = self._s_layer('softmax_dot_concat', lambda name: concat_layer(name=name, input_count=len(cluster_counts)))
         softmax_dot_concat_reshaper = self._s_layer('softmax_dot_concat_reshaper', lambda name: Reshape((len(cluster_counts),), name=name))
         cluster_attention = self._s_layer('cluster_attention', lambda name: Dot(axes=1, name=name))
-        n_cluster_output = additional_network_outputs['cluster_count_output']
         similarities = []
         for i_source in range(self.input_count):
 
@@ -372,8 +594,10 @@ class SimpleLossClusterNN_V02(ClusterNN):
 
         # Now all comparisons are stored in "similarities": Concate them and return the array
         # similarities_output = self._s_layer('similarities_output', lambda name: Concatenate(name=name), format_name=False)(similarities)
-        similarities_output = self._s_layer('similarities_output', lambda name: concat_layer(name=name, input_count=len(similarities)), format_name=False)(similarities)
-        loss_output.append(similarities_output)
+        return self._s_layer('similarities_output', lambda name: concat_layer(name=name, input_count=len(similarities)), format_name=False)(similarities)
+
+    def __build_additional_loss_outputs(self, similarities_output, n_cluster_output, loss_output):
+        cluster_counts = self._get_cluster_counts()
 
         # Also add the cluster count output, but only if there is more than one possible cluster count and only if it is not fixed
         if len(cluster_counts) > 1:
@@ -390,7 +614,11 @@ class SimpleLossClusterNN_V02(ClusterNN):
 
         # If required add additional embedding comparison regularisations
         for additional_embedding_comparison_regularisation in self._additional_embedding_comparison_regularisations:
-            comparisons = self.__build_comparisons_arrays(
+            if self._vectorized_auxiliary_losses:
+                build_comparisons_arrays = self.__build_vectorized_comparisons_arrays
+            else:
+                build_comparisons_arrays = self.__build_comparisons_arrays
+            comparisons = build_comparisons_arrays(
                 additional_embedding_comparison_regularisation['embeddings'],
                 additional_embedding_comparison_regularisation['comparator_f'],
                 additional_embedding_comparison_regularisation['weight']
@@ -400,8 +628,6 @@ class SimpleLossClusterNN_V02(ClusterNN):
                 name=additional_embedding_comparison_regularisation['name']
             )(comparisons))
 
-        return True
-
     def get_class_weights(self):
         if not self._weighted_classes:
             return None
@@ -469,7 +695,7 @@ class SimpleLossClusterNN_V02(ClusterNN):
             _, y = self._build_Xy_data(data)
 
             # Get the y-data and calculate the expected percentage of '0s' in the similarities output
-            similarities_output = y['similarities_output']
+            similarities_output = self._similarities_targets_to_similarities(y['similarities_output'])
             return [
                 np.mean(similarities_output[i]) for i in range(len(data))
             ]
@@ -518,6 +744,7 @@ class SimpleLossClusterNN_V02(ClusterNN):
         return w0, w1
 
     def _get_keras_loss(self):
+        class_weights = None
         if self._similarities_loss_f is not None:
             print("Use a custom similarities loss function")
             similarities_loss = self._similarities_loss_f
@@ -552,10 +779,37 @@ class SimpleLossClusterNN_V02(ClusterNN):
                 print("Normalized weights: w0={}, w1={}".format(w0, w1))
 
             print("Final calculated weights: w0={}, w1={}".format(w0, w1))
+            class_weights = (w0, w1)
             similarities_loss = create_weighted_binary_crossentropy(w0, w1)
         else:
             print("Use the standard non-weighted binary crossentropy loss")
             similarities_loss = binary_crossentropy # 'binary_crossentropy'
+
+        # The loss of the similarities of all pairs: It is used by the additional grouping similarity losses. If label
+        # targets or sampled pairs are used, then the pair targets are built from the cluster indices of the target.
+        def all_pairs_similarities_loss(y_true, y_pred, loss_f=similarities_loss):
+            return loss_f(self._label_targets_to_similarities(y_true), y_pred)
+
+        # If sampled pairs are used: The loss is only calculated for the sampled pairs and weighted with the pair
+        # weights. The class weights are applied to each pair. A custom loss function is applied to (B, S, 1) tensors,
+        # this means a loss function that calculates the mean over the last axis returns the (B, S) pair losses.
+        if self._sampled_pairs is not None:
+            def sampled_similarities_loss(y_true, y_pred, loss_f=self._similarities_loss_f):
+                targets, similarities, weights = self._sampled_pairs_targets_to_predictions(y_true, y_pred)
+                if loss_f is not None:
+                    pair_losses = loss_f(K.expand_dims(targets), K.expand_dims(similarities))
+                else:
+                    pair_losses = K.binary_crossentropy(targets, similarities)
+                    if class_weights is not None:
+                        pair_losses *= targets * class_weights[1] + (1. - targets) * class_weights[0]
+                return K.mean(weights * pair_losses, axis=-1)
+            similarities_loss = sampled_similarities_loss
+
+        # If label targets are used: The loss function receives the cluster indices and has to build the pair targets.
+        # Keras does not check the target shape for custom loss functions, therefore the (B, N) targets are ok.
+        elif self._use_label_targets:
+            similarities_loss = all_pairs_similarities_loss
+
         loss = {}
         if self._use_similarities_loss:
             loss['similarities_output'] = similarities_loss
@@ -570,9 +824,9 @@ class SimpleLossClusterNN_V02(ClusterNN):
             if weight is None:
                 weight = 1.0
             if additional_grouping_similarity_loss['calculate_org_similarity_loss']:
-                loss[name] = lambda y_true, y_pred, loss_f=loss_f: weight * loss_f(similarities_loss(y_true, y_pred))
+                loss[name] = lambda y_true, y_pred, loss_f=loss_f: weight * loss_f(all_pairs_similarities_loss(y_true, y_pred))
             else:
-                loss[name] = lambda y_true, y_pred, loss_f=loss_f: weight * loss_f(y_true, y_pred)
+                loss[name] = lambda y_true, y_pred, loss_f=loss_f: weight * loss_f(self._label_targets_to_similarities(y_true), y_pred)
 
         # Register all regularisations
         if len(self._additional_regularisations) > 0:
@@ -592,6 +846,7 @@ class SimpleLossClusterNN_V02(ClusterNN):
                 n = self.input_count * (self.input_count - 1) // 2
 
             def embedding_comparison_regularisation_loss(y_true, y_pred):
+                y_true = self._label_targets_to_similarities(y_true)
                 cmp_eq = y_pred[:, :n]
                 cmp_ne = y_pred[:, n:]
                 return K.mean(
@@ -607,6 +862,19 @@ class SimpleLossClusterNN_V02(ClusterNN):
         metrics = {
             'similarities_output': 'accuracy'
         }
+        if self._sampled_pairs is not None:
+
+            # The weighted accuracy of the sampled pairs (an unbiased estimate of the accuracy over all pairs)
+            def acc(y_true, y_pred):
+                targets, similarities, weights = self._sampled_pairs_targets_to_predictions(y_true, y_pred)
+                return K.mean(weights * K.cast(K.equal(targets, K.round(similarities)), K.floatx()), axis=-1)
+            metrics['similarities_output'] = acc
+        elif self._use_label_targets:
+
+            # The function name is used for the history key (similarities_output_acc)
+            def acc(y_true, y_pred):
+                return K.mean(K.equal(self._label_targets_to_similarities(y_true), K.round(y_pred)), axis=-1)
+            metrics['similarities_output'] = acc
         if len(self.data_provider.get_cluster_counts()) > 1:
             metrics['cluster_count_output'] = 'categorical_accuracy'
         return metrics
@@ -3,7 +3,8 @@ from keras.layers import Reshape, Concatenate, Bidirectional, LSTM, Dense, Batch
 
 import numpy as np
 
-from core.nn.helper import slice_layer, get_cluster_centers, get_cluster_cohesion, get_cluster_separation
+from core.nn.helper import slice_layer, get_cluster_centers_vectorized, get_cluster_cohesion_vectorized, \
+    get_cluster_separation_vectorized
 from impl.nn.base.simple_loss.simple_loss_cluster_nn import SimpleLossClusterNN
 
 class ClusterNNTry00_V04(SimpleLossClusterNN):
@@ -103,11 +104,11 @@ class ClusterNNTry00_V04(SimpleLossClusterNN):
 
             # Create evaluation metrics
             self._add_debug_output(Concatenate(axis=1)(cluster_classifiers[k]), 'eval_classifications_k{}'.format(k))
-            cluster_centers = get_cluster_centers(embeddings_reshaped, cluster_classifiers[k])
-            self._add_debug_output(Concatenate(axis=1)(cluster_centers), 'eval_cluster_centers_k{}'.format(k))
-            cohesion = get_cluster_cohesion(cluster_centers, embeddings_reshaped, cluster_classifiers[k])
+            cluster_centers = get_cluster_centers_vectorized(embeddings_reshaped, cluster_classifiers[k])
+            self._add_debug_output(cluster_centers, 'eval_cluster_centers_k{}'.format(k))
+            cohesion = get_cluster_cohesion_vectorized(cluster_centers, embeddings_reshaped, cluster_classifiers[k])
             self._add_debug_output(cohesion, 'eval_cohesion_k{}'.format(k))
-            separation = get_cluster_separation(cluster_centers, cluster_classifiers[k])
+            separation = get_cluster_separation_vectorized(cluster_centers, cluster_classifiers[k])
             self._add_debug_output(separation, 'eval_separation_k{}'.format(k))
 
             cluster_quality_loss = Lambda(lambda cohesion:
@@ -4,7 +4,8 @@ import keras.backend as K
 
 import numpy as np
 
-from core.nn.helper import slice_layer, get_cluster_centers, get_cluster_cohesion, get_cluster_separation
+from core.nn.helper import slice_layer, get_cluster_centers_vectorized, get_cluster_cohesion_vectorized, \
+    get_cluster_separation_vectorized
 from impl.nn.base.simple_loss.simple_loss_cluster_nn_v02 import SimpleLossClusterNN_V02
 
 class ClusterNNTry00_V06(SimpleLossClusterNN_V02):
@@ -113,15 +114,15 @@ class ClusterNNTry00_V06(SimpleLossClusterNN_V02):
 
             # Create evaluation metrics
             self._add_debug_output(Concatenate(axis=1)(cluster_classifiers[k]), 'eval_classifications_k{}'.format(k))
-            cluster_centers = get_cluster_centers(embeddings_reshaped, cluster_classifiers[k])
-            self._add_debug_output(Concatenate(axis=1)(cluster_centers), 'eval_cluster_centers_k{}'.format(k))
-            cohesion = get_cluster_cohesion(cluster_centers, embeddings_reshaped, cluster_classifiers[k])
+            cluster_centers = get_cluster_centers_vectorized(embeddings_reshaped, cluster_classifiers[k])
+            self._add_debug_output(cluster_centers, 'eval_cluster_centers_k{}'.format(k))
+            cohesion = get_cluster_cohesion_vectorized(cluster_centers, embeddings_reshaped, cluster_classifiers[k])
             self._add_debug_output(cohesion, 'eval_cohesion_k{}'.format(k))
-            separation = get_cluster_separation(cluster_centers, cluster_classifiers[k])
+            separation = get_cluster_separation_vectorized(cluster_centers, cluster_classifiers[k])
             self._add_debug_output(separation, 'eval_separation_k{}'.format(k))
 
             self._add_additional_prediction_output(
-                Concatenate(axis=1, name='cluster_centers_k{}'.format(k))(cluster_centers),
+                Activation('linear', name='cluster_centers_k{}'.format(k))(cluster_centers),
                 'cluster_centers_k{}'.format(k)
             )
 
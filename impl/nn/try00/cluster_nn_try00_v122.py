@@ -2,10 +2,12 @@ from keras.layers import Reshape, Concatenate, Bidirectional, Dense, BatchNormal
     Activation, Lambda, Add, CuDNNLSTM, Dropout
 from keras.layers.advanced_activations import LeakyReLU
 from keras.losses import mean_squared_error
+import keras.backend as K
 
 import numpy as np
 
-from core.nn.helper import slice_layer, lukic_kl_divergence, reweight_values, concat, ExtendedDropout
+from core.nn.helper import slice_layer, lukic_kl_divergence, reweight_values, reweight_values_vectorized, concat, \
+    ExtendedDropout, masked_cluster_softmax, MultiHeadAttention, LayerNormalization, InducingPoints
 from impl.nn.base.simple_loss.simple_loss_cluster_nn_v02 import SimpleLossClusterNN_V02
 
 from keras.layers import LSTM
@@ -16,9 +18,25 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
                  weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, internal_embedding_size=96,
                  kl_embedding_size=128, kl_divergence_factor=1.,
-                 simplified_center_loss_factor=1.):
+                 simplified_center_loss_factor=1., set_encoder='rbdlstm', set_encoder_heads=4, set_encoder_inducing_points=16,
+                 checkpoint_every_nth_block=None):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes, include_input_count_in_name=False)
 
+        # The set encoder processes all (internal) embeddings together. The block count is always lstm_layers:
+        # - rbdlstm: Residual bidirectional LSTM layers (sequential over the elements)
+        # - sab: Multi-head self-attention blocks (all elements are processed in parallel)
+        # - isab: Induced set attention blocks: The elements attend to set_encoder_inducing_points trainable points and
+        #   these points attend to the elements, this is linear instead of quadratic in the input count
+        if set_encoder not in ['rbdlstm', 'sab', 'isab']:
+            raise ValueError("Invalid set encoder: {}".format(set_encoder))
+        self.__set_encoder = set_encoder
+        self.__set_encoder_heads = set_encoder_heads
+        self.__set_encoder_inducing_points = set_encoder_inducing_points
+
+        # Gradient checkpointing for the set encoder: Only the input of every nth block is stored for the backward
+        # pass, the other activations are recomputed (None: store all activations)
+        self.__checkpoint_every_nth_block = checkpoint_every_nth_block
+
         self.__internal_embedding_size = internal_embedding_size
 
         # Network parameters
@@ -33,12 +51,22 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
         self.__kl_divergence_factor = kl_divergence_factor
         self.__simplified_center_loss_factor = simplified_center_loss_factor
 
+    def _supports_packed_input(self):
+        return True
+
+    def _supports_shared_assignment_head(self):
+        return True
+
     def _build_network(self, network_input, network_output, additional_network_outputs):
         cluster_counts = list(self.data_provider.get_cluster_counts())
 
         # The simple loss cluster NN requires a specific output: a list of softmax distributions
         # First in this list are all softmax distributions for k=k_min for each object, then for k=k_min+1 for each
         # object etc. At the end, there is the cluster count output.
+        # If the input is packed, then all elements are processed as one (B, N, ...) tensor and there is only one
+        # stacked softmax output for each k.
+        if self.packed_input_active:
+            return self.__build_packed_network(network_input, network_output, additional_network_outputs)
 
         # First we get an embedding for the network inputs
         embeddings = self._get_embedding(network_input)
@@ -78,15 +106,8 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
         # Merge all embeddings to one tensor
         embeddings_merged = self._s_layer('embeddings_merge', lambda name: Concatenate(axis=1, name=name))(embeddings_reshaped)
 
-        # Use now some lstm-layers
-        processed = embeddings_merged
-        second_last_processed = None
-        for i in range(self.__lstm_layers):
-            second_last_processed = processed
-            tmp = self._s_layer(
-                'LSTM_proc_{}'.format(i), lambda name: Bidirectional(LSTM(internal_embedding_size // 2, return_sequences=True), name=name)
-            )(processed)
-            processed = Add()([processed, tmp])
+        # Use now the set encoder (by default some lstm-layers)
+        processed, second_last_processed = self.__build_set_encoder(embeddings_merged, internal_embedding_size)
 
         # Split the tensor to seperate layers
         embeddings_processed = [self._s_layer('slice_{}'.format(i), lambda name: slice_layer(processed, i, name)) for i in range(len(network_input))]
@@ -94,6 +115,8 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
         # Implement the simplified center loss
         center_loss_vectors = embeddings_processed
         def simple_center_loss(y_true, y_pred):
+            if self.vectorized_auxiliary_losses:
+                return self.__vectorized_simple_center_loss(processed, y_true)
 
             # y_true has no fixed shape, but we require that the second dimension size is already known. Reshape it.
             n = self.input_count
@@ -158,8 +181,171 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
                 network_output.append(output_classifier)
 
         # Calculate the real cluster count
+        self.__build_cluster_count_output(second_last_processed, cluster_counts, network_output, additional_network_outputs)
+
+        return True
+
+    def __build_packed_network(self, network_input, network_output, additional_network_outputs):
+        cluster_counts = list(self.data_provider.get_cluster_counts())
+        n = self.input_count
+
+        # Get the embeddings for the whole set at once and reshape them to a (B, N, embedding_size) tensor. All layers
+        # with weights are the same as in the unpacked network.
+        embeddings = self._get_packed_embedding(network_input)
+        embedding_size = int(np.prod(embeddings._keras_shape[2:]))
+        embeddings_reshaped = self._s_layer('embedding_reshape_packed', lambda name: Reshape((n, embedding_size), name=name))(embeddings)
+
+        # The KL-divergence only makes sense if an embedding is used (otherwise no embedding can be optimized)
+        if self._uses_embedding_layer() and self.__kl_divergence_factor > 0.:
+            kl_dense0 = self._s_layer('kl_dense0', lambda name: LeakyReLU(self.__kl_embedding_size, name=name))
+            kl_softmax = self._s_layer('kl_softmax', lambda name: Dense(self.__kl_embedding_size, name=name, activation='softmax'))
+            kl_embeddings = kl_softmax(kl_dense0(embeddings_reshaped))
+            if not self.vectorized_auxiliary_losses:
+                kl_embeddings = [self._s_layer('kl_slice_{}'.format(i), lambda name: slice_layer(kl_embeddings, i, name)) for i in range(n)]
+            self._register_additional_embedding_comparison_regularisation(
+                'KL_divergence',
+                lukic_kl_divergence,
+                kl_embeddings,
+                weight=self.__kl_divergence_factor
+            )
+
+        # Resize the embeddings to the internal representation
+        internal_embedding_size = self.__internal_embedding_size // 2 * 2
+        embedding_internal_resizer = self._s_layer('internal_embedding_resize', lambda name: Dense(internal_embedding_size, name=name))
+        processed = LeakyReLU()(embedding_internal_resizer(embeddings_reshaped))
+
+        # Use now the set encoder (by default some lstm-layers)
+        processed, second_last_processed = self.__build_set_encoder(processed, internal_embedding_size)
+
+        # Implement the simplified center loss (the non-vectorized version requires a tensor for each element)
+        if self.__simplified_center_loss_factor > 0.:
+            if not self.vectorized_auxiliary_losses:
+                center_loss_vectors = [self._s_layer('slice_{}'.format(i), lambda name: slice_layer(processed, i, name)) for i in range(n)]
+            def simple_center_loss(y_true, y_pred):
+                if self.vectorized_auxiliary_losses:
+                    return self.__vectorized_simple_center_loss(processed, y_true)
+                if self.include_self_comparison:
+                    y_len = n * (n + 1) // 2
+                else:
+                    y_len = n * (n - 1) // 2
+                y_true = Lambda(lambda x: y_true)(center_loss_vectors[0])
+                y_true = Reshape((y_len,))(y_true)
+                centers = reweight_values(center_loss_vectors, y_true)
+                return mean_squared_error(
+                    concat(centers, axis=1),
+                    concat(center_loss_vectors, axis=1)
+                )
+            self._register_additional_grouping_similarity_loss(
+                'simple_center_loss', simple_center_loss, False, weight=self.__simplified_center_loss_factor
+            )
+
+        # The output layers work on the last axis, therefore they can be applied to all elements at once. Only the
+        # batch normalization differs from the unpacked network while training: It uses the statistics of all elements
+        # instead of the statistics of each element. The layer names are the same as in the unpacked network (so the
+        # weights are compatible): The batch normalization and the activation are shared over all output dense layers.
+        embedding_proc = processed
+        for i in range(self.__output_dense_layers):
+            embedding_proc = self._s_layer('output_dense{}'.format(i), lambda name: Dense(self.__output_dense_units, name=name))(embedding_proc)
+            embedding_proc = self._s_layer('output_batch', lambda name: BatchNormalization(name=name))(embedding_proc)
+            embedding_proc = LeakyReLU()(embedding_proc)
+            embedding_proc = self._s_layer('output_relu', lambda name: Activation(LeakyReLU(), name=name))(embedding_proc)
+            embedding_proc = Dropout(0.5)(embedding_proc)
+
+            # Add forward pass dropout
+            if self._try_get_additional_build_config_value('forward_pass_dropout', default_value=False):
+                embedding_proc = ExtendedDropout(0.5, train_phase_active=False, test_phase_active=True)(embedding_proc)
+
+        # Create a (B, N, k) softmax output for each cluster count
+        clusters_output = additional_network_outputs['clusters_stacked'] = {}
+        if self.shared_assignment_head_active:
+            self.__build_shared_assignment_head(embedding_proc, cluster_counts, network_output, additional_network_outputs)
+        else:
+
+            # Register the heads for the two-phase prediction: They only depend on embedding_proc
+            assignment_heads = additional_network_outputs['assignment_heads'] = {}
+            additional_network_outputs['assignment_trunk'] = embedding_proc
+            for k in cluster_counts:
+                assignment_heads[k] = self._s_layer(
+                    'softmax_cluster_{}'.format(k), lambda name: Dense(k, activation='softmax', name=name)
+                )
+                output_classifier = assignment_heads[k](embedding_proc)
+                clusters_output['cluster{}'.format(k)] = output_classifier
+                network_output.append(output_classifier)
+
+        # Calculate the real cluster count
+        self.__build_cluster_count_output(second_last_processed, cluster_counts, network_output, additional_network_outputs)
+
+        return True
+
+    def __build_shared_assignment_head(self, embedding_proc, cluster_counts, network_output, additional_network_outputs):
+        # All cluster counts share one (B, N, k_max) logit tensor; the distribution for k clusters is the softmax of
+        # the first k logits. The network has then only one (B, N, K, k_max) assignment output.
+        k_max = max(cluster_counts)
+        logits = self._s_layer('assignment_logits', lambda name: Dense(k_max, name=name))(embedding_proc)
+        clusters_shared = self._s_layer('softmax_clusters_shared', lambda name: Lambda(
+            lambda x: masked_cluster_softmax(x, cluster_counts),
+            output_shape=(self.input_count, len(cluster_counts), k_max),
+            name=name
+        ))(logits)
+        additional_network_outputs['clusters_shared'] = clusters_shared
+        network_output.append(clusters_shared)
+
+        # Views for the loss network: A (B, N, k) tensor for each cluster count
+        for j, k in enumerate(cluster_counts):
+            additional_network_outputs['clusters_stacked']['cluster{}'.format(k)] = self._s_layer(
+                'softmax_cluster_{}_view'.format(k), lambda name: Lambda(lambda x, j=j, k=k: x[:, :, j, :k], output_shape=(self.input_count, k), name=name)
+            )(clusters_shared)
+
+    def __build_set_encoder(self, processed, internal_embedding_size):
+        """
+        Process all elements of the set together.
+        :param processed: The (B, N, internal_embedding_size) internal embeddings
+        :param internal_embedding_size: The internal embedding size
+        :return: The (B, N, internal_embedding_size) output of the last block and the input of the last block (it is
+        used for the cluster count output)
+        """
+        def block_f(i, processed):
+            if self.__set_encoder == 'rbdlstm':
+                tmp = self._s_layer(
+                    'LSTM_proc_{}'.format(i), lambda name: Bidirectional(LSTM(internal_embedding_size // 2, return_sequences=True), name=name)
+                )(processed)
+                return Add()([processed, tmp])
+            elif self.__set_encoder == 'sab':
+                return self.__build_attention_block('SAB_proc_{}'.format(i), processed, processed, internal_embedding_size)
+            else:
+                inducing_points = self._s_layer(
+                    'ISAB_proc_{}_inducing_points'.format(i),
+                    lambda name: InducingPoints(self.__set_encoder_inducing_points, internal_embedding_size, name=name)
+                )(processed)
+                tmp = self.__build_attention_block('ISAB_proc_{}_0'.format(i), inducing_points, processed, internal_embedding_size)
+                return self.__build_attention_block('ISAB_proc_{}_1'.format(i), processed, tmp, internal_embedding_size)
+        return self._build_checkpointed_blocks(processed, self.__lstm_layers, block_f, self.__checkpoint_every_nth_block)
+
+    def __build_attention_block(self, name, x, y, units):
+        """
+        A multihead attention block (see https://arxiv.org/pdf/1810.00825.pdf): x attends to y, then a dense layer is
+        applied to each element. Both steps have a residual connection and a layer normalization.
+        """
+        tmp = self._s_layer(
+            '{}_attention'.format(name), lambda name: MultiHeadAttention(units, heads=self.__set_encoder_heads, name=name)
+        )([x, y])
+        x = self._s_layer('{}_norm0'.format(name), lambda name: LayerNormalization(name=name))(Add()([x, tmp]))
+        tmp = self._s_layer('{}_dense'.format(name), lambda name: Dense(units, activation='relu', name=name))(x)
+        return self._s_layer('{}_norm1'.format(name), lambda name: LayerNormalization(name=name))(Add()([x, tmp]))
+
+    def __vectorized_simple_center_loss(self, processed, y_true):
+        # The same as the simplified center loss, but all centers are calculated with one batched matrix product on
+        # the (B, N, D) tensor (see reweight_values_vectorized)
+        n = self.input_count
+        if self.include_self_comparison:
+            y_len = n * (n + 1) // 2
+        else:
+            y_len = n * (n - 1) // 2
+        centers = reweight_values_vectorized(processed, K.reshape(y_true, (-1, y_len)))
+        return mean_squared_error(centers, processed)
+
+    def __build_cluster_count_output(self, cluster_count, cluster_counts, network_output, additional_network_outputs):
         assert self.__cluster_count_lstm_layers >= 1
-        cluster_count = second_last_processed
         for i in range(self.__cluster_count_lstm_layers - 1):
             cluster_count = self._s_layer('cluster_count_LSTM{}'.format(i), lambda name: Bidirectional(LSTM(self.__cluster_count_lstm_units, return_sequences=True), name=name)(cluster_count))
             cluster_count = self._s_layer('cluster_count_LSTM{}_batch'.format(i), lambda name: BatchNormalization(name=name))(cluster_count)
@@ -175,8 +361,6 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
             if self._try_get_additional_build_config_value('forward_pass_dropout', default_value=False):
                 cluster_count = ExtendedDropout(0.5, train_phase_active=False, test_phase_active=True)(cluster_count)
 
-            # cluster_count = self._s_layer('cluster_count_relu{}'.format(i), lambda name: Activation(LeakyReLU(), name=name))(cluster_count)
-
         # The next layer is an output-layer, therefore the name must not be formatted
         cluster_count = self._s_layer(
             'cluster_count_output',
@@ -186,5 +370,3 @@ class ClusterNNTry00_V122(SimpleLossClusterNN_V02):
         additional_network_outputs['cluster_count_output'] = cluster_count
 
         network_output.append(cluster_count)
-
-        return True
\ No newline at end of file
@@ -16,13 +16,15 @@ class ClusterNNTry00_V135(SimpleLossClusterNN_V02):
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
                  weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, internal_embedding_size=96,
                  kl_embedding_size=128, kl_divergence_factor=1.,
-                 simplified_center_loss_factor=1., cluster_assignment_regularization_factor=0.5, use_v02_cluster_assignment_loss=False):
+                 simplified_center_loss_factor=1., cluster_assignment_regularization_factor=0.5, use_v02_cluster_assignment_loss=False,
+                 vectorized_cluster_assignment_regularization=False, checkpoint_every_nth_block=None):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes, include_input_count_in_name=False)
 
         self.__internal_embedding_size = internal_embedding_size
 
         # Network parameters
         self.__lstm_layers = lstm_layers
+        self.__checkpoint_every_nth_block = checkpoint_every_nth_block # Gradient checkpointing for the lstm-layers
         self.__output_dense_units = output_dense_units
         self.__cluster_count_lstm_layers = cluster_count_lstm_layers
         self.__cluster_count_lstm_units = cluster_count_lstm_units
@@ -34,6 +36,7 @@ class ClusterNNTry00_V135(SimpleLossClusterNN_V02):
         self.__simplified_center_loss_factor = simplified_center_loss_factor
         self.__cluster_assignment_regularization_factor = cluster_assignment_regularization_factor
         self.__use_v02_cluster_assignment_loss = use_v02_cluster_assignment_loss
+        self.__vectorized_cluster_assignment_regularization = vectorized_cluster_assignment_regularization
 
     def _build_network(self, network_input, network_output, additional_network_outputs):
         cluster_counts = list(self.data_provider.get_cluster_counts())
@@ -80,15 +83,15 @@ class ClusterNNTry00_V135(SimpleLossClusterNN_V02):
         # Merge all embeddings to one tensor
         embeddings_merged = self._s_layer('embeddings_merge', lambda name: Concatenate(axis=1, name=name))(embeddings_reshaped)
 
-        # Use now some lstm-layers
-        processed = embeddings_merged
-        second_last_processed = None
-        for i in range(self.__lstm_layers):
-            second_last_processed = processed
+        # Use now some lstm-layers (if required: with gradient checkpointing)
+        def block_f(i, processed):
             tmp = self._s_layer(
                 'LSTM_proc_{}'.format(i), lambda name: Bidirectional(LSTM(internal_embedding_size // 2, return_sequences=True), name=name)
             )(processed)
-            processed = Add()([processed, tmp])
+            return Add()([processed, tmp])
+        processed, second_last_processed = self._build_checkpointed_blocks(
+            embeddings_merged, self.__lstm_layers, block_f, self.__checkpoint_every_nth_block
+        )
 
         # Split the tensor to seperate layers
         embeddings_processed = [self._s_layer('slice_{}'.format(i), lambda name: slice_layer(processed, i, name)) for i in range(len(network_input))]
@@ -165,7 +168,10 @@ class ClusterNNTry00_V135(SimpleLossClusterNN_V02):
                 # Add the output for the regularizer
                 softmax_outputs[k].append(output_classifier)
 
-        cluster_assignment_regularization = regularizer_cluster_assignment(softmax_outputs, use_v02_loss=self.__use_v02_cluster_assignment_loss)
+        cluster_assignment_regularization = regularizer_cluster_assignment(
+            softmax_outputs, use_v02_loss=self.__use_v02_cluster_assignment_loss,
+            vectorized=self.__vectorized_cluster_assignment_regularization
+        )
         self._register_additional_regularisation(
             cluster_assignment_regularization,
             'cluster_assignment_regularization',
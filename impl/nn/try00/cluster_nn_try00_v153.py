@@ -16,13 +16,14 @@ class ClusterNNTry00_V153(SimpleLossClusterNN_V02):
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
                  weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, internal_embedding_size=96,
                  kl_embedding_size=128, kl_divergence_factor=1.,
-                 simplified_center_loss_factor=1.):
+                 simplified_center_loss_factor=1., checkpoint_every_nth_block=None):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes, include_input_count_in_name=False)
 
         self.__internal_embedding_size = internal_embedding_size
 
         # Network parameters
         self.__lstm_layers = lstm_layers
+        self.__checkpoint_every_nth_block = checkpoint_every_nth_block # Gradient checkpointing for the lstm-layers
         self.__output_dense_units = output_dense_units
         self.__cluster_count_lstm_layers = cluster_count_lstm_layers
         self.__cluster_count_lstm_units = cluster_count_lstm_units
@@ -78,18 +79,18 @@ class ClusterNNTry00_V153(SimpleLossClusterNN_V02):
         # Merge all embeddings to one tensor
         embeddings_merged = self._s_layer('embeddings_merge', lambda name: Concatenate(axis=1, name=name))(embeddings_reshaped)
 
-        # Use now some lstm-layers
-        processed = embeddings_merged
-        second_last_processed = None
-        for i in range(self.__lstm_layers):
-            second_last_processed = processed
+        # Use now some lstm-layers (if required: with gradient checkpointing)
+        def block_f(i, processed):
             tmp = self._s_layer(
                 'LSTM_proc_{}'.format(i), lambda name: Bidirectional(LSTM(internal_embedding_size // 2, return_sequences=True), name=name)
             )(processed)
             if i == self.__lstm_layers - 1:
-                processed = tmp
+                return tmp
             else:
-                processed = Add()([processed, tmp])
+                return Add()([processed, tmp])
+        processed, second_last_processed = self._build_checkpointed_blocks(
+            embeddings_merged, self.__lstm_layers, block_f, self.__checkpoint_every_nth_block
+        )
 
         # Split the tensor to seperate layers
         embeddings_processed = [self._s_layer('slice_{}'.format(i), lambda name: slice_layer(processed, i, name)) for i in range(len(network_input))]
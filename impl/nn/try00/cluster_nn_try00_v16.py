@@ -11,7 +11,7 @@ from impl.nn.base.misc.deep_divergence_based_clustering import get_ddbc_loss_fun
 class ClusterNNTry00_V16(SimpleLossClusterNN_V02):
     def __init__(self, data_provider, input_count, embedding_nn=None, lstm_units=64, output_dense_units=512,
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
-                 weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64):
+                 weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, vectorized_ddbc_loss=False):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes)
 
         # Network parameters
@@ -23,6 +23,7 @@ class ClusterNNTry00_V16(SimpleLossClusterNN_V02):
         self.__cluster_count_dense_layers = cluster_count_dense_layers
         self.__cluster_count_dense_units = cluster_count_dense_units
         self.__output_dense_layers = output_dense_layers
+        self.__vectorized_ddbc_loss = vectorized_ddbc_loss
 
     def _build_network(self, network_input, network_output, additional_network_outputs):
         cluster_counts = list(self.data_provider.get_cluster_counts())
@@ -129,7 +130,7 @@ class ClusterNNTry00_V16(SimpleLossClusterNN_V02):
                 lambda i: Reshape((k,))(additional_network_outputs['clusters']['input{}'.format(i)]['cluster{}'.format(k)]),
                 range(len(embeddings)))
             )
-            ddbc_losses.append(get_ddbc_loss_function(x_inputs, s_inputs)[0])
+            ddbc_losses.append(get_ddbc_loss_function(x_inputs, s_inputs, vectorized=self.__vectorized_ddbc_loss)[0])
         ddbc_loss = concat_layer(input_count=len(ddbc_losses), axis=1)(ddbc_losses) # Concatenate(axis=1)(ddbc_losses)
         self._add_debug_output(ddbc_loss, "ddbc_loss")
         self._add_debug_output(cluster_count, "cluster_count")
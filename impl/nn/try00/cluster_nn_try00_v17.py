@@ -11,7 +11,7 @@ from impl.nn.base.misc.deep_divergence_based_clustering import get_ddbc_loss_fun
 class ClusterNNTry00_V17(SimpleLossClusterNN_V02):
     def __init__(self, data_provider, input_count, embedding_nn=None, lstm_units=64, output_dense_units=512,
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
-                 weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64):
+                 weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, vectorized_ddbc_loss=False):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes)
 
         # Network parameters
@@ -23,6 +23,7 @@ class ClusterNNTry00_V17(SimpleLossClusterNN_V02):
         self.__cluster_count_dense_layers = cluster_count_dense_layers
         self.__cluster_count_dense_units = cluster_count_dense_units
         self.__output_dense_layers = output_dense_layers
+        self.__vectorized_ddbc_loss = vectorized_ddbc_loss
 
     def _build_network(self, network_input, network_output, additional_network_outputs):
         cluster_counts = list(self.data_provider.get_cluster_counts())
@@ -132,7 +133,7 @@ class ClusterNNTry00_V17(SimpleLossClusterNN_V02):
                 range(len(embeddings)))
             )
             # ddbc_losses.append(get_ddbc_loss_function(x_inputs, s_inputs)[0])
-            _, d_a, _, d_m = get_ddbc_loss_function(x_inputs, s_inputs)
+            _, d_a, _, d_m = get_ddbc_loss_function(x_inputs, s_inputs, vectorized=self.__vectorized_ddbc_loss)
             d_a_losses.append(d_a)
             d_m_losses.append(d_m)
         # ddbc_loss = concat_layer(input_count=len(ddbc_losses), axis=1)(ddbc_losses) # Concatenate(axis=1)(ddbc_losses)
@@ -15,7 +15,7 @@ class ClusterNNTry00_V58(SimpleLossClusterNN_V02):
     def __init__(self, data_provider, input_count, embedding_nn=None, output_dense_units=512,
                  cluster_count_dense_layers=1, lstm_layers=5, output_dense_layers=1, cluster_count_dense_units=512,
                  weighted_classes=False, cluster_count_lstm_layers=2, cluster_count_lstm_units=64, internal_embedding_size=96,
-                 kl_embedding_size=128, kl_divergence_factor=1.):
+                 kl_embedding_size=128, kl_divergence_factor=1., vectorized_cluster_assignment_regularization=False):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes, include_input_count_in_name=False)
 
         self.__internal_embedding_size = internal_embedding_size
@@ -28,6 +28,7 @@ class ClusterNNTry00_V58(SimpleLossClusterNN_V02):
         self.__cluster_count_dense_layers = cluster_count_dense_layers
         self.__cluster_count_dense_units = cluster_count_dense_units
         self.__output_dense_layers = output_dense_layers
+        self.__vectorized_cluster_assignment_regularization = vectorized_cluster_assignment_regularization
         self.__kl_embedding_size = kl_embedding_size
         self.__kl_divergence_factor = kl_divergence_factor
 
@@ -154,7 +155,9 @@ class ClusterNNTry00_V58(SimpleLossClusterNN_V02):
                 # Add the output for the regularizer
                 softmax_outputs[k].append(output_classifier)
 
-        cluster_assignment_regularization = regularizer_cluster_assignment(softmax_outputs)
+        cluster_assignment_regularization = regularizer_cluster_assignment(
+            softmax_outputs, vectorized=self.__vectorized_cluster_assignment_regularization
+        )
         self._register_additional_regularisation(
             cluster_assignment_regularization,
             'cluster_assignment_regularization',
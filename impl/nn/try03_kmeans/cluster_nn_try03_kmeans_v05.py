@@ -7,14 +7,14 @@ from keras.layers import Reshape, Concatenate, Bidirectional, LSTM, Dense, Batch
 import keras.backend as K
 import tensorflow as tf
 
-from core.nn.helper import slice_layer, gaussian_random_layer, concat_layer
+from core.nn.helper import slice_layer, gaussian_random_layer, concat_layer, differentiable_kmeans
 from impl.nn.base.simple_loss.simple_loss_cluster_nn import SimpleLossClusterNN
 
 
 class ClusterNNTry03KMeansV05(SimpleLossClusterNN):
     def __init__(self, data_provider, input_count, embedding_nn=None, lstm_units=64, output_dense_units=512,
                  cluster_count_dense_layers=1, lstm_layers=0, output_dense_layers=1, cluster_count_dense_units=512,
-                 weighted_classes=False, kmeans_itrs=2, kmeans_input_dimension=2):
+                 weighted_classes=False, kmeans_itrs=2, kmeans_input_dimension=2, fused_kmeans=False):
         super().__init__(data_provider, input_count, embedding_nn, weighted_classes)
 
         # Network parameters
@@ -23,6 +23,11 @@ class ClusterNNTry03KMeansV05(SimpleLossClusterNN):
         self.__kmeans_itrs = kmeans_itrs
         self.__kmeans_input_dimension = kmeans_input_dimension
 
+        # If the k-means is fused, then all iterations for all cluster counts are calculated by one
+        # DifferentiableKMeans layer instead of unrolled distance and center layers for each point, center and
+        # iteration. The intermediate debug outputs of the iterations are not available in this case.
+        self.__fused_kmeans = fused_kmeans
+
         self.__output_dense_units = output_dense_units
         self.__cluster_count_dense_layers = cluster_count_dense_layers
         self.__cluster_count_dense_units = cluster_count_dense_units
@@ -110,6 +115,7 @@ class ClusterNNTry03KMeansV05(SimpleLossClusterNN):
         assert self.__kmeans_itrs > 0
         cluster_vector_size = self.__kmeans_input_dimension #(self.__lstm_units * 2) if self.__lstm_layers > 0 else embedding_size
         cluster_assignements = {}
+        initial_clusters = {}
         initial_cluster_guess = Concatenate(axis=1)(embeddings_processed)
         initial_cluster_guess_lstm_count = 3
         for i in range(initial_cluster_guess_lstm_count):
@@ -190,6 +196,11 @@ class ClusterNNTry03KMeansV05(SimpleLossClusterNN):
             for i in range(len(clusters)):
                 add_dbg_output('INIT_CLUSTER_{}'.format(i), clusters[i])
 
+            # The fused k-means is calculated for all cluster counts at once (see below)
+            if self.__fused_kmeans:
+                initial_clusters[k] = clusters
+                continue
+
             # Cluster-assignements
             current_cluster_assignements = None
 
@@ -278,6 +289,14 @@ class ClusterNNTry03KMeansV05(SimpleLossClusterNN):
                 '3_Final_cluster_guesses_(k={})'.format(k)
             )
 
+        # Do all iterations for all cluster counts at once
+        if self.__fused_kmeans:
+            cluster_assignements, final_clusters = differentiable_kmeans(
+                embeddings_processed, initial_clusters, self.__kmeans_itrs
+            )
+            for k in cluster_counts:
+                self._add_additional_prediction_output(final_clusters[k], '3_Final_cluster_guesses_(k={})'.format(k))
+
         # Reshape all softmax layers
         for k in cluster_counts:
             cluster_assignements[k] = [
@@ -0,0 +1,65 @@
+"""
+Check that the vectorized auxiliary losses (core.nn.helper) calculate the same values as the loop versions:
+- reweight_values_vectorized vs. reweight_values (used by the simplified center loss)
+- pairwise_comparisons_tensor vs. a comparator call for each pair (the embedding comparison regularisations)
+Additionally the amount of graph operations of both versions is printed.
+"""
+import numpy as np
+
+from keras.layers import Input, Lambda
+import keras.backend as K
+
+from core.nn.helper import reweight_values, reweight_values_vectorized, pairwise_comparisons_tensor, \
+    lukic_kl_divergence, concat, get_pair_indices
+from playground.benchmark_helper import DEFAULT_SEED, softmax
+
+
+def count_operations(f):
+    graph = K.get_session().graph
+    operations_before = len(graph.get_operations())
+    result = f()
+    return result, len(graph.get_operations()) - operations_before
+
+
+def check_auxiliary_losses(input_count=12, embedding_size=16, batch_size=16, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    inputs = [Input((1, embedding_size)) for i in range(input_count)]
+    data = [softmax(rand.randn(batch_size, 1, embedding_size)) for i in range(input_count)]
+
+    all_equal = True
+    for include_self_comparison in [True, False]:
+        i_source, i_target = get_pair_indices(input_count, include_self_comparison)
+        similarities = Input((i_source.shape[0],))
+        similarities_data = rand.randint(0, 2, (batch_size, i_source.shape[0])).astype(np.float32)
+
+        def loop_comparisons():
+            cmp_eq = [lukic_kl_divergence(inputs[i], inputs[j], 1.) for i, j in zip(i_source, i_target)]
+            cmp_ne = [lukic_kl_divergence(inputs[i], inputs[j], 0.) for i, j in zip(i_source, i_target)]
+            return concat([concat(cmp_eq, axis=1), concat(cmp_ne, axis=1)], axis=1)
+
+        def vectorized_comparisons():
+            return Lambda(lambda x: pairwise_comparisons_tensor(
+                x, lukic_kl_divergence, input_count, include_self_comparison
+            ))(concat(inputs, axis=1))
+
+        checks = [
+            ('center loss', lambda: concat(reweight_values(inputs, similarities), axis=1),
+             lambda: reweight_values_vectorized(inputs, similarities)),
+            ('embedding comparisons', loop_comparisons, vectorized_comparisons)
+        ]
+        for name, f_loop, f_vectorized in checks:
+            loop, loop_operations = count_operations(f_loop)
+            vectorized, vectorized_operations = count_operations(f_vectorized)
+            loop_value, vectorized_value = K.function(inputs + [similarities], [loop, vectorized])(data + [similarities_data])
+            equal = loop_value.shape == vectorized_value.shape and np.allclose(loop_value, vectorized_value, rtol=1e-5, atol=1e-6)
+            all_equal = all_equal and equal
+            print("{} (include_self_comparison={}): {} (max. abs. difference: {}, operations: {} => {})".format(
+                name, include_self_comparison, 'OK' if equal else 'FAILED',
+                np.max(np.abs(loop_value - vectorized_value)) if loop_value.shape == vectorized_value.shape else 'shape mismatch',
+                loop_operations, vectorized_operations
+            ))
+    return all_equal
+
+
+if __name__ == '__main__':
+    assert check_auxiliary_losses()
@@ -0,0 +1,66 @@
+"""
+Helpers for the check and benchmark scripts in the playground:
+- softmax and DEFAULT_SEED for the generated test data
+- run_in_process runs one measurement in a new (spawned) process, therefore the measurements of different
+  configurations do not influence each other (graph, caches, memory)
+- get_max_rss_mb returns the peak memory of the current process
+"""
+import multiprocessing
+import queue as queue_module
+import resource
+import traceback
+
+import numpy as np
+
+DEFAULT_SEED = 1729
+
+
+def softmax(x):
+    x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return (x / np.sum(x, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def get_max_rss_mb():
+    """
+    Get the peak memory (max. RSS) of the current process in MiB. ru_maxrss is inherited over exec (spawn), therefore
+    the high water mark of /proc is used if it is available (Linux).
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _run_and_put(f, args, queue):
+    try:
+        queue.put((True, f(*args)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+def run_in_process(f, *args):
+    """
+    Call f(*args) in a new process and return the result. f and the result have to be picklable (f must be a module
+    level function).
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_and_put, args=(f, args, queue))
+    process.start()
+    while True:
+        try:
+            success, result = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                raise Exception("The benchmark process died (exit code {}), e.g. it ran out of memory".format(
+                    process.exitcode
+                ))
+    process.join()
+    if not success:
+        raise Exception("The benchmark process failed:\n{}".format(result))
+    return result
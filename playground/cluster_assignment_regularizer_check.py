@@ -0,0 +1,37 @@
+"""
+Check that the vectorized cluster assignment regularizers (core.nn.helper) calculate the same values as the loop
+versions regularizer_cluster_assignment and regularizer_cluster_assignment_new.
+"""
+import numpy as np
+
+from keras.layers import Input
+import keras.backend as K
+
+from core.nn.helper import regularizer_cluster_assignment, regularizer_cluster_assignment_new
+from playground.benchmark_helper import DEFAULT_SEED, softmax
+
+
+def check_cluster_assignment_regularizers(input_count=12, cluster_counts=(1, 2, 3, 4, 5), batch_size=16, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    inputs = {k: [Input((1, k)) for i in range(input_count)] for k in cluster_counts}
+    data = {k: [softmax(rand.randn(batch_size, 1, k)) for i in range(input_count)] for k in cluster_counts}
+    input_list = [x for k in cluster_counts for x in inputs[k]]
+    data_list = [x for k in cluster_counts for x in data[k]]
+
+    all_equal = True
+    for f_regularizer in [regularizer_cluster_assignment, regularizer_cluster_assignment_new]:
+        for use_v02_loss in [False, True]:
+            loop = f_regularizer(inputs, use_v02_loss=use_v02_loss)
+            vectorized = f_regularizer(inputs, use_v02_loss=use_v02_loss, vectorized=True)
+            loop_value, vectorized_value = K.function(input_list, [loop, vectorized])(data_list)
+            equal = loop_value.shape == vectorized_value.shape and np.allclose(loop_value, vectorized_value, rtol=1e-5, atol=1e-6)
+            all_equal = all_equal and equal
+            print("{} (use_v02_loss={}): {} (max. abs. difference: {})".format(
+                f_regularizer.__name__, use_v02_loss, 'OK' if equal else 'FAILED',
+                np.max(np.abs(loop_value - vectorized_value)) if loop_value.shape == vectorized_value.shape else 'shape mismatch'
+            ))
+    return all_equal
+
+
+if __name__ == '__main__':
+    assert check_cluster_assignment_regularizers()
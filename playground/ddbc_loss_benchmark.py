@@ -0,0 +1,82 @@
+"""
+Compare the two implementations of the DDBC loss (impl.nn.base.misc.deep_divergence_based_clustering):
+- loop: get_ddbc_loss_function (python lists of lists, concat layers and chained batch_dot calls)
+- vectorized: get_ddbc_loss_function_vectorized (batched tensor operations on the stacked inputs)
+
+First the parity of all four outputs (loss, d_a, triuAAt, d_m) is checked, then for each input count the build time
+and the time of a training step (forward and backward pass) and the peak memory (max. RSS) are measured in a separate
+process.
+"""
+from time import time
+
+import numpy as np
+
+from playground.benchmark_helper import DEFAULT_SEED, softmax, get_max_rss_mb, run_in_process
+
+
+def build_ddbc_graph(n, embedding_size, k, vectorized):
+    from keras.layers import Input
+    from impl.nn.base.misc.deep_divergence_based_clustering import get_ddbc_loss_function
+
+    x_inputs = [Input((embedding_size,)) for i in range(n)]
+    s_inputs = [Input((k,)) for i in range(n)]
+    return x_inputs + s_inputs, list(get_ddbc_loss_function(x_inputs, s_inputs, vectorized=vectorized))
+
+
+def generate_inputs(n, embedding_size, k, batch_size, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    return [rand.uniform(-1, 1, (batch_size, embedding_size)).astype(np.float32) for i in range(n)] + \
+           [softmax(rand.uniform(-5, 5, (batch_size, k))) for i in range(n)]
+
+
+def check_ddbc_loss(n=10, embedding_size=4, k=3, batch_size=8):
+    import keras.backend as K
+
+    data = generate_inputs(n, embedding_size, k, batch_size)
+    results = {}
+    for vectorized in [False, True]:
+        inputs, outputs = build_ddbc_graph(n, embedding_size, k, vectorized)
+        results[vectorized] = K.function(inputs, outputs)(data)
+
+    all_equal = True
+    for name, loop_value, vectorized_value in zip(['loss', 'd_a', 'triuAAt', 'd_m'], results[False], results[True]):
+        equal = loop_value.shape == vectorized_value.shape and np.allclose(loop_value, vectorized_value, rtol=1e-4, atol=1e-5)
+        all_equal = all_equal and equal
+        print("{}: {} (max. abs. difference: {})".format(
+            name, 'OK' if equal else 'FAILED',
+            np.max(np.abs(loop_value - vectorized_value)) if loop_value.shape == vectorized_value.shape else 'shape mismatch'
+        ))
+    return all_equal
+
+
+def run_benchmark(n, embedding_size, k, batch_size, vectorized, steps):
+    import keras.backend as K
+
+    t_start = time()
+    inputs, outputs = build_ddbc_graph(n, embedding_size, k, vectorized)
+    loss = K.mean(outputs[0])
+    f = K.function(inputs, [loss] + K.gradients(loss, inputs))
+    build_time = time() - t_start
+
+    data = generate_inputs(n, embedding_size, k, batch_size)
+    f(data)
+    t_start = time()
+    for i in range(steps):
+        f(data)
+    step_time = (time() - t_start) / steps
+
+    return build_time, step_time, get_max_rss_mb()
+
+
+def benchmark(input_counts=(5, 10, 20, 50), embedding_size=64, k=5, batch_size=100, steps=10):
+    for n in input_counts:
+        for vectorized in [False, True]:
+            build_time, step_time, max_rss = run_in_process(run_benchmark, n, embedding_size, k, batch_size, vectorized, steps)
+            print("N={:3d} {:10s}: build {:8.2f}s, step {:8.4f}s, max. RSS {:8.1f} MiB".format(
+                n, 'vectorized' if vectorized else 'loop', build_time, step_time, max_rss
+            ))
+
+
+if __name__ == '__main__':
+    assert check_ddbc_loss()
+    benchmark()
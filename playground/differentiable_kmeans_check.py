@@ -0,0 +1,61 @@
+"""
+Check that core.nn.helper.differentiable_kmeans (one DifferentiableKMeans layer for all cluster counts) calculates the
+same soft assignments and final centers as a plain soft k-means for each cluster count (the k-means of the
+try03_kmeans networks).
+"""
+import numpy as np
+
+from keras.layers import Input
+import keras.backend as K
+
+from core.nn.helper import differentiable_kmeans
+from playground.benchmark_helper import DEFAULT_SEED
+
+
+def soft_kmeans(points, initial_centers, iterations, center_epsilon=1e-8):
+    def assign(centers):
+        distances = np.sum(np.square(points[:, :, None] - centers[:, None]), axis=3)
+        logits = -np.square(1 + distances)
+        assignments = np.exp(logits - np.max(logits, axis=2, keepdims=True))
+        return assignments / np.sum(assignments, axis=2, keepdims=True)
+
+    centers = initial_centers
+    assignments = assign(centers)
+    for i in range(1, iterations):
+        centers = np.einsum('bnk,bnd->bkd', assignments, points) / (center_epsilon + np.sum(assignments, axis=1)[:, :, None])
+        assignments = assign(centers)
+    return assignments, centers
+
+
+def check_differentiable_kmeans(input_count=20, dimension=2, cluster_counts=(1, 2, 3, 4, 5), iterations=3, batch_size=8, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    points = np.tanh(rand.randn(batch_size, input_count, dimension)).astype(np.float32)
+    initial_centers = {k: np.tanh(rand.randn(batch_size, k, dimension)).astype(np.float32) for k in cluster_counts}
+
+    points_inputs = [Input((1, dimension)) for i in range(input_count)]
+    initial_centers_inputs = {k: Input((k, dimension)) for k in cluster_counts}
+    assignments, centers = differentiable_kmeans(points_inputs, initial_centers_inputs, iterations)
+    f = K.function(
+        points_inputs + [initial_centers_inputs[k] for k in cluster_counts],
+        [x for k in cluster_counts for x in assignments[k]] + [centers[k] for k in cluster_counts]
+    )
+    results = f([points[:, i:(i + 1)] for i in range(input_count)] + [initial_centers[k] for k in cluster_counts])
+
+    all_equal = True
+    for i_k, k in enumerate(cluster_counts):
+        expected_assignments, expected_centers = soft_kmeans(points, initial_centers[k], iterations)
+        fused_assignments = np.concatenate(results[(i_k * input_count):((i_k + 1) * input_count)], axis=1)
+        fused_centers = results[len(cluster_counts) * input_count + i_k]
+        equal = np.allclose(fused_assignments, expected_assignments, rtol=1e-4, atol=1e-5) and \
+            np.allclose(fused_centers, expected_centers, rtol=1e-4, atol=1e-5)
+        all_equal = all_equal and equal
+        print("k={}: {} (max. abs. difference: {})".format(
+            k, 'OK' if equal else 'FAILED', max(
+                np.max(np.abs(fused_assignments - expected_assignments)), np.max(np.abs(fused_centers - expected_centers))
+            )
+        ))
+    return all_equal
+
+
+if __name__ == '__main__':
+    assert check_differentiable_kmeans()
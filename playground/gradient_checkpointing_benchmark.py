@@ -0,0 +1,89 @@
+"""
+Gradient checkpointing for the RBDLSTM stacks (checkpoint_every_nth_block of ClusterNNTry00_V122 and later variants).
+
+First it is checked that checkpointed_gradients calculates the same gradients as K.gradients for a stack of residual
+BDLSTM blocks (with a layer before and after the stack). Then ClusterNNTry00_V122 with lstm_layers=14 and
+internal_embedding_size=288 is trained with different checkpoint distances; for each configuration the build time,
+the time of a training iteration and the peak memory (max. RSS of a separate process, once after the build and once
+after the training) are printed.
+"""
+from time import time
+
+import numpy as np
+
+from playground.benchmark_helper import DEFAULT_SEED, get_max_rss_mb, run_in_process
+
+
+def check_checkpointed_gradients(input_count=12, units=16, block_count=6, checkpoint_every_nth_block=2, batch_size=8, seed=DEFAULT_SEED):
+    from keras.layers import Input, Dense, Bidirectional, LSTM, Add
+    import keras.backend as K
+    from core.nn.helper import gradient_checkpointed_blocks, checkpointed_gradients
+
+    x = Input((input_count, units))
+    input_layer = Dense(units)
+    output_layer = Dense(1)
+    block_layers = [Bidirectional(LSTM(units // 2, return_sequences=True)) for i in range(block_count)]
+
+    def block_f(i, x):
+        return Add()([x, block_layers[i](x)])
+
+    losses = {}
+    chains = {}
+    for n in [None, checkpoint_every_nth_block]:
+        processed, second_last, chains[n] = gradient_checkpointed_blocks(input_layer(x), block_count, block_f, n)
+        losses[n] = K.mean(K.square(output_layer(processed))) + K.mean(second_last)
+    params = input_layer.trainable_weights + output_layer.trainable_weights + \
+        [w for l in block_layers for w in l.trainable_weights]
+
+    f = K.function([x], K.gradients(losses[None], params) + checkpointed_gradients(
+        losses[checkpoint_every_nth_block], params, [chains[checkpoint_every_nth_block]]
+    ))
+    gradients = f([np.random.RandomState(seed).randn(batch_size, input_count, units).astype(np.float32)])
+    max_difference = max(np.max(np.abs(g0 - g1)) for g0, g1 in zip(gradients[:len(params)], gradients[len(params):]))
+    equal = max_difference < 1e-5
+    print("Checkpointed gradients: {} (max. abs. difference: {})".format('OK' if equal else 'FAILED', max_difference))
+    return equal
+
+
+def run_benchmark(checkpoint_every_nth_block, input_count, minibatch_size, lstm_layers, internal_embedding_size, iterations):
+    from impl.data.simple_2d_point_data_provider import Simple2DPointDataProvider
+    from impl.nn.try00.cluster_nn_try00_v122 import ClusterNNTry00_V122
+
+    dp = Simple2DPointDataProvider(min_cluster_count=1, max_cluster_count=5, use_extended_data_gen=True)
+    c_nn = ClusterNNTry00_V122(
+        dp, input_count, None, lstm_layers=lstm_layers, internal_embedding_size=internal_embedding_size,
+        cluster_count_dense_layers=1, cluster_count_dense_units=256, output_dense_layers=1, output_dense_units=256,
+        cluster_count_lstm_layers=1, cluster_count_lstm_units=128, checkpoint_every_nth_block=checkpoint_every_nth_block
+    )
+    c_nn.include_self_comparison = False
+    c_nn.minibatch_size = minibatch_size
+    c_nn.validate_every_nth_epoch = iterations + 10
+
+    t_start = time()
+    c_nn.build_networks(print_summaries=False)
+    build_time = time() - t_start
+    build_max_rss = get_max_rss_mb()
+
+    # The first iteration includes the graph initialization, therefore it is not measured
+    c_nn.train(1)
+    t_start = time()
+    c_nn.train(iterations)
+    iteration_time = (time() - t_start) / iterations
+
+    return build_time, iteration_time, build_max_rss, get_max_rss_mb()
+
+
+def benchmark(checkpoint_distances=(None, 1, 2, 4, 7), input_count=100, minibatch_size=100, lstm_layers=14,
+              internal_embedding_size=288, iterations=5):
+    for checkpoint_every_nth_block in checkpoint_distances:
+        build_time, iteration_time, build_max_rss, max_rss = run_in_process(
+            run_benchmark, checkpoint_every_nth_block, input_count, minibatch_size, lstm_layers, internal_embedding_size, iterations
+        )
+        print("checkpoint_every_nth_block={:4s}: build {:7.2f}s, iteration {:7.2f}s, max. RSS {:8.1f} MiB (after the build: {:8.1f} MiB)".format(
+            str(checkpoint_every_nth_block), build_time, iteration_time, max_rss, build_max_rss
+        ))
+
+
+if __name__ == '__main__':
+    assert check_checkpointed_gradients()
+    benchmark()
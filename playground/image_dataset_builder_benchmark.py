@@ -0,0 +1,34 @@
+"""
+Measure how fast impl.data.misc.simple_class_based_dataset.load_data decodes and resizes a dataset directory
+(top_dir/class_name/img.jpg) for different amounts of worker processes (no cache is used). The first run (one worker)
+is the reference: All other runs have to return the same images.
+
+Usage: python image_dataset_builder_benchmark.py <dataset_dir> [<height> <width>]
+"""
+import sys
+from multiprocessing import cpu_count
+from time import time
+
+import numpy as np
+
+from impl.data.misc.simple_class_based_dataset import load_data
+
+
+def benchmark(top_dir, target_img_size=(48, 48), worker_counts=None):
+    if worker_counts is None:
+        worker_counts = sorted({1, 2, 4, cpu_count()})
+    reference = None
+    for workers in worker_counts:
+        t_start = time()
+        x, y = load_data(top_dir, target_img_size=target_img_size, disable_cache_file=True, workers=workers)
+        duration = time() - t_start
+        if reference is None:
+            reference = (x, y)
+        equal = np.array_equal(x, reference[0]) and np.array_equal(y, reference[1])
+        print("workers={:3d}: {:8.2f}s ({:.1f} images/s) {}".format(
+            workers, duration, x.shape[0] / duration, 'OK' if equal else 'FAILED'
+        ))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1], tuple(map(int, sys.argv[2:4])) if len(sys.argv) >= 4 else (48, 48))
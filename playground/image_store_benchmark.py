@@ -0,0 +1,86 @@
+"""
+Compare the memory usage of the two ways the image data providers keep their images:
+- dict: all images are scaled to float32 and split with {i: x[y == i] for i in np.unique(y)}
+- store: the uint8 images are written to a ClassGroupedImageStore (impl.data.misc.class_grouped_image_store) and only
+  the sampled images are read and scaled
+
+First it is checked that both contain the same images, then for each variant the peak RSS (after loading and after
+sampling some batches) and the sampling time are measured in a separate process.
+"""
+import os
+import shutil
+import tempfile
+from time import time
+
+import numpy as np
+
+from impl.data.misc.class_grouped_image_store import ClassGroupedImageStore
+from playground.benchmark_helper import DEFAULT_SEED, get_max_rss_mb, run_in_process
+
+
+def generate_records(n, image_shape, class_count, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    x = rand.randint(0, 256, (n,) + image_shape).astype(np.uint8)
+    y = rand.randint(0, class_count, (n,))
+    return x, y
+
+
+def scale(x):
+    return (x.astype(np.float32) / 255 - 0.5) * 2
+
+
+def check_image_store(store_dir, n=1000, image_shape=(16, 16, 3), class_count=13):
+    x, y = generate_records(n, image_shape, class_count)
+    store = ClassGroupedImageStore.create(os.path.join(store_dir, 'check'), x, y, chunk_size=100)
+    data = {i: scale(x[y == i]) for i in np.unique(y)}
+    equal = sorted(store.keys()) == sorted(data.keys()) and \
+        all(np.array_equal(scale(store[i]), data[i]) for i in data.keys())
+    print("Image store: {}".format('OK' if equal else 'FAILED'))
+    return equal
+
+
+def run_benchmark(store_path, records_args, use_store, batches, batch_size):
+    if use_store:
+        data = ClassGroupedImageStore(store_path)
+    else:
+        x, y = generate_records(*records_args)
+        x = scale(x)
+        data = {i: x[y == i] for i in np.unique(y)}
+        del x, y
+    load_rss = get_max_rss_mb()
+
+    rand = np.random.RandomState(42)
+    classes = list(data.keys())
+    t_start = time()
+    for i in range(batches):
+        for j in range(batch_size):
+            class_data = data[classes[rand.randint(len(classes))]]
+            element = np.reshape(class_data[rand.randint(class_data.shape[0])], (1,) + class_data.shape[1:])
+            element = scale(element) if use_store else np.copy(element)
+    sample_time = (time() - t_start) / batches
+
+    return load_rss, get_max_rss_mb(), sample_time
+
+
+def benchmark(store_dir, n=20000, image_shape=(64, 64, 3), class_count=100, batches=20, batch_size=200):
+    store_path = os.path.join(store_dir, 'benchmark')
+    x, y = generate_records(n, image_shape, class_count)
+    ClassGroupedImageStore.create(store_path, x, y)
+    del x, y
+
+    for use_store in [False, True]:
+        load_rss, sample_rss, sample_time = run_in_process(
+            run_benchmark, store_path, (n, image_shape, class_count), use_store, batches, batch_size
+        )
+        print("{:5s}: max. RSS after loading {:8.1f} MiB, after sampling {:8.1f} MiB, {:8.4f}s per batch".format(
+            'store' if use_store else 'dict', load_rss, sample_rss, sample_time
+        ))
+
+
+if __name__ == '__main__':
+    store_dir = tempfile.mkdtemp()
+    try:
+        assert check_image_store(store_dir)
+        benchmark(store_dir)
+    finally:
+        shutil.rmtree(store_dir)
@@ -0,0 +1,73 @@
+"""
+Check the sampled pair training objective of SimpleLossClusterNN_V02 (sampled_pairs):
+- sampled_pair_similarities_tensor calculates the same similarities as pairwise_cluster_similarities_tensor for the
+  sampled pairs
+- the weighted mean of the binary crossentropy over the pairs of sample_pairs is an unbiased estimate of the mean over
+  all pairs (the average over many samples is compared with the full loss)
+"""
+import numpy as np
+
+from keras.layers import Input
+import keras.backend as K
+
+from core.nn.helper import sample_pairs, sampled_pair_similarities_tensor, pairwise_cluster_similarities_tensor, \
+    get_pair_indices, cluster_indices_to_similarities
+from playground.benchmark_helper import DEFAULT_SEED, softmax
+
+
+def check_sampled_pairs(input_count=30, cluster_counts=(1, 2, 3, 4, 5), sample_count=40, batch_size=8, repetitions=2000,
+                        include_self_comparison=True, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    k_max = max(cluster_counts)
+    softmax_dists = [softmax(rand.randn(batch_size, input_count, k)) for k in cluster_counts]
+    cluster_count_dist = softmax(rand.randn(batch_size, len(cluster_counts)))
+    cluster_indices = rand.randint(0, 3, (batch_size, input_count))
+    padded_softmax_dists = np.stack([
+        np.concatenate([s, np.zeros((batch_size, input_count, k_max - k), dtype=np.float32)], axis=2)
+        for s, k in zip(softmax_dists, cluster_counts)
+    ], axis=2)
+
+    softmax_inputs = [Input((input_count, k)) for k in cluster_counts]
+    padded_input = Input((input_count, len(cluster_counts), k_max))
+    cluster_count_input = Input((len(cluster_counts),))
+    i_source_input = Input((sample_count,))
+    i_target_input = Input((sample_count,))
+    f_all = K.function(softmax_inputs + [cluster_count_input], [
+        pairwise_cluster_similarities_tensor(softmax_inputs, cluster_count_input, input_count, include_self_comparison)
+    ])
+    f_sampled = K.function([padded_input, cluster_count_input, i_source_input, i_target_input], [
+        sampled_pair_similarities_tensor(padded_input, cluster_count_input, i_source_input, i_target_input)
+    ])
+
+    def binary_crossentropy(t, p):
+        p = np.clip(p, 1e-7, 1 - 1e-7)
+        return -(t * np.log(p) + (1 - t) * np.log(1 - p))
+
+    all_similarities = f_all(softmax_dists + [cluster_count_dist])[0]
+    full_loss = np.mean(binary_crossentropy(cluster_indices_to_similarities(cluster_indices, include_self_comparison), all_similarities), axis=1)
+
+    # Map the pairs to the index in the similarities output
+    i_source_all, i_target_all = get_pair_indices(input_count, include_self_comparison)
+    pair_index = np.zeros((input_count, input_count), dtype=np.int32)
+    pair_index[i_source_all, i_target_all] = np.arange(i_source_all.shape[0])
+
+    max_difference = 0.
+    estimated_loss = np.zeros((batch_size,))
+    for i in range(repetitions):
+        i_source, i_target, weights = sample_pairs(cluster_indices, sample_count, include_self_comparison, rand=rand)
+        sampled_similarities = f_sampled([padded_softmax_dists, cluster_count_dist, i_source, i_target])[0]
+        expected_similarities = all_similarities[np.arange(batch_size)[:, np.newaxis], pair_index[i_source, i_target]]
+        max_difference = max(max_difference, np.max(np.abs(sampled_similarities - expected_similarities)))
+        targets = (cluster_indices[np.arange(batch_size)[:, np.newaxis], i_source] == cluster_indices[np.arange(batch_size)[:, np.newaxis], i_target])
+        estimated_loss += np.mean(weights * binary_crossentropy(targets, sampled_similarities), axis=1)
+    estimated_loss /= repetitions
+
+    similarities_ok = max_difference < 1e-5
+    loss_ok = np.allclose(estimated_loss, full_loss, rtol=0.02)
+    print("Sampled similarities: {} (max. abs. difference: {})".format('OK' if similarities_ok else 'FAILED', max_difference))
+    print("Loss estimate: {} (full loss: {}, mean estimate: {})".format('OK' if loss_ok else 'FAILED', full_loss, estimated_loss))
+    return similarities_ok and loss_ok
+
+
+if __name__ == '__main__':
+    assert check_sampled_pairs()
@@ -0,0 +1,89 @@
+"""
+Compare the set encoders of ClusterNNTry00_V122 (set_encoder='rbdlstm', 'sab' and 'isab') on two data providers:
+- Simple2DPointDataProvider (without an embedding network)
+- MNISTDataProvider (with a small CNN embedding)
+
+Each encoder is trained for a fixed amount of iterations in a separate process. The throughput (training iterations
+per second, prediction time for one batch and peak memory) and the quality (validation loss and the mean adjusted
+rand index for the true cluster count on test data) are printed.
+"""
+from time import time
+
+import numpy as np
+
+from playground.benchmark_helper import get_max_rss_mb, run_in_process
+
+
+def create_network(provider, set_encoder, input_count, lstm_layers):
+    from keras.optimizers import Adadelta
+    from impl.nn.try00.cluster_nn_try00_v122 import ClusterNNTry00_V122
+
+    if provider == 'points':
+        from impl.data.simple_2d_point_data_provider import Simple2DPointDataProvider
+        dp = Simple2DPointDataProvider(min_cluster_count=1, max_cluster_count=5, use_extended_data_gen=True)
+        en = None
+    else:
+        from impl.data.image.mnist_data_provider import MNISTDataProvider
+        from impl.nn.base.embedding_nn.cnn_embedding import CnnEmbedding
+        dp = MNISTDataProvider(min_cluster_count=1, max_cluster_count=5)
+        en = CnnEmbedding(
+            output_size=64, cnn_layers_per_block=1, block_feature_counts=[16, 32],
+            fc_layer_feature_counts=[], hidden_activation='relu', final_activation='relu',
+            batch_norm_for_init_layer=True
+        )
+
+    c_nn = ClusterNNTry00_V122(
+        dp, input_count, en, lstm_layers=lstm_layers, internal_embedding_size=96, cluster_count_dense_layers=1,
+        cluster_count_dense_units=128, output_dense_layers=1, output_dense_units=128, cluster_count_lstm_layers=1,
+        cluster_count_lstm_units=64, kl_embedding_size=64, set_encoder=set_encoder
+    )
+    c_nn.packed_input = True
+    c_nn.include_self_comparison = False
+    c_nn.minibatch_size = 25
+    c_nn.validate_every_nth_epoch = 10
+    c_nn.validation_data_count = c_nn.minibatch_size
+    c_nn.optimizer = Adadelta(lr=5.0)
+    return c_nn, dp
+
+
+def run_benchmark(provider, set_encoder, input_count, lstm_layers, iterations, test_count):
+    c_nn, dp = create_network(provider, set_encoder, input_count, lstm_layers)
+
+    t_start = time()
+    c_nn.build_networks(print_summaries=False)
+    build_time = time() - t_start
+
+    # The first iteration includes the graph initialization, therefore it is not measured
+    c_nn.train(1)
+    t_start = time()
+    c_nn.train(iterations)
+    iterations_per_second = iterations / (time() - t_start)
+
+    history = c_nn._get_history(c_nn._model_training)
+    val_loss = [v for v in history['val_loss'] if v is not None]
+
+    # Evaluate the clustering quality for the true cluster count
+    data, _, _ = dp.get_data(input_count, test_count, data_type='test')
+    t_start = time()
+    metrics = c_nn.evaluate_metrics(data)
+    prediction_time = time() - t_start
+    ari = np.mean([m['adjusted_rand_score'][len(collection)] for m, collection in zip(metrics, data)])
+
+    return build_time, iterations_per_second, prediction_time, val_loss[-1] if len(val_loss) > 0 else None, ari, get_max_rss_mb()
+
+
+def benchmark(providers=('points', 'mnist'), set_encoders=('rbdlstm', 'sab', 'isab'), input_counts=(20, 50, 100),
+              lstm_layers=4, iterations=200, test_count=100):
+    for provider in providers:
+        for n in input_counts:
+            for set_encoder in set_encoders:
+                build_time, iterations_per_second, prediction_time, val_loss, ari, max_rss = run_in_process(
+                    run_benchmark, provider, set_encoder, n, lstm_layers, iterations, test_count
+                )
+                print("{:6s} N={:3d} {:7s}: build {:7.2f}s, {:6.2f} itr/s, prediction {:6.2f}s, val. loss {}, ARI {:.4f}, max. RSS {:8.1f} MiB".format(
+                    provider, n, set_encoder, build_time, iterations_per_second, prediction_time, val_loss, ari, max_rss
+                ))
+
+
+if __name__ == '__main__':
+    benchmark()
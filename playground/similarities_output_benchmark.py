@@ -0,0 +1,83 @@
+"""
+Compare the two implementations of the similarities output of SimpleLossClusterNN_V02:
+- loop: A Dot layer for each pair and cluster count, a concat and a "cluster attention" Dot for each pair
+- vectorized: pairwise_cluster_similarities_tensor (a batched matrix product for each cluster count and one gather)
+
+For each input count the build time, the time of a training step (forward and backward pass) and the peak memory
+(max. RSS of a separate process) are measured. Both graphs must produce the same output.
+"""
+from time import time
+
+import numpy as np
+
+from playground.benchmark_helper import DEFAULT_SEED, softmax, get_max_rss_mb, run_in_process
+
+
+def build_similarities_graph(n, cluster_counts, vectorized, include_self_comparison=True):
+    from keras.layers import Input, Dot, Reshape
+    from core.nn.helper import concat_layer, slice_layer, pairwise_cluster_similarities_tensor
+
+    softmax_inputs = [Input((n, k)) for k in cluster_counts]
+    cluster_count_input = Input((len(cluster_counts),))
+    inputs = softmax_inputs + [cluster_count_input]
+    if vectorized:
+        return inputs, pairwise_cluster_similarities_tensor(softmax_inputs, cluster_count_input, n, include_self_comparison)
+
+    # The same graph as SimpleLossClusterNN_V02 creates with vectorized_similarities=False
+    softmax_dists = [[slice_layer(s, i) for s in softmax_inputs] for i in range(n)]
+    k_dot_prod = [Dot(axes=2) for k in cluster_counts]
+    softmax_dot_concat = concat_layer(input_count=len(cluster_counts))
+    softmax_dot_concat_reshaper = Reshape((len(cluster_counts),))
+    cluster_attention = Dot(axes=1)
+    similarities = []
+    for i_source in range(n):
+        for i_target in range(i_source if include_self_comparison else i_source + 1, n):
+            k_comparisons = [
+                k_dot_prod[j]([softmax_dists[i_source][j], softmax_dists[i_target][j]]) for j in range(len(cluster_counts))
+            ]
+            comparisons_concat = softmax_dot_concat_reshaper(softmax_dot_concat(k_comparisons))
+            similarities.append(cluster_attention([comparisons_concat, cluster_count_input]))
+    return inputs, concat_layer(input_count=len(similarities))(similarities)
+
+
+def generate_inputs(n, cluster_counts, batch_size, seed=DEFAULT_SEED):
+    rand = np.random.RandomState(seed)
+    return [softmax(rand.randn(batch_size, n, k)) for k in cluster_counts] + \
+           [softmax(rand.randn(batch_size, len(cluster_counts)))]
+
+
+def run_benchmark(n, cluster_counts, batch_size, vectorized, steps):
+    import keras.backend as K
+
+    t_start = time()
+    inputs, output = build_similarities_graph(n, cluster_counts, vectorized)
+    loss = K.mean(K.square(output))
+    f = K.function(inputs, [output] + K.gradients(loss, inputs))
+    build_time = time() - t_start
+
+    data = generate_inputs(n, cluster_counts, batch_size)
+    result = f(data)[0]
+    t_start = time()
+    for i in range(steps):
+        f(data)
+    step_time = (time() - t_start) / steps
+
+    return build_time, step_time, get_max_rss_mb(), result
+
+
+def benchmark(input_counts=(20, 50, 100), cluster_counts=(1, 2, 3, 4, 5), batch_size=100, steps=10):
+    for n in input_counts:
+        results = {}
+        for vectorized in [False, True]:
+            results[vectorized] = run_in_process(run_benchmark, n, list(cluster_counts), batch_size, vectorized, steps)
+            build_time, step_time, max_rss, _ = results[vectorized]
+            print("N={:3d} {:10s}: build {:8.2f}s, step {:8.4f}s, max. RSS {:8.1f} MiB".format(
+                n, 'vectorized' if vectorized else 'loop', build_time, step_time, max_rss
+            ))
+        print("N={:3d} identical output: {} (max. abs. difference: {})".format(
+            n, np.array_equal(results[False][3], results[True][3]), np.max(np.abs(results[False][3] - results[True][3]))
+        ))
+
+
+if __name__ == '__main__':
+    benchmark()